@@ -0,0 +1,262 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Generates large, realistically skewed corpora of user agents, and benchmarks parsing
+them.
+
+    python -m benchmarks.corpus generate corpus.txt [--size N] [--distinct N]
+        [--zipf S] [--seed N]
+    python -m benchmarks.corpus run corpus.txt
+
+Every user agent in our test fixtures is a template for its family, with each of its
+version numbers swapped out for others drawn with our version strategy (never lower
+than the original, so that any version gates in the parsers still pass). Along with
+those, there's a family of random strings that we don't know how to parse. Both the
+families, and the user agents within each family, are drawn with Zipf-like
+frequencies, the most popular ones far more often than the rest.
+
+The same arguments always generate the same corpus.
+"""
+
+import argparse
+import glob
+import os.path
+import random
+import re
+import string
+import timeit
+
+import yaml
+
+from hypothesis import HealthCheck, Phase, given, seed, settings, strategies as st
+
+from linehaul.ua import parser as user_agents
+from linehaul.ua.impl import ParserSet
+from tests.strategies import version as st_version
+
+
+FIXTURES = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "unit", "ua", "fixtures", "*.yml"
+)
+
+# The families that we see the most of, most popular first, the rest follow in
+# alphabetical order.
+POPULARITY = [
+    "pip",
+    "uv",
+    "requests",
+    "browser",
+    "ignored",
+    "setuptools",
+    "poetry",
+    "unknown",
+    "pdm",
+    "bandersnatch",
+    "conda",
+    "twine",
+]
+
+_VERSION_RE = re.compile(r"\d+(?:\.\d+)+")
+
+
+def _template(user_agent):
+    """
+    Returns a strategy for user agents like the given one, with each version number
+    in it replaced with one that has the same number of parts, and the same parts
+    except for the last one, which is at least the original.
+    """
+    parts = _VERSION_RE.split(user_agent)
+    versions = []
+    for original in _VERSION_RE.findall(user_agent):
+        digits = original.count(".") + 1
+        prefix = original.rsplit(".", 1)[0]
+        versions.append(
+            st_version(
+                min_digits=digits,
+                max_digits=digits,
+                min_version=original,
+                max_version=f"{prefix}.99",
+            )
+        )
+
+    def _fill(drawn):
+        return "".join(
+            part + version for part, version in zip(parts, list(drawn) + [""])
+        )
+
+    return st.tuples(*versions).map(_fill)
+
+
+def families(fixtures=FIXTURES):
+    """
+    Returns a strategy for the user agents of each family, by name, the families
+    being our fixture files, plus unknown.
+    """
+    strategies = {}
+    for path in sorted(glob.glob(fixtures)):
+        with open(path) as fp:
+            templates = [fixture["ua"] for fixture in yaml.safe_load(fp)]
+        name = os.path.splitext(os.path.basename(path))[0]
+        strategies[name] = st.one_of([_template(ua) for ua in templates])
+    strategies["unknown"] = st.text(
+        alphabet=string.ascii_letters + string.digits + " ./-_;()", min_size=1
+    ).map(str.strip).filter(bool)
+    return strategies
+
+
+def _draw(strategy, count, seed_):
+    """Draws up to count distinct examples from the strategy, repeatably."""
+    drawn = {}
+
+    @seed(seed_)
+    @settings(
+        max_examples=count,
+        database=None,
+        deadline=None,
+        phases=[Phase.generate],
+        suppress_health_check=list(HealthCheck),
+    )
+    @given(strategy)
+    def collect(value):
+        drawn.setdefault(value, None)
+
+    collect()
+    return list(drawn)
+
+
+def _expected(family):
+    if family == "ignored":
+        return lambda result: result is None
+    if family == "unknown":
+        return lambda result: result is user_agents.UnknownUserAgentError
+    return lambda result: result not in {None, user_agents.UnknownUserAgentError}
+
+
+def _parse_or_error(user_agent):
+    try:
+        return user_agents._parse(user_agent)
+    except user_agents.UnknownUserAgentError:
+        return user_agents.UnknownUserAgentError
+
+
+def _zipf(count, exponent):
+    return [1 / rank**exponent for rank in range(1, count + 1)]
+
+
+def generate(size=100000, distinct=200, exponent=1.1, seed_=0, fixtures=FIXTURES):
+    """
+    Returns a corpus of size user agents, drawn from up to distinct user agents per
+    family. Any drawn user agent that doesn't come out of parsing the way that its
+    family should (say, a version that was drawn too long for a parser's regex) is
+    left out.
+    """
+    strategies = families(fixtures)
+    ranked = sorted(
+        strategies,
+        key=lambda name: (
+            POPULARITY.index(name) if name in POPULARITY else len(POPULARITY),
+            name,
+        ),
+    )
+
+    population, weights = [], []
+    for family, family_weight in zip(ranked, _zipf(len(ranked), exponent)):
+        expected = _expected(family)
+        drawn = [
+            user_agent
+            for user_agent in _draw(strategies[family], distinct, seed_)
+            if expected(_parse_or_error(user_agent))
+        ]
+        population += drawn
+        weights += [family_weight * weight for weight in _zipf(len(drawn), exponent)]
+
+    return random.Random(seed_).choices(population, weights, k=size)
+
+
+def _engines():
+    def uncached(user_agent):
+        return user_agents._parse(user_agent)
+
+    def cached(user_agent, _cache=user_agents.UserAgentCache()):
+        return _cache(user_agent)
+
+    parsers = user_agents._parser
+    sequential = ParserSet(combine_regexes=False)
+    for position, stage in [
+        ("first", parsers._first),
+        (None, parsers._parsers),
+        ("last", parsers._last),
+    ]:
+        for parser in stage:
+            sequential.register(parser, position=position, _randomize=False)
+
+    def sequential_regexes(user_agent):
+        combined, user_agents._parser = user_agents._parser, sequential
+        try:
+            return user_agents._parse(user_agent)
+        finally:
+            user_agents._parser = combined
+
+    return {
+        "uncached": uncached,
+        "cached": cached,
+        "sequential regexes": sequential_regexes,
+    }
+
+
+def run(corpus):
+    engines = _engines()
+    counts = {}
+    for name, fn in engines.items():
+
+        def consume():
+            for user_agent in corpus:
+                try:
+                    fn(user_agent)
+                except user_agents.UnknownUserAgentError:
+                    pass
+
+        elapsed = min(timeit.repeat(consume, number=1, repeat=3))
+        counts[name] = len(corpus) / elapsed
+        print(f"{name:>20}: {counts[name]:12,.0f} UAs/s")
+    return counts
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = args.add_subparsers(dest="command", required=True)
+
+    generating = commands.add_parser("generate")
+    generating.add_argument("output")
+    generating.add_argument("--size", type=int, default=100000)
+    generating.add_argument("--distinct", type=int, default=200)
+    generating.add_argument("--zipf", type=float, default=1.1)
+    generating.add_argument("--seed", type=int, default=0)
+
+    running = commands.add_parser("run")
+    running.add_argument("corpus")
+
+    args = args.parse_args(argv)
+    if args.command == "generate":
+        corpus = generate(args.size, args.distinct, args.zipf, args.seed)
+        with open(args.output, "w") as fp:
+            fp.writelines(f"{user_agent}\n" for user_agent in corpus)
+        print(f"Wrote {len(corpus)} user agents ({len(set(corpus))} distinct)")
+    else:
+        with open(args.corpus) as fp:
+            run(fp.read().splitlines())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the ways we have of turning a log line into an event.
+
+    python -m benchmarks.events [path/to/log.gz ...]
+"""
+
+import gzip
+import math
+import posixpath
+import sys
+import timeit
+
+import attr
+
+from linehaul.events import parser
+from linehaul.ua import parser as user_agents
+
+
+FIXTURES = [
+    "fixtures/downloads-2021-01-07-20-55-2021-01-07T20-55-00.000-B8Hs_G6d6xN61En2ypwk.log.gz",
+    "fixtures/simple-2021-01-07-20-55-2021-01-07T20-55-00.000-3wuB00t9tqgbGLFI2fSI.log.gz",
+]
+REPEAT = 5
+
+
+def legacy_parse(message):
+    """
+    How parse() used to work: the pyparsing grammar, structuring a nested dict with
+    cattrs (and all of the validators), then evolving in the user agent.
+    """
+    parsed = parser._grammar_message(message.decode())
+    if parsed is None:
+        raise parser.UnparseableEvent(message)
+    data = {}
+    data["timestamp"] = parsed.timestamp
+    data["tls_protocol"] = parser._value_or_none(parsed.tls_protocol)
+    data["tls_cipher"] = parser._value_or_none(parsed.tls_cipher)
+    data["country_code"] = parser._value_or_none(parsed.country_code)
+    data["url"] = parsed.url
+    data["file"] = {}
+    data["file"]["filename"] = posixpath.basename(parsed.url)
+    data["file"]["project"] = parser._value_or_none(parsed.project_name)
+    data["file"]["version"] = parser._value_or_none(parsed.version)
+    data["file"]["type"] = parser._value_or_none(parsed.package_type)
+    if parsed.header == "download":
+        data["project"] = parser._value_or_none(parsed.project_name)
+        if data["project"] is not None:
+            # Not something we used to have, but we need it to compare like with like.
+            derived = parser.url_fields(parsed.url, data["project"])
+            data["file"].update(derived._asdict())
+        result = parser._cattr.structure(data, parser.Download)
+    else:
+        data["project"] = parsed.url.split("/")[2]
+        result = parser._cattr.structure(data, parser.Simple)
+
+    try:
+        ua = user_agents._parse(parsed.user_agent)
+        if ua is None:
+            return
+    except user_agents.UnknownUserAgentError:
+        pass
+    else:
+        result = attr.evolve(result, details=ua)
+
+    return result
+
+
+def _strict_parse(message):
+    return parser.parse(message.decode(), strict=True)
+
+
+def _str_parse(message):
+    return parser.parse(message.decode())
+
+
+def _suffix_parse(message, _suffixes=parser.SuffixCache()):
+    return parser.parse(message, suffixes=_suffixes)
+
+
+ENGINES = {
+    "legacy": legacy_parse,
+    "strict": _strict_parse,
+    "str": _str_parse,
+    "bytes": parser.parse,
+    "suffix": _suffix_parse,
+}
+
+
+def _consume(fn, lines):
+    for line in lines:
+        try:
+            fn(line)
+        except Exception:
+            pass
+
+
+def main(paths):
+    lines = []
+    for path in paths:
+        with gzip.open(path, "rb") as fp:
+            lines.extend(fp)
+
+    # Make sure we're comparing like with like before timing anything.
+    for line in lines:
+        results = set()
+        for fn in ENGINES.values():
+            try:
+                results.add(fn(line))
+            except Exception as exc:
+                results.add(type(exc))
+        assert len(results) == 1, (line, results)
+
+    # The engines take turns, rather than each being timed all in one go, so that
+    # whichever one happens to run while the machine is quietest isn't favoured.
+    number = max(1, 20000 // len(lines))
+    best = dict.fromkeys(ENGINES, math.inf)
+    for _ in range(REPEAT):
+        for name, fn in ENGINES.items():
+            elapsed = timeit.timeit(lambda: _consume(fn, lines), number=number)
+            best[name] = min(best[name], elapsed)
+
+    baseline = None
+    for name, elapsed in best.items():
+        per_line = elapsed / (number * len(lines)) * 1e6
+        baseline = baseline or per_line
+        print(f"{name:>8}: {per_line:8.2f} us/line ({baseline / per_line:5.1f}x)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or FIXTURES)
@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how parsing scales with the number of threads doing it, both for user
+agents on their own and for batches of log lines, the way that the ingestor does
+with PARSE_THREADS. Only a free-threaded build of Python can be expected to scale.
+
+    python -m benchmarks.threads [--threads 1 2 4 8] [corpus.txt]
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from linehaul.events.batch import parse_many
+from linehaul.events.parser import SuffixCache
+from linehaul.ua import parser as user_agents
+
+from benchmarks import corpus as _corpus
+
+
+# Everything about a line other than its user agent, which we fill in from the
+# corpus.
+LINE = (
+    "download|Thu, 07 Jan 2021 20:54:54 GMT|US|/packages/f7/12/ec3f2e203afa394a14991"
+    "1729357aa48affc59c20e2c1c8297a60f33f133/threadpoolctl-2.1.0-py3-none-any.whl|"
+    "TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|threadpoolctl|2.1.0|bdist_wheel|{}"
+)
+CHUNK_SIZE = 1000
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _workloads(corpus):
+    def uncached(user_agents_):
+        for user_agent in user_agents_:
+            try:
+                user_agents._parse(user_agent)
+            except user_agents.UnknownUserAgentError:
+                pass
+
+    cache = user_agents.UserAgentCache()
+
+    def cached(user_agents_):
+        for user_agent in user_agents_:
+            try:
+                cache(user_agent)
+            except user_agents.UnknownUserAgentError:
+                pass
+
+    # A SuffixCache can't be shared, so just like the ingestor, each thread gets
+    # its own, which goes away along with the pool that the thread belongs to.
+    state = threading.local()
+
+    def lines(lines_):
+        try:
+            suffixes = state.suffixes
+        except AttributeError:
+            suffixes = state.suffixes = SuffixCache()
+        parse_many(lines_, suffixes=suffixes)
+
+    log = [LINE.format(user_agent).encode() for user_agent in corpus]
+    return {
+        "uncached UAs": (uncached, _chunks(corpus), lambda: None),
+        "cached UAs": (cached, _chunks(corpus), cache.clear),
+        "log lines": (lines, _chunks(log), lambda: None),
+    }
+
+
+def run(corpus, threads=(1, 2, 4, 8)):
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+
+    results = {}
+    for name, (fn, chunks, reset) in _workloads(corpus).items():
+        print(f"{name}:")
+        for count in threads:
+            best = None
+            for _ in range(3):
+                reset()
+                with ThreadPoolExecutor(count) as executor:
+                    start = time.perf_counter()
+                    list(executor.map(fn, chunks))
+                    elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name, count] = len(corpus) / best
+            speedup = results[name, count] / results[name, threads[0]]
+            print(
+                f"{count:>4} threads: {results[name, count]:12,.0f} per second "
+                f"({speedup:.2f}x)"
+            )
+    return results
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    args.add_argument("corpus", nargs="?")
+    args.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = args.parse_args(argv)
+
+    if args.corpus:
+        with open(args.corpus) as fp:
+            corpus = fp.read().splitlines()
+    else:
+        corpus = _corpus.generate(size=20000)
+    run(corpus, args.threads)
+
+
+if __name__ == "__main__":
+    main()
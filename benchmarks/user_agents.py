@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Compares structuring the dicts that the user agent parsers return into UserAgents
+with the generic cattrs converter, and with our generated structure functions, and
+then decoding the JSON payloads of pip and uv user agents with each of the
+available backends.
+
+    python -m benchmarks.user_agents [path/to/log.gz ...]
+
+Without any logs, it uses the user agents from our user agent test fixtures.
+"""
+
+import glob
+import gzip
+import sys
+import timeit
+
+import cattr
+import yaml
+
+from linehaul.events import parser
+from linehaul.ua import parser as user_agents
+from linehaul.ua import payloads
+from linehaul.ua.datastructures import UserAgent
+from linehaul.ua.structuring import structure_user_agent
+
+
+FIXTURES = "tests/unit/ua/fixtures/*.yml"
+
+
+def _user_agents(paths):
+    if not paths:
+        for path in glob.glob(FIXTURES):
+            with open(path) as fp:
+                yield from (fixture["ua"] for fixture in yaml.safe_load(fp))
+        return
+
+    for path in paths:
+        with gzip.open(path, "rb") as fp:
+            for line in fp:
+                message = parser._grammar_message(line.decode())
+                if message is not None:
+                    yield message.user_agent
+
+
+def _parsed(uas):
+    parsed = []
+    for user_agent in uas:
+        try:
+            data = user_agents._parser(user_agent)
+        except user_agents.UnableToParse:
+            continue
+        if data is not None:
+            parsed.append(data)
+    return parsed
+
+
+def _compare(engines, inputs):
+    results = [[fn(item) for item in inputs] for fn in engines.values()]
+    assert all(result == results[0] for result in results), "engines disagree"
+
+    baseline = None
+    for name, fn in engines.items():
+        number = max(1, 20000 // len(inputs))
+        elapsed = min(
+            timeit.repeat(lambda: [fn(item) for item in inputs], number=number)
+        )
+        per_ua = elapsed / (number * len(inputs)) * 1e6
+        baseline = baseline or per_ua
+        print(f"{name:>8}: {per_ua:8.2f} us/ua ({baseline / per_ua:5.1f}x)")
+
+
+def main(paths):
+    uas = list(_user_agents(paths))
+    # We're after the dicts that the parsers structure, not UserAgents.
+    payloads.decoder.backend = "stdlib"
+
+    print("Structuring:")
+    _compare(
+        {
+            "cattrs": lambda data: cattr.structure(data, UserAgent),
+            "compiled": structure_user_agent,
+        },
+        _parsed(uas),
+    )
+
+    print("Decoding pip and uv JSON:")
+    _compare(
+        {
+            name: lambda payload, decode=decode: structure_user_agent(decode(payload))
+            for name, decode in payloads.BACKENDS.items()
+        },
+        [
+            ua.split(maxsplit=1)[1]
+            for ua in uas
+            if ua.startswith(("pip/", "uv/")) and " {" in ua
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Compares checking installer versions against a specifier the way the user agent
+parsers used to, building a SpecifierSet on every call, with a VersionGate.
+
+    python -m benchmarks.versions
+"""
+
+import timeit
+
+import packaging.version
+
+from packaging.specifiers import SpecifierSet
+
+from linehaul.ua.versions import VersionGate
+
+
+# Roughly what our traffic looks like, a few versions over and over again.
+VERSIONS = ["24.0", "23.2.1", "20.0.2", "9.0.1", "0.4.18", "1.5.6", "6.0b1"] * 100
+
+
+def legacy_check(version):
+    return packaging.version.parse(version) in SpecifierSet(">=6", prereleases=True)
+
+
+def main():
+    gate = VersionGate(">=6")
+    engines = {"legacy": legacy_check, "gate": gate.__contains__}
+
+    for version in VERSIONS:
+        assert legacy_check(version) == (version in gate), version
+
+    baseline = None
+    for name, fn in engines.items():
+        elapsed = min(
+            timeit.repeat(lambda: [fn(v) for v in VERSIONS], number=20, repeat=5)
+        )
+        per_check = elapsed / (20 * len(VERSIONS)) * 1e6
+        baseline = baseline or per_check
+        print(f"{name:>8}: {per_check:8.3f} us/check ({baseline / per_check:6.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+def hit_rate(hits, misses):
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+class LRUCache:
+    """
+    A least recently used cache, bounded by how many entries it holds, and
+    optionally by their total cost as well, as worked out by cost(key, value), for
+    entries that can be arbitrarily large.
+
+    Anything that's just a pure function of its arguments is better off memoized
+    with functools.lru_cache, which does the same thing in C. This is for the caches
+    that need to decide for themselves what they store.
+
+    An LRUCache can be shared between threads, but working out a value that's
+    missing is up to the caller, so two threads that miss on the same key at once
+    will both do that work.
+    """
+
+    def __init__(self, maxsize, *, maxcost=None, cost=None):
+        self.maxsize = maxsize
+        self.maxcost = maxcost
+        self._cost = cost
+        self._entries = OrderedDict()
+        self.total_cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries))
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        cost = 0 if self._cost is None else self._cost(key, value)
+        with self._lock:
+            # Another thread may well have beaten us to it.
+            if key in self._entries:
+                return
+            if self.maxcost is not None and cost > self.maxcost:
+                return
+            while self._entries and (
+                len(self._entries) >= self.maxsize
+                or (self.maxcost is not None and self.total_cost + cost > self.maxcost)
+            ):
+                evicted = self._entries.popitem(last=False)
+                if self._cost is not None:
+                    self.total_cost -= self._cost(*evicted)
+                self.evictions += 1
+            self._entries[key] = value
+            self.total_cost += cost
+
+    @property
+    def hit_rate(self):
+        return hit_rate(self.hits, self.misses)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_cost = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
@@ -0,0 +1,45 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import attr
+
+
+def slot_constructor(cls, name, params, fields, *, globs, prelude=()):
+    """
+    Compiles a function called name, taking the given params, that builds an
+    instance of the given slotted attrs class with object.__new__, and assigns each
+    of its slots directly through the slot itself, skipping the frozen __setattr__
+    and the attribute validators. The function is returned, and is also left in
+    globs, so that functions compiled against the same globs can call each other.
+
+    Each of the fields is a (field name, lines, value) tuple, where lines are any
+    statements that work the value out, which run before it's assigned, and value
+    is the expression that's assigned. The prelude runs before the instance is
+    created. All of the lines are indented to the function body already.
+
+    Anything else that the lines refer to must already be in globs.
+    """
+    slots = {field.name: getattr(cls, field.name) for field in attr.fields(cls)}
+    globs["_new"] = object.__new__
+    globs[f"_{cls.__name__}"] = cls
+
+    lines = [f"def {name}({', '.join(params)}):", *prelude]
+    lines.append(f"    self = _new(_{cls.__name__})")
+    for field_name, field_lines, value in fields:
+        setter = f"_set_{cls.__name__}_{field_name}"
+        globs[setter] = slots[field_name].__set__
+        lines += field_lines
+        lines.append(f"    {setter}(self, {value})")
+    lines.append("    return self")
+
+    exec(compile("\n".join(lines), f"<{name}>", "exec"), globs)
+    return globs[name]
@@ -0,0 +1,207 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from array import array
+from collections import Counter
+
+from linehaul.cache import LRUCache
+from linehaul.events.parser import _TRUSTED_CONSTRUCTORS, _decompose, _try_parse
+
+
+class EventBatch:
+    """
+    A batch of parsed events, stored as columns rather than as an event object per
+    line. Each row is just a pair of codes, one into the distinct timestamps of the
+    batch, and one into the distinct rows that the SuffixCache gave us, which holds
+    the rest of the fields (the country, TLS, project, version, package type and
+    user agent, etc).
+
+    Lines that didn't give us an event are kept as is, and we count up why.
+    """
+
+    def __init__(self):
+        self.timestamps = array("I")
+        self.rows = array("I")
+        self.timestamp_values = []
+        self.row_values = []
+        self._timestamp_codes = {}
+        # The user agent in a row isn't hashable (its subcommand is a list), but a
+        # SuffixCache hands us the very same fields tuple for every line that shares
+        # a row, and we hold onto every one of them, so their ids are stable.
+        self._row_codes = {}
+        self.reasons = Counter()
+        self.unprocessed = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, line, *, suffixes=None):
+        if suffixes is not None:
+            cls, timestamp, fields, reason = suffixes.fields(line)
+        else:
+            cls, timestamp, fields, reason = _decompose(*_try_parse(line))
+        if reason is not None:
+            self.reasons[reason] += 1
+        if cls is None:
+            self.unprocessed.append(line)
+            return
+
+        code = self._timestamp_codes.get(timestamp)
+        if code is None:
+            code = self._timestamp_codes[timestamp] = len(self.timestamp_values)
+            self.timestamp_values.append(timestamp)
+        self.timestamps.append(code)
+
+        code = self._row_codes.get(id(fields))
+        if code is None:
+            code = self._row_codes[id(fields)] = len(self.row_values)
+            self.row_values.append((cls, fields))
+        self.rows.append(code)
+
+    @property
+    def min_timestamp(self):
+        return min(self.timestamp_values, default=None)
+
+    def count(self, cls):
+        kinds = [row_cls is cls for row_cls, _ in self.row_values]
+        return sum(kinds[code] for code in self.rows)
+
+    def column(self, name):
+        """
+        The values of a single field for every row, a dotted name like file.version
+        or details.installer.name reaches into the nested records, with None for
+        any row that doesn't have it.
+        """
+        if name == "timestamp":
+            return [self.timestamp_values[code] for code in self.timestamps]
+
+        first, *rest = name.split(".")
+        values = []
+        for cls, fields in self.row_values:
+            names = _TRUSTED_CONSTRUCTORS[cls][1]
+            value = fields[names.index(first)] if first in names else None
+            for part in rest:
+                value = getattr(value, part, None)
+            values.append(value)
+        return [values[code] for code in self.rows]
+
+    def events(self):
+        for timestamp, row in zip(self.timestamps, self.rows):
+            cls, fields = self.row_values[row]
+            new = _TRUSTED_CONSTRUCTORS[cls][0]
+            yield new(self.timestamp_values[timestamp], *fields)
+
+    def write_ndjson(self, fp, cls, unstructure, *, details=None):
+        """
+        Writes every event of the given class to fp as newline delimited JSON, the
+        same as json.dumps(unstructure(event)) would, but only serializing each of
+        our distinct timestamps and rows once. Returns how many events it wrote.
+
+        Given a DetailsCache, the user agent details of each row are serialized by
+        it, so that rows that only share their user agent share that too.
+        """
+        # The timestamp is always the first field of an event, so each line is just a
+        # serialized timestamp followed by the serialized rest of the row.
+        prefixes = [
+            json.dumps({"timestamp": unstructure(timestamp)})[:-1].encode()
+            for timestamp in self.timestamp_values
+        ]
+        new, names = _TRUSTED_CONSTRUCTORS[cls]
+        tails = []
+        for row_cls, fields in self.row_values:
+            if row_cls is not cls:
+                tails.append(None)
+                continue
+            # Any timestamp will do here, we're only after everything that follows it.
+            if details is None or names[-1] != "details":
+                data = unstructure(new(self.timestamp_values[0], *fields))
+                del data["timestamp"]
+                tails.append(b", " + json.dumps(data)[1:].encode() + b"\n")
+                continue
+
+            # The details are always last, so we serialize everything else with null
+            # details, and then swap the serialized details in for that null.
+            data = unstructure(new(self.timestamp_values[0], *fields[:-1], None))
+            del data["timestamp"]
+            serialized = json.dumps(data)[1:-len("null}")]
+            fragment = details(fields[-1], unstructure)
+            tails.append(b", " + (serialized + fragment).encode() + b"}\n")
+
+        chunks = []
+        for timestamp, row in zip(self.timestamps, self.rows):
+            tail = tails[row]
+            if tail is not None:
+                chunks.append(prefixes[timestamp])
+                chunks.append(tail)
+        fp.write(b"".join(chunks))
+        return len(chunks) // 2
+
+    def write_unprocessed(self, fp):
+        for line in self.unprocessed:
+            fp.write(line if line.endswith(b"\n") else line + b"\n")
+        return len(self.unprocessed)
+
+
+class DetailsCache:
+    """
+    A least recently used cache of the serialized JSON for the user agent details
+    of events. The UserAgentCache gives every line with the same user agent the very
+    same UserAgent, so we key on its identity, holding onto it so that its id can't
+    be reused by anything else while it's in here.
+
+    Every call is expected to pass the same unstructure function.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = LRUCache(maxsize)
+
+    def __call__(self, details, unstructure):
+        if details is None:
+            return "null"
+
+        cached = self._entries.get(id(details))
+        if cached is None:
+            fragment = json.dumps(unstructure(details))
+            self._entries.put(id(details), (details, fragment))
+        else:
+            _, fragment = cached
+        return fragment
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    @property
+    def hit_rate(self):
+        return self._entries.hit_rate
+
+    def clear(self):
+        self._entries.clear()
+
+
+def parse_many(lines, *, suffixes=None):
+    """
+    Parses the raw bytes of many log lines into a single EventBatch. Rows are only
+    shared between lines when they come from the given SuffixCache, without one
+    every event gets a row of its own.
+    """
+    batch = EventBatch()
+    for line in lines:
+        batch.append(line, suffixes=suffixes)
+    return batch
@@ -11,20 +11,30 @@
 # limitations under the License.
 
 import enum
+import functools
 import logging
 import posixpath
+import re
 
-from datetime import datetime, timezone
-from typing import Optional
+from datetime import datetime
+from typing import Any, Callable, NamedTuple, Optional
 
 import attr
 import attr.validators
 import cattr
 
+from packaging.utils import (
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_wheel_filename,
+)
 from pyparsing import Literal as L, Word, Optional as OptionalItem
 from pyparsing import printables as _printables, rest_of_line
 from pyparsing import ParseException
 
+from linehaul.cache import LRUCache, hit_rate
+from linehaul.codegen import slot_constructor
+from linehaul.events import timestamps
 from linehaul.ua import UserAgent, parser as user_agents
 
 
@@ -39,12 +49,7 @@ logger = logging.getLogger(__name__)
 # exception type is never surfaced to a human, so the richer aggregated error is
 # pure overhead here, and the parser tests assert the bare TypeError/ValueError.
 _cattr = cattr.Converter(detailed_validation=False)
-_cattr.register_structure_hook(
-    datetime,
-    lambda d, t: datetime.strptime(d[5:-4], "%d %b %Y %H:%M:%S").replace(
-        tzinfo=timezone.utc
-    ),
-)
+_cattr.register_structure_hook(datetime, lambda d, t: timestamps.codec.parse(d))
 
 
 class UnparseableEvent(Exception):
@@ -144,6 +149,22 @@ class File:
     project = attr.ib(validator=attr.validators.instance_of(str))
     version = attr.ib(validator=attr.validators.instance_of(str))
     type = attr.ib(type=PackageType)
+    normalized_project = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    python_tag = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    abi_tag = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    platform_tag = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
 
 
 @attr.s(slots=True, frozen=True)
@@ -187,50 +208,663 @@ class Simple:
     details = attr.ib(type=Optional[UserAgent], default=None)
 
 
-def _value_or_none(value):
-    if value is NullValue or value == "":
-        return None
+def _trusted_constructor(cls):
+    """
+    Generates a function that builds an instance of the given (slotted) attrs class
+    with the same arguments as its __init__, but that assigns the slots directly
+    instead of going through the frozen __setattr__ and the attribute validators.
+    """
+    fields = attr.fields(cls)
+    globs, params = {}, []
+    for field in fields:
+        if field.default is attr.NOTHING:
+            params.append(field.name)
+        else:
+            globs[f"_default_{field.name}"] = field.default
+            params.append(f"{field.name}=_default_{field.name}")
+
+    return slot_constructor(
+        cls,
+        f"_new_{cls.__name__.lower()}",
+        params,
+        [(field.name, [], field.name) for field in fields],
+        globs=globs,
+    )
+
+
+_new_file = _trusted_constructor(File)
+_new_download = _trusted_constructor(Download)
+_new_simple = _trusted_constructor(Simple)
+
+# The trusted constructor for each kind of event, along with the names of all of
+# its fields after the timestamp, in the order that the constructor takes them.
+_TRUSTED_CONSTRUCTORS = {
+    cls: (new, tuple(field.name for field in attr.fields(cls)[1:]))
+    for cls, new in [(Download, _new_download), (Simple, _new_simple)]
+}
+
+
+class _Message(NamedTuple):
+    header: str
+    timestamp: str
+    country_code: str
+    url: str
+    tls_protocol: str | _NullValue
+    tls_cipher: str | _NullValue
+    project_name: str | _NullValue
+    version: str | _NullValue
+    package_type: str | _NullValue
+    user_agent: str
+
+
+class _Tokens(NamedTuple):
+    download: str | bytes
+    simple: str | bytes
+    pipe: str | bytes
+    space: str | bytes
+    field_space: str | bytes
+    tab: str | bytes
+    newline: str | bytes
+    null: str | bytes
+    whitespace: str | bytes
+    package_types: frozenset
+    printable: Callable[[Any], bool]
+
+
+# Whether Word(printables) would match everything in a field, any line with
+# something else before the user agent is left to the grammar. That's printable
+# ASCII other than "@". Tabs are technically printables, but parse_string() expands
+# them to spaces before parsing.
+def _printable_str(value):
+    return value.isascii() and value.isprintable() and "@" not in value
+
+
+_PRINTABLE_BYTES = bytes(range(0x20, 0x7F)).replace(b"@", b"")
+
+
+def _printable_bytes(value):
+    # Deleting everything printable is done in one pass in C, and leaves nothing
+    # behind unless there was something else.
+    return not value.translate(None, _PRINTABLE_BYTES)
+
+
+# The whitespace pyparsing skips over before each token, and at the end of the line
+# when parsing with parse_all=True.
+_WHITESPACE = " \t\n\r"
+
+_STR_TOKENS = _Tokens(
+    download="download|",
+    simple="simple|",
+    pipe="|",
+    space=" ",
+    field_space="| ",
+    tab="\t",
+    newline="\n",
+    null="(null)",
+    whitespace=_WHITESPACE,
+    package_types=frozenset(t.value for t in PackageType),
+    printable=_printable_str,
+)
+
+_BYTES_TOKENS = _Tokens(
+    download=b"download|",
+    simple=b"simple|",
+    pipe=b"|",
+    space=b" ",
+    field_space=b"| ",
+    tab=b"\t",
+    newline=b"\n",
+    null=b"(null)",
+    whitespace=_WHITESPACE.encode(),
+    package_types=frozenset(t.value.encode() for t in PackageType),
+    printable=_printable_bytes,
+)
+
+
+class _FastPathRejected(Exception):
+    pass
+
+
+def _null_or_word(value, null):
+    if value == null:
+        return NullValue
+    # The grammar matches NULL before trying Word, so something like "(null)foo" is
+    # a parse error, not a word. We don't try to replicate that, we just bail out.
+    if not value or value.startswith(null):
+        raise _FastPathRejected
+    return value
+
+
+def _split_message(message):
+    """
+    A hand written equivalent to MESSAGE.parse_string() that only understands well
+    formed lines, returning None for anything that it isn't completely sure the
+    grammar would parse in exactly the same way.
+
+    This works on both str and bytes, when given bytes the fields that it returns
+    are left as bytes as well, except for the header.
+    """
+    tokens = _STR_TOKENS if isinstance(message, str) else _BYTES_TOKENS
+
+    if message.startswith(tokens.download):
+        header = "download"
+        parts = message.split(tokens.pipe, 9)
+        if len(parts) != 10:
+            return None
+    elif message.startswith(tokens.simple):
+        header = "simple"
+        parts = message.split(tokens.pipe, 9)
+        # Simple events never have project details, just empty fields.
+        if len(parts) != 10 or parts[6] or parts[7] or parts[8]:
+            return None
     else:
+        return None
+
+    # Note: We use find() rather than in throughout, since in is a lot slower for
+    #       bytes than for str.
+    user_agent = parts[9]
+    if user_agent.find(tokens.tab) >= 0:
+        return None
+
+    # rest_of_line stops at a newline, and then parse_all only allows trailing
+    # whitespace after it.
+    end = user_agent.find(tokens.newline)
+    if end >= 0:
+        if user_agent[end + 1 :].strip(tokens.whitespace):
+            return None
+        user_agent = user_agent[:end]
+
+    # Every field before the user agent has to be made up of printables, and must not
+    # start with whitespace, since the grammar would have silently skipped it.
+    head = message[: len(message) - len(parts[9]) - 1]
+    if not tokens.printable(head) or head.find(tokens.field_space) >= 0:
+        return None
+
+    timestamp, country_code, url = parts[1], parts[2], parts[3]
+    if not timestamp or not url:
+        return None
+
+    try:
+        tls_protocol = _null_or_word(parts[4], tokens.null)
+        tls_cipher = _null_or_word(parts[5], tokens.null)
+        if header == "download":
+            project_name = _null_or_word(parts[6], tokens.null)
+            version = _null_or_word(parts[7], tokens.null)
+            package_type = parts[8]
+            if package_type == tokens.null:
+                package_type = NullValue
+            elif package_type not in tokens.package_types:
+                return None
+        else:
+            project_name = version = package_type = parts[6]
+    except _FastPathRejected:
+        return None
+
+    return _Message(
+        header,
+        timestamp,
+        country_code,
+        url,
+        tls_protocol,
+        tls_cipher,
+        project_name,
+        version,
+        package_type,
+        user_agent,
+    )
+
+
+class InternTable:
+    """
+    Maps the raw value of a field (either str or the bytes straight out of the log
+    line) onto a single shared str, so that every event that has the same value for
+    a field shares the same object, and so that we only decode a value the first
+    time we see it. Values are memoized with functools.lru_cache, which hands back
+    whichever equal str it saw first.
+
+    Any of the given nulls map to None, which lets us skip _value_or_none() as well.
+    """
+
+    def __init__(self, maxsize=16384, *, nulls=()):
+        self.maxsize = maxsize
+        self._nulls = frozenset(nulls)
+        self._lookup = functools.lru_cache(maxsize=maxsize)(self._intern)
+        self.clear()
+
+    def _intern(self, value):
+        # Only ever called for a value that isn't in our cache.
+        self.misses += 1
+        if value in self._nulls:
+            return None
+        if isinstance(value, bytes):
+            # Anything that reaches us as bytes has been checked to be printable
+            # ASCII, and we share the str with anyone who looks it up as a str. That
+            # isn't a lookup of its own as far as our stats are concerned.
+            misses = self.misses
+            interned = self._lookup(value.decode("ascii"))
+            self.misses = misses
+            return interned
         return value
 
+    def __call__(self, value):
+        self.lookups += 1
+        return self._lookup(value)
+
+    @property
+    def dedup_ratio(self):
+        return 1 - (self.misses / self.lookups) if self.lookups else 0.0
+
+    def clear(self):
+        self._lookup.cache_clear()
+        self.misses = 0
+        # Looking up the nulls doesn't count either.
+        for null in self._nulls:
+            self._lookup(null)
+        self.lookups = 0
+        self.misses = 0
+
+
+class StringInterner:
+    """
+    A set of InternTables, one for each of the fields of an event that tend to have
+    the same value over and over again, along with which values of that field the
+    grammar treats as missing.
+    """
+
+    FIELDS = {
+        "country_code": ("", b""),
+        "tls_protocol": (NullValue,),
+        "tls_cipher": (NullValue,),
+        "url": (),
+        "filename": (),
+        "project": (NullValue,),
+        "version": (NullValue,),
+    }
+
+    def __init__(self, maxsize=16384):
+        for field, nulls in self.FIELDS.items():
+            setattr(self, field, InternTable(maxsize=maxsize, nulls=nulls))
+
+    def stats(self):
+        return {
+            field: {
+                "lookups": getattr(self, field).lookups,
+                "unique": getattr(self, field).misses,
+                "dedup_ratio": getattr(self, field).dedup_ratio,
+            }
+            for field in self.FIELDS
+        }
+
+    def clear(self):
+        for field in self.FIELDS:
+            getattr(self, field).clear()
+
+
+strings = StringInterner()
+
+
+class UrlFields(NamedTuple):
+    filename: str
+    normalized_project: str | None = None
+    python_tag: str | None = None
+    abi_tag: str | None = None
+    platform_tag: str | None = None
+
+
+def url_fields(url, project):
+    """
+    Works out everything about a download that we derive from its URL, the name of
+    the file, and for wheels, the (possibly compressed) tags in that name.
+    """
+    filename = strings.filename(posixpath.basename(url))
+    normalized_project = canonicalize_name(project)
+    if not filename.endswith(".whl"):
+        return UrlFields(filename, normalized_project)
+
+    try:
+        parse_wheel_filename(filename)
+    except InvalidWheelFilename:
+        return UrlFields(filename, normalized_project)
+    python_tag, abi_tag, platform_tag = filename[:-4].rsplit("-", 3)[1:]
+    return UrlFields(filename, normalized_project, python_tag, abi_tag, platform_tag)
+
+
+def _simple_project(url):
+    url_parts = url.split("/", 3)
+    return strings.project(url_parts[2]) if len(url_parts) >= 3 else None
+
+
+class UrlCache:
+    """
+    Memoizes the fields that we derive from the URL of an event, which are the same
+    every time that we see that URL, and a popular file gets downloaded over and
+    over again within a single log file.
+    """
+
+    def __init__(self, maxsize=16384):
+        self.maxsize = maxsize
+        # The normalized project name comes from the project, not the URL, and
+        # nothing stops a line from pairing a URL with some other project, so
+        # downloads are keyed on both.
+        self.download = functools.lru_cache(maxsize=maxsize)(url_fields)
+        self._simple = functools.lru_cache(maxsize=maxsize)(_simple_project)
+
+    def simple(self, url):
+        """
+        The project that a simple request is for, or None if the URL doesn't have
+        one in it.
+        """
+        return self._simple(url)
+
+    def _infos(self):
+        return self.download.cache_info(), self._simple.cache_info()
+
+    @property
+    def lookups(self):
+        return sum(info.hits + info.misses for info in self._infos())
+
+    @property
+    def misses(self):
+        return sum(info.misses for info in self._infos())
+
+    @property
+    def hit_rate(self):
+        return hit_rate(self.lookups - self.misses, self.misses)
+
+    def clear(self):
+        self.download.cache_clear()
+        self._simple.cache_clear()
 
-def parse(message):
+
+urls = UrlCache()
+
+
+_PACKAGE_TYPES_BY_VALUE = {t.value: t for t in PackageType} | {
+    t.value.encode(): t for t in PackageType
+}
+
+
+def _grammar_message(message):
     try:
         parsed = MESSAGE.parse_string(message, parse_all=True)
-    except ParseException as exc:
-        raise UnparseableEvent("{!r} {}".format(message, exc)) from None
-
-    data = {}
-    data["timestamp"] = parsed.timestamp
-    data["tls_protocol"] = _value_or_none(parsed.tls_protocol)
-    data["tls_cipher"] = _value_or_none(parsed.tls_cipher)
-    data["country_code"] = _value_or_none(parsed.country_code)
-    data["url"] = parsed.url
-    data["file"] = {}
-    data["file"]["filename"] = posixpath.basename(parsed.url)
-    data["file"]["project"] = _value_or_none(parsed.project_name)
-    data["file"]["version"] = _value_or_none(parsed.version)
-    data["file"]["type"] = _value_or_none(parsed.package_type)
-
-    if parsed[0] == "download":
-        data["project"] = _value_or_none(parsed.project_name)
-        result = _cattr.structure(data, Download)
-    elif parsed[0] == "simple":
-        data["project"] = parsed.url.split("/")[2]
-        result = _cattr.structure(data, Simple)
+    except ParseException:
+        return None
+
+    return _Message(
+        parsed[0],
+        parsed.timestamp,
+        parsed.country_code,
+        parsed.url,
+        parsed.tls_protocol,
+        parsed.tls_cipher,
+        parsed.project_name,
+        parsed.version,
+        parsed.package_type,
+        parsed.user_agent,
+    )
+
+
+def _value_or_none(value):
+    if value is NullValue or value == "":
+        return None
     else:
-        # MESSAGE can only match a "download" or "simple" header today, but guard
-        # against a future grammar being added without a matching branch here --
-        # fail cleanly instead of an UnboundLocalError on `result` below.
-        raise UnparseableEvent("{!r} unexpected event header {!r}".format(message, parsed[0]))
+        return value
+
+
+@enum.unique
+class Reason(enum.Enum):
+    # The line didn't match our grammar at all.
+    grammar_mismatch = "grammar_mismatch"
+    # The line wasn't valid UTF-8.
+    decode_error = "decode_error"
+    # The timestamp couldn't be parsed.
+    bad_timestamp = "bad_timestamp"
+    # A download was missing its project name or version.
+    missing_project = "missing_project"
+    # A download was missing its package type.
+    bad_package_type = "bad_package_type"
+    # A simple request for a URL that doesn't have a project in it.
+    bad_url = "bad_url"
+    # The user agent is one that we explicitly ignore.
+    ignored_user_agent = "ignored_user_agent"
+    # The user agent is one that we don't know, the event is still returned.
+    unknown_user_agent = "unknown_user_agent"
+
+
+# The exceptions that parse() has always raised for each of our reasons.
+_REASON_EXCEPTIONS = {
+    Reason.grammar_mismatch: UnparseableEvent,
+    Reason.decode_error: UnparseableEvent,
+    Reason.bad_timestamp: ValueError,
+    Reason.missing_project: TypeError,
+    Reason.bad_package_type: ValueError,
+    Reason.bad_url: IndexError,
+}
+
+
+def try_parse(message, *, strict=False, suffixes=None):
+    """
+    Parses a log line without raising for lines that we can't (or won't) turn into
+    an event, returning an (event, reason) tuple instead. The event is None when the
+    line should not be logged, and the reason says why. An event can come back with
+    a reason as well, when the user agent was one that we didn't recognize.
+
+    In strict mode the attrs validators still raise, since they should only ever
+    fail because of a bug in the parser itself.
+
+    Passing a SuffixCache lets lines that only differ by their timestamp skip almost
+    all of the work, it's ignored in strict mode.
+    """
+    # We can be handed the raw bytes of a line straight out of the log file, in which
+    # case we do all of our splitting on those bytes, and only decode what we need.
+    if isinstance(message, (bytearray, memoryview)):
+        message = bytes(message)
+
+    if suffixes is not None and not strict:
+        return suffixes.parse(message)
+    return _try_parse(message, strict=strict)
+
+
+def _try_parse(message, *, strict=False):
+    # Most lines are well formed, so we try our hand written splitter first, and only
+    # fall back to the (much slower) pyparsing grammar when it gives up on a line.
+    parsed = _split_message(message)
+    if parsed is None:
+        if isinstance(message, bytes):
+            try:
+                message = message.decode("utf8")
+            except UnicodeDecodeError:
+                return None, Reason.decode_error
+        parsed = _grammar_message(message)
+        if parsed is None:
+            return None, Reason.grammar_mismatch
+
+    return _build_event(parsed, strict=strict)
+
+
+def parse(message, *, strict=False, suffixes=None):
+    result, reason = try_parse(message, strict=strict, suffixes=suffixes)
+    if result is None and reason is not Reason.ignored_user_agent:
+        raise _REASON_EXCEPTIONS[reason]("{!r} {}".format(message, reason.value))
+    return result
+
+
+def _decompose(result, reason):
+    if result is None:
+        return None, None, None, reason
+    cls = type(result)
+    names = _TRUSTED_CONSTRUCTORS[cls][1]
+    return cls, result.timestamp, tuple(getattr(result, name) for name in names), reason
 
+
+class SuffixCache:
+    """
+    Memoizes everything about a log line except for its timestamp. CI fleets and
+    mirrors send us long runs of lines that are identical apart from when they were
+    made, so we key on the header plus everything after the timestamp, and keep the
+    fields of the event that we built from it, so that a repeat only has to parse
+    its timestamp and put a new event together.
+    """
+
+    # Reasons that we settle on before ever looking at the timestamp, anything else
+    # could come out differently for a different timestamp, so isn't cached.
+    CACHED_REASONS = frozenset(
+        {Reason.grammar_mismatch, Reason.decode_error, Reason.ignored_user_agent}
+    )
+
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        self._entries = LRUCache(maxsize)
+
+    def parse(self, message):
+        cls, timestamp, fields, reason = self.fields(message)
+        if cls is None:
+            return None, reason
+        return _TRUSTED_CONSTRUCTORS[cls][0](timestamp, *fields), reason
+
+    def fields(self, message):
+        """
+        Like parse(), but instead of an event, returns an (event class, timestamp,
+        fields, reason) tuple, where the fields are everything after the timestamp,
+        in order, and are the very same tuple for every line that shares a suffix.
+        The event class is None when there's no event.
+        """
+        tokens = _STR_TOKENS if isinstance(message, str) else _BYTES_TOKENS
+        parts = message.split(tokens.pipe, 2)
+        if len(parts) != 3:
+            return _decompose(*_try_parse(message))
+
+        # A timestamp that the fast path would refuse could change how the grammar
+        # reads the rest of the line, so those lines don't get cached at all.
+        header, timestamp, rest = parts
+        if (
+            not timestamp
+            or timestamp[:1] == tokens.space
+            or not tokens.printable(timestamp)
+        ):
+            return _decompose(*_try_parse(message))
+
+        key = (header, rest)
+        cached = self._entries.get(key)
+        if cached is not None:
+            cls, fields, reason = cached
+            if cls is None:
+                return None, None, None, reason
+            try:
+                return cls, timestamps.codec.parse(timestamp), fields, reason
+            except ValueError:
+                return None, None, None, Reason.bad_timestamp
+
+        decomposed = _decompose(*_try_parse(message))
+        cls, _, fields, reason = decomposed
+        if cls is None and reason not in self.CACHED_REASONS:
+            return decomposed
+
+        self._entries.put(key, (cls, fields, reason))
+        return decomposed
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    @property
+    def hit_rate(self):
+        return self._entries.hit_rate
+
+    def stats(self):
+        return self._entries.stats()
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _build_event(parsed, *, strict=False):
+    user_agent = parsed.user_agent
+    if isinstance(user_agent, bytes):
+        try:
+            user_agent = user_agent.decode("utf8")
+        except UnicodeDecodeError:
+            return None, Reason.decode_error
+
+    # Figure out whether we're going to keep this event at all before we spend any
+    # time building it.
     try:
-        ua = user_agents.parse(parsed.user_agent)
-        if ua is None:
-            return  # Ignored user agents mean we'll skip trying to log this event
+        ua = user_agents.parse(user_agent)
     except user_agents.UnknownUserAgentError:
-        pass
+        ua, reason = None, Reason.unknown_user_agent
     else:
-        result = attr.evolve(result, details=ua)
+        if ua is None:
+            # Ignored user agents mean we'll skip trying to log this event
+            return None, Reason.ignored_user_agent
+        reason = None
+
+    # Everything we pass into our records below has already been checked by either
+    # the grammar or by the checks here, so the attrs validators are only worth
+    # running when we're looking for bugs in the parser itself.
+    if strict:
+        new_file, new_download, new_simple = File, Download, Simple
+    else:
+        new_file, new_download, new_simple = _new_file, _new_download, _new_simple
+
+    # Our intern tables take care of decoding any fields that are still bytes, as
+    # well as turning NULL and empty fields into None.
+    url = strings.url(parsed.url)
+    if parsed.header == "download":
+        try:
+            timestamp = timestamps.codec.parse(parsed.timestamp)
+        except ValueError:
+            return None, Reason.bad_timestamp
+        package_type = _PACKAGE_TYPES_BY_VALUE.get(parsed.package_type)
+        if package_type is None:
+            return None, Reason.bad_package_type
+        project = strings.project(parsed.project_name)
+        version = strings.version(parsed.version)
+        if project is None or version is None:
+            return None, Reason.missing_project
+
+        derived = urls.download(url, project)
+        result = new_download(
+            timestamp,
+            url,
+            project,
+            new_file(
+                derived.filename,
+                project,
+                version,
+                package_type,
+                *derived[1:],
+            ),
+            strings.tls_protocol(parsed.tls_protocol),
+            strings.tls_cipher(parsed.tls_cipher),
+            strings.country_code(parsed.country_code),
+            ua,
+        )
+    elif parsed.header == "simple":
+        project = urls.simple(url)
+        if project is None:
+            return None, Reason.bad_url
+        try:
+            timestamp = timestamps.codec.parse(parsed.timestamp)
+        except ValueError:
+            return None, Reason.bad_timestamp
+
+        result = new_simple(
+            timestamp,
+            url,
+            project,
+            strings.tls_protocol(parsed.tls_protocol),
+            strings.tls_cipher(parsed.tls_cipher),
+            strings.country_code(parsed.country_code),
+            ua,
+        )
+    else:
+        # MESSAGE can only match a "download" or "simple" header today, but guard
+        # against a future grammar being added without a matching branch here --
+        # fail cleanly instead of silently returning None.
+        return None, Reason.grammar_mismatch
 
-    return result
+    return result, reason
@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import re
+
+from datetime import datetime, timezone
+
+from linehaul.cache import hit_rate
+
+
+_MONTHS = {
+    "Jan": 1,
+    "Feb": 2,
+    "Mar": 3,
+    "Apr": 4,
+    "May": 5,
+    "Jun": 6,
+    "Jul": 7,
+    "Aug": 8,
+    "Sep": 9,
+    "Oct": 10,
+    "Nov": 11,
+    "Dec": 12,
+}
+
+# Matches the "20 Jul 2018 02:19:19" part of a "Fri, 20 Jul 2018 02:19:19 GMT"
+# timestamp, which is the only layout Fastly ever actually gives us.
+_rfc1123_re = re.compile(
+    r"(\d\d) (" + "|".join(_MONTHS) + r") (\d{4}) (\d\d):(\d\d):(\d\d)", re.ASCII
+)
+
+
+def parse_timestamp(value):
+    matched = _rfc1123_re.fullmatch(value, 5, len(value) - 4)
+    if matched is None:
+        # Anything that doesn't look exactly like we expect gets handed to strptime,
+        # which is what we've historically used, so that it can decide what to do.
+        return datetime.strptime(value[5:-4], "%d %b %Y %H:%M:%S").replace(
+            tzinfo=timezone.utc
+        )
+
+    day, month, year, hour, minute, second = matched.groups()
+    return datetime(
+        int(year),
+        _MONTHS[month],
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        tzinfo=timezone.utc,
+    )
+
+
+def format_timestamp(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S +00:00")
+
+
+def _parse_timestamp(value):
+    # We'll happily memoize bytes as well, so that callers can skip decoding the
+    # timestamp entirely when it's one we've already seen.
+    if isinstance(value, bytes):
+        value = value.decode("ascii")
+    return parse_timestamp(value)
+
+
+class TimestampCodec:
+    """
+    Memoizes parsing the timestamps in our log lines, and formatting them again for
+    our output. A single log file only spans a few minutes, so the same second shows
+    up on thousands of lines, and there is no reason to parse or format it more than
+    once.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        # These are the memoized functions themselves, rather than methods that call
+        # them, so that a hit never has to leave C.
+        self.parse = functools.lru_cache(maxsize=maxsize)(_parse_timestamp)
+        self.format = functools.lru_cache(maxsize=maxsize)(format_timestamp)
+
+    @property
+    def hits(self):
+        return self.parse.cache_info().hits + self.format.cache_info().hits
+
+    @property
+    def misses(self):
+        return self.parse.cache_info().misses + self.format.cache_info().misses
+
+    @property
+    def hit_rate(self):
+        return hit_rate(self.hits, self.misses)
+
+    def clear(self):
+        self.parse.cache_clear()
+        self.format.cache_clear()
+
+
+codec = TimestampCodec()
@@ -11,9 +11,173 @@
 # limitations under the License.
 
 import logging as _logging
+import threading
+import time
 
 
 SPEW = 5
 
 
 _logging.addLevelName(SPEW, "SPEW")
+
+
+class _Kind:
+    __slots__ = ("logged_at", "suppressed", "samples")
+
+    def __init__(self):
+        self.logged_at = None
+        self.suppressed = 0
+        self.samples = []
+
+
+class ErrorAggregator:
+    """
+    Logs the first error of each kind (like a parser, and the type of exception that
+    it raised) along with its traceback, and then at most one more of that kind per
+    interval. Any others are only counted, along with a few samples of what caused
+    them, and logged as a summary the next time that we log that kind, or when
+    we're flushed.
+
+    A single bad user agent that suddenly shows up everywhere would otherwise log
+    (and send to Sentry) a formatted traceback for every one of its lines.
+    """
+
+    def __init__(self, logger, *, interval=60.0, samples=3, clock=time.monotonic):
+        self.logger = logger
+        self.interval = interval
+        self.samples = samples
+        self._clock = clock
+        self._kinds = {}
+        self._lock = threading.Lock()
+        self.errors = 0
+        self.suppressed = 0
+
+    def report(self, kind, sample, msg, *args):
+        """
+        Reports an error of the given kind, caused by sample, from within the except
+        block that caught it. Returns whether or not it was logged.
+        """
+        now = self._clock()
+        with self._lock:
+            self.errors += 1
+            state = self._kinds.get(kind)
+            if state is None:
+                state = self._kinds[kind] = _Kind()
+            if state.logged_at is not None and now - state.logged_at < self.interval:
+                self.suppressed += 1
+                state.suppressed += 1
+                if len(state.samples) < self.samples:
+                    state.samples.append(sample)
+                return False
+
+            state.logged_at = now
+            summary = self._take_summary(kind, state)
+
+        # We log outside of the lock, since a handler (like Sentry's) can be slow.
+        if summary is not None:
+            self.logger.error(*summary)
+        self.logger.error(msg, *args, exc_info=True)
+        return True
+
+    def _take_summary(self, kind, state):
+        if not state.suppressed:
+            return None
+        summary = (
+            "Suppressed %d more errors like %s, for example: %s",
+            state.suppressed,
+            "/".join(map(str, kind)) if isinstance(kind, tuple) else kind,
+            ", ".join(map(repr, state.samples)),
+        )
+        state.suppressed = 0
+        state.samples = []
+        return summary
+
+    def flush(self):
+        """
+        Logs a summary of every error that we've suppressed since it was last logged.
+        """
+        with self._lock:
+            summaries = [
+                self._take_summary(kind, state) for kind, state in self._kinds.items()
+            ]
+        for summary in summaries:
+            if summary is not None:
+                self.logger.error(*summary)
+
+    def take_counts(self):
+        """
+        Returns how many errors have been reported, and how many of those were
+        suppressed, since the counts were last taken, and starts counting over. When
+        each kind was last logged is kept, so this doesn't let any more through.
+        """
+        with self._lock:
+            counts = (self.errors, self.suppressed)
+            self.errors = 0
+            self.suppressed = 0
+        return counts
+
+    def clear(self):
+        with self._lock:
+            self._kinds.clear()
+            self.errors = 0
+            self.suppressed = 0
+
+
+class EventLimiter:
+    """
+    Caps how many events of the same kind we'll pass on per interval, for use as
+    Sentry's before_send and before_breadcrumb hooks. Events from logging are of the
+    same kind when they come from the same logger and format string, no matter what
+    went into that format string, and exceptions when they have the same type.
+    """
+
+    def __init__(self, limit=10, *, interval=60.0, clock=time.monotonic):
+        self.limit = limit
+        self.interval = interval
+        self._clock = clock
+        self._windows = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def allow(self, kind):
+        now = self._clock()
+        with self._lock:
+            started, count = self._windows.get(kind, (None, 0))
+            if started is None or now - started >= self.interval:
+                started, count = now, 0
+            if count >= self.limit:
+                self.dropped += 1
+                return False
+            self._windows[kind] = (started, count + 1)
+            return True
+
+    def take_dropped(self):
+        """
+        Returns how many events have been dropped since this was last called, and
+        starts counting over.
+        """
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    @staticmethod
+    def _kind(category, hint):
+        record = (hint or {}).get("log_record")
+        if record is not None:
+            return (category, record.name, record.msg)
+        exc_info = (hint or {}).get("exc_info")
+        if exc_info is not None:
+            return (category, exc_info[0])
+        return None
+
+    def before_send(self, event, hint):
+        kind = self._kind("event", hint)
+        if kind is not None and not self.allow(kind):
+            return None
+        return event
+
+    def before_breadcrumb(self, crumb, hint):
+        kind = self._kind("breadcrumb", hint)
+        if kind is not None and not self.allow(kind):
+            return None
+        return crumb
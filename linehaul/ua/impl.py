@@ -12,19 +12,43 @@
 
 import abc
 import collections
+import functools
 import logging
+import math
 import random
 import re
+import threading
+import time
+
+from linehaul.logging import ErrorAggregator
 
 
 logger = logging.getLogger(__name__)
 
+# Parsers that raise something other than UnableToParse, by parser and exception,
+# which only get logged (with a traceback) once in a while.
+errors = ErrorAggregator(logger)
+
+
+def _report_error(user_agent, parser, exc):
+    errors.report(
+        (parser.name, type(exc).__name__),
+        user_agent,
+        "Error parsing %r as a %s.",
+        user_agent,
+        parser.name,
+    )
+
 
 class UnableToParse(Exception):
     pass
 
 
 class UserAgentParser(metaclass=abc.ABCMeta):
+    # The literal prefixes that every user agent this parser can parse starts with,
+    # which lets a ParserSet skip it for anything else. None means any user agent.
+    prefixes = None
+
     @property
     @abc.abstractmethod
     def name(self):
@@ -43,12 +67,13 @@ class UserAgentParser(metaclass=abc.ABCMeta):
 
 
 class CallbackUserAgentParser(UserAgentParser):
-    def __init__(self, callback, *, name=None):
+    def __init__(self, callback, *, name=None, prefixes=None):
         if name is None:
             name = callback.__name__
 
         self._callback = callback
         self._name = name
+        self.prefixes = prefixes
 
     @property
     def name(self):
@@ -58,27 +83,31 @@ class CallbackUserAgentParser(UserAgentParser):
         return self._callback(ua)
 
 
-def ua_parser(fn):
+def ua_parser(fn=None, *, prefixes=None):
+    if fn is None:
+        return lambda fn: CallbackUserAgentParser(fn, prefixes=prefixes)
     return CallbackUserAgentParser(fn)
 
 
 class RegexUserAgentParser(UserAgentParser):
-    def __init__(self, regexes, handler, *, name=None):
+    def __init__(self, regexes, handler, *, name=None, prefixes=None):
         if name is None:
             name = handler.__name__
 
         self._regexes = [
             re.compile(regex) if isinstance(regex, str) else regex for regex in regexes
         ]
+        self._bindings = [_binding(regex) for regex in self._regexes]
         self._handler = handler
         self._name = name
+        self.prefixes = prefixes
 
     @property
     def name(self):
         return self._name
 
     def __call__(self, ua):
-        for regex in self._regexes:
+        for regex, binding in zip(self._regexes, self._bindings):
             matched = regex.search(ua)
 
             # If we've matched this particuar regex, then we'll break the loop here and
@@ -89,90 +118,538 @@ class RegexUserAgentParser(UserAgentParser):
             # None of our regexes matched.
             raise UnableToParse
 
-        # We need to build up the args, and kwargs of our function, we call any unnamed
-        # group an arg, and pass them in, in order, and we call any named group a kwarg
-        # and we pass them in by name.
-        group_to_name = {v: k for k, v in matched.re.groupindex.items()}
-        args, kwargs = [], {}
-        for i, value in enumerate(matched.groups(), start=1):
-            name = group_to_name.get(i)
-            if name is not None:
-                kwargs[name] = value
-            else:
-                args.append(value)
+        return self._handle(matched.groups(), binding)
+
+    def _handle(self, groups, binding, offset=0):
+        # Call our handler with the captured groups, bound to its arguments the way
+        # that we worked out when we compiled the regex, and return whatever result it
+        # gives us. The offset is where our groups start within the given groups.
+        args, kwargs = binding
+        return self._handler(
+            *[groups[offset + i] for i in args],
+            **{name: groups[offset + i] for name, i in kwargs.items()},
+        )
+
+
+def _binding(regex):
+    # We call any unnamed group an arg, and pass them in, in order, and we call any
+    # named group a kwarg and we pass them in by name. This gives the (zero based)
+    # index of each of those groups within matched.groups().
+    group_to_name = {v: k for k, v in regex.groupindex.items()}
+    args, kwargs = [], {}
+    for i in range(regex.groups):
+        name = group_to_name.get(i + 1)
+        if name is not None:
+            kwargs[name] = i
+        else:
+            args.append(i)
+    return args, kwargs
+
+
+_INLINE_FLAGS = {re.IGNORECASE: "i", re.MULTILINE: "m", re.DOTALL: "s", re.VERBOSE: "x"}
+_NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+
+# How the regex parser spells out a "^" at the start of a regex.
+_AT = re._parser.AT  # type: ignore[attr-defined]
+_AT_BEGINNING = re._parser.AT_BEGINNING  # type: ignore[attr-defined]
+
+
+def _anchored(regex):
+    """
+    Whether every match of the given regex starts at the start of the string, which
+    a regex that starts with a "^" doesn't guarantee, if it's only the start of the
+    first branch of a top level alternation.
+    """
+    if regex.flags & re.MULTILINE:
+        return False
+    try:
+        parsed = re._parser.parse(regex.pattern, regex.flags)
+    except re.error:
+        return False
+    return bool(parsed.data) and parsed.data[0] == (_AT, _AT_BEGINNING)
+
+
+def _alternative(regex):
+    """
+    Returns the source of a single alternative of a CombinedRegexParser, that
+    matches the same things as the given regex, with the same groups in the same
+    order, all wrapped in one more group, or None if the regex can't be combined.
+    """
+    if not isinstance(regex.pattern, str):
+        return None
+
+    # Only regexes that are anchored to the start of the user agent are worth
+    # combining. Searching an alternation means trying every alternative at every
+    # position, while a regex on its own can skip ahead to where its literal prefix
+    # is, so combining unanchored regexes only slows them down.
+    if not _anchored(regex):
+        return None
+
+    # Any flags that the regex was compiled with have to be scoped to just its own
+    # part of the combined regex.
+    flags = regex.flags & ~re.UNICODE
+    inline = "".join(letter for flag, letter in _INLINE_FLAGS.items() if flags & flag)
+    if flags & ~sum(_INLINE_FLAGS):
+        return None
+
+    # The group names only need to be unique within each regex, but they'd need to
+    # be unique across all of them once combined. We never look groups up by name
+    # anyways, so we just drop the names.
+    if "(?P=" in regex.pattern:
+        return None
+    source = _NAMED_GROUP.sub("(", regex.pattern)
+    source = f"(?{inline}:({source}))" if inline else f"({source})"
+
+    # Make sure that didn't change the meaning of the regex, which it could if it
+    # was using inline global flags, or had an escaped "(?P<" in it.
+    try:
+        compiled = re.compile(source)
+    except re.error:
+        return None
+    if compiled.groups != regex.groups + 1:
+        return None
+    return source
+
+
+class CombinedRegexParser:
+    """
+    Tries many RegexUserAgentParsers at once, by searching a single regex that is
+    an alternation of all of their regexes. Which group of the combined regex was
+    the last one to be matched tells us which alternative, and thus which parser,
+    matched, and where its captures are.
+    """
+
+    def __init__(self, parsers):
+        self.parsers = parsers
+
+        alternatives = []
+        self._alternatives = {}
+        groups = 0
+        for parser in parsers:
+            for regex, binding in zip(parser._regexes, parser._bindings):
+                alternatives.append(_alternative(regex))
+                # The group wrapping this alternative closes after any group within it,
+                # so it's the lastindex of a match, and the groups of the regex start
+                # right after it in matched.groups().
+                groups += 1
+                self._alternatives[groups] = (parser, binding, groups)
+                groups += regex.groups
+        self._regex = re.compile("|".join(alternatives))
+
+    @staticmethod
+    def can_combine(parser):
+        return type(parser) is RegexUserAgentParser and all(
+            _alternative(regex) is not None for regex in parser._regexes
+        )
+
+    def __call__(self, user_agent):
+        """
+        Returns the parser that parsed the user agent, along with what it parsed it
+        into, or raises UnableToParse if none of our parsers can parse it.
+        """
+        # Every alternative is anchored to the start, so there's no need to search
+        # anywhere else, which the regex engine can't tell for itself once they're
+        # wrapped in groups.
+        matched = self._regex.match(user_agent)
+        if matched is None:
+            raise UnableToParse
+
+        parser, binding, offset = self._alternatives[matched.lastindex]
+        try:
+            return parser, parser._handle(matched.groups(), binding, offset)
+        except UnableToParse:
+            pass
+        except Exception as exc:
+            _report_error(user_agent, parser, exc)
+
+        # The first thing to match didn't pan out, but that doesn't mean that nothing
+        # else could, so fall back to trying each parser on its own. The parser that
+        # did match has already had its say, unless it has other regexes to try.
+        for other in self.parsers:
+            if other is parser and len(parser._regexes) == 1:
+                continue
+            try:
+                return other, other(user_agent)
+            except UnableToParse:
+                pass
+            except Exception as exc:
+                _report_error(user_agent, other, exc)
 
-        # Finally, we'll call our handler with our parsed arguments, and return whatever
-        # result it gives us.
-        return self._handler(*args, **kwargs)
+        raise UnableToParse
 
 
-def regex_ua_parser(*regexes):
+def regex_ua_parser(*regexes, prefixes=None):
     def deco(fn):
-        return RegexUserAgentParser(regexes, fn)
+        if prefixes is None:
+            return RegexUserAgentParser(regexes, fn)
+        return RegexUserAgentParser(regexes, fn, prefixes=prefixes)
 
     return deco
 
 
-class ParserSet:
+class _Figures:
+    __slots__ = ("attempts", "hits", "misses", "errors", "total_ns", "samples")
+
+    def __init__(self, samples):
+        self.attempts = self.hits = self.misses = self.errors = self.total_ns = 0
+        self.samples = collections.deque(maxlen=samples)
+
+
+class ParserStats:
+    """
+    How many times each parser was tried, and what came of it (a hit, a miss where
+    it raised UnableToParse, or an unexpected error), along with how long it took,
+    in total and as percentiles over its most recent attempts. Anything else that
+    we want to time, like structuring the parsed user agent, can be recorded
+    alongside the parsers under a name of its own.
+    """
+
+    SAMPLES = 1024
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self._figures = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed_ns, outcome=None):
+        with self._lock:
+            figures = self._figures.get(name)
+            if figures is None:
+                figures = self._figures[name] = _Figures(self.SAMPLES)
+            figures.attempts += 1
+            figures.total_ns += elapsed_ns
+            figures.samples.append(elapsed_ns)
+            if outcome is not None:
+                setattr(figures, outcome, getattr(figures, outcome) + 1)
+
+    def snapshot(self):
+        """
+        Returns the figures for everything we've recorded, by name, with the most
+        time consuming first.
+        """
+        snapshot = {}
+        with self._lock:
+            for name, figures in sorted(
+                self._figures.items(), key=lambda item: item[1].total_ns, reverse=True
+            ):
+                samples = sorted(figures.samples)
+                snapshot[name] = {
+                    "attempts": figures.attempts,
+                    "hits": figures.hits,
+                    "misses": figures.misses,
+                    "errors": figures.errors,
+                    "total_ms": figures.total_ns / 1e6,
+                }
+                for percentile in self.PERCENTILES:
+                    index = min(len(samples) - 1, len(samples) * percentile // 100)
+                    snapshot[name][f"p{percentile}_us"] = samples[index] / 1e3
+        return snapshot
+
+    def format(self):
+        return "\n".join(
+            f"{name}: "
+            + ", ".join(
+                f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in figures.items()
+            )
+            for name, figures in self.snapshot().items()
+        )
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+
+
+class _ThreadCounts(threading.local):
+    # The hits and calls that one thread has made on a ParserSet since it last
+    # merged them into the shared counts.
     def __init__(self):
+        self.counts = collections.Counter()
+        self.calls = 0
+
+
+class ParserSet:
+    """
+    Tries each registered parser in turn until one of them can parse a given user
+    agent, keeping the most commonly used parsers first.
+
+    A parser can also be registered with an explicit position, "first" or "last",
+    to always be tried ahead of or behind all of the others, in the order that
+    those were registered in, which our optimizing leaves alone.
+
+    A ParserSet is safe to use from several threads at once. Each thread counts
+    its own hits, and merges them into the shared counts once every merge_every
+    calls, so that the lock is rarely taken. Reordering the parsers builds a new
+    list rather than sorting the one that other threads may be walking through.
+    """
+
+    def __init__(
+        self, *, combine_regexes=True, optimize_every=1000000, merge_every=1024
+    ):
         self._parsers = []
+        self._first = []
+        self._last = []
+        self._combine_regexes = combine_regexes
 
-        self._optimize_every = 1000000
+        # None turns off optimizing as we go, leaving the parsers in whatever order
+        # they were registered, or a loaded profile put them in.
+        self._optimize_every = math.inf if optimize_every is None else optimize_every
         # Set the first optimize in to a reduced amount to get some basic optimization
         # done early.
         self._optimize_in = self._optimize_every * 0.25
         self._counts = collections.Counter()
 
-    def register(self, parser, *, _randomize=True):
-        self._parsers.append(parser)
+        self._merge_every = merge_every
+        self._local = _ThreadCounts()
+        self._lock = threading.RLock()
+
+        # Only set while we're instrumented, see enable_stats().
+        self.stats = None
 
-        # The use of random.shuffle here is a bit quirkly, it doesn't actually help us
-        # at runtime in any way. What it *does* do, is make it more likely that any
-        # ordering dependence in registered parsers shows up as test failures instead
-        # of being hard to find bugs in production.
-        # This does make registering a parser more heavy-weight than recorded (through
-        # minorly so), but this shouldn't matter since in our usage registerin is only
-        # done at the module level anyways.
-        if _randomize:
-            random.shuffle(self._parsers)
+        self._reset_index()
+
+    def register(self, parser=None, *, position=None, _randomize=True):
+        # Called with just a position, as a decorator.
+        if parser is None:
+            return functools.partial(
+                self.register, position=position, _randomize=_randomize
+            )
+
+        if position not in {None, "first", "last"}:
+            raise ValueError(
+                f"Unknown position {position!r}, expected 'first' or 'last'."
+            )
+
+        with self._lock:
+            if position == "first":
+                self._first = self._first + [parser]
+            elif position == "last":
+                self._last = self._last + [parser]
+            else:
+                parsers = self._parsers + [parser]
+
+                # The use of random.shuffle here is a bit quirkly, it doesn't actually
+                # help us at runtime in any way. What it *does* do, is make it more
+                # likely that any ordering dependence in registered parsers shows up
+                # as test failures instead of being hard to find bugs in production.
+                # This does make registering a parser more heavy-weight than recorded
+                # (through minorly so), but this shouldn't matter since in our usage
+                # registerin is only done at the module level anyways.
+                if _randomize:
+                    random.shuffle(parsers)
+
+                self._parsers = parsers
+            self._reset_index()
 
         return parser
 
+    def _reset_index(self):
+        # Every parser that has declared its prefixes, by prefix, along with those
+        # prefixes by how they start (as many characters as the shortest of them has),
+        # so that we can find every prefix that a user agent starts with by slicing
+        # it once, and then checking the few prefixes that start the same way.
+        by_prefix = collections.defaultdict(set)
+        for parser in self._first + self._parsers + self._last:
+            for prefix in getattr(parser, "prefixes", None) or ():
+                by_prefix[prefix].add(parser)
+        head = min(map(len, by_prefix), default=0)
+        by_head = collections.defaultdict(list)
+        for prefix in sorted(by_prefix, key=len):
+            by_head[prefix[:head]].append(prefix)
+        self._index = (head, dict(by_head), by_prefix)
+
+        # The parsers worth trying for each combination of prefixes that we've seen,
+        # always in the same order as self._parsers (between any that were given a
+        # position), along with every parser that didn't declare any prefixes at
+        # all. Unless we've been told not to, all of the regex parsers in there
+        # that weren't given a position get tried at once, by one
+        # CombinedRegexParser.
+        self._candidates = {}
+
+    def _candidates_for(self, user_agent):
+        # Hold on to the cache that we looked in, so that if another thread
+        # replaces it while we're working out the candidates, we only ever store
+        # them in the old one that is being thrown away.
+        cache = self._candidates
+        head, by_head, by_prefix = self._index
+        prefixes = tuple(
+            prefix
+            for prefix in by_head.get(user_agent[:head], ())
+            if user_agent.startswith(prefix)
+        )
+        try:
+            return cache[prefixes]
+        except KeyError:
+            pass
+
+        matched = set().union(*(by_prefix[prefix] for prefix in prefixes))
+
+        def worth_trying(parsers):
+            return [
+                parser
+                for parser in parsers
+                if parser in matched or not getattr(parser, "prefixes", None)
+            ]
+
+        candidates = worth_trying(self._parsers)
+        if self._combine_regexes:
+            candidates = _combined(candidates)
+        candidates = worth_trying(self._first) + candidates + worth_trying(self._last)
+        cache[prefixes] = candidates
+        return candidates
+
+    def _merge(self, local):
+        # Must be called with the lock held, and only with the calling thread's own
+        # counts.
+        self._counts.update(local.counts)
+        self._optimize_in -= local.calls
+        local.counts.clear()
+        local.calls = 0
+
     def _optimize(self):
-        # We're going to sort our list in place, using the value of how many times
-        # a parser function has been used as the parser for a user agent to put the
-        # most commonly used parsed first.
-        self._parsers.sort(key=lambda p: self._counts[p], reverse=True)
+        with self._lock:
+            # Whatever this thread has counted so far should count towards the order
+            # we're about to pick.
+            self._merge(self._local)
+
+            # We're going to sort into a new list, using the value of how many times
+            # a parser function has been used as the parser for a user agent to put
+            # the most commonly used parsed first. Any thread that is part way
+            # through the old list carries on with it undisturbed.
+            self._parsers = sorted(
+                self._parsers, key=lambda p: self._counts[p], reverse=True
+            )
+            self._candidates = {}
+
+            # Reduce our recorded counts just to keep the size of our counts in
+            # checks. This will also implicitly act as a decay so that historical
+            # data is less relevant than new data.
+            self._counts.subtract({k: int(v * 0.5) for k, v in self._counts.items()})
+
+            # Reset our marker
+            self._optimize_in = self._optimize_every
+
+    def export_profile(self):
+        """
+        Returns how many times each parser has been used to parse a user agent, by
+        name, which load_profile can give another ParserSet a head start with.
 
-        # Reduce our recorded counts just to keep the size of our counts in checks.
-        # This will also implicitly act as a decay so that historical data is less
-        # relevant than new data.
-        self._counts.subtract({k: int(v * 0.5) for k, v in self._counts.items()})
+        Counts that other threads haven't merged yet are left out.
+        """
+        with self._lock:
+            self._merge(self._local)
+            return {
+                parser.name: count
+                for parser, count in self._counts.items()
+                if count > 0
+            }
+
+    def load_profile(self, profile):
+        """
+        Orders our parsers by the counts in the given profile, as if we had already
+        been used to parse those user agents. Any parser that we don't have is
+        skipped, and any that the profile doesn't mention stay at the back.
+        """
+        with self._lock:
+            by_name = {parser.name: parser for parser in self._parsers}
+            for name, count in profile.items():
+                if name in by_name:
+                    self._counts[by_name[name]] = count
+
+            self._parsers = sorted(
+                self._parsers, key=lambda p: self._counts[p], reverse=True
+            )
+            self._candidates = {}
+
+    def enable_stats(self):
+        """
+        Starts recording a ParserStats for every parser that we try, returning it.
+        While we're recording, the regex parsers are tried one at a time instead of
+        all at once, so that the time each of them takes is its own.
+        """
+        if self.stats is None:
+            self.stats = ParserStats()
+        return self.stats
 
-        # Reset our marker
-        self._optimize_in = self._optimize_every
+    def disable_stats(self):
+        self.stats = None
 
     def __call__(self, user_agent):
-        # Decrement our counter for how long until we will implicitly call optimize
-        # on our ParserSet, and check to see if it's time to optimize or not.
-        self._optimize_in -= 1
-        if self._optimize_in <= 0:
-            self._optimize()
-
-        # Actually go through our registered parsers and try to use them to parse.
-        for parser in self._parsers:
-            try:
-                parsed = parser(user_agent)
-
-                # Record a "hit" for this parser.
-                self._counts[parser] += 1
+        local = self._local
+        local.calls += 1
+        try:
+            stats = self.stats
+            if stats is not None:
+                parser, parsed = self._instrumented_call(user_agent, stats)
+            else:
+                parser, parsed = self._call(user_agent)
+
+            # Record a "hit" for this parser.
+            local.counts[parser] += 1
+
+            return parsed
+        finally:
+            # Every so often, fold what this thread has counted into the shared
+            # counts, and check to see if it's time to optimize or not.
+            if local.calls >= self._merge_every:
+                with self._lock:
+                    self._merge(local)
+                    if self._optimize_in <= 0:
+                        self._optimize()
+
+    def _call(self, user_agent):
+        # Actually go through the registered parsers that could possibly parse this
+        # user agent and try to use them to parse.
+        for parser in self._candidates_for(user_agent):
+            if type(parser) is CombinedRegexParser:
+                try:
+                    return parser(user_agent)
+                except UnableToParse:
+                    continue
 
-                return parsed
+            try:
+                return parser, parser(user_agent)
             except UnableToParse:
                 pass
-            except Exception:
-                logger.error(
-                    "Error parsing %r as a %s.", user_agent, parser.name, exc_info=True
-                )
+            except Exception as exc:
+                _report_error(user_agent, parser, exc)
+
+        raise UnableToParse
+
+    def _instrumented_call(self, user_agent, stats):
+        for step in self._candidates_for(user_agent):
+            parsers = step.parsers if type(step) is CombinedRegexParser else [step]
+            for parser in parsers:
+                start = time.perf_counter_ns()
+                try:
+                    parsed = parser(user_agent)
+                except UnableToParse:
+                    stats.record(parser.name, time.perf_counter_ns() - start, "misses")
+                except Exception as exc:
+                    stats.record(parser.name, time.perf_counter_ns() - start, "errors")
+                    _report_error(user_agent, parser, exc)
+                else:
+                    stats.record(parser.name, time.perf_counter_ns() - start, "hits")
+                    return parser, parsed
 
         raise UnableToParse
+
+
+def _combined(parsers):
+    # Replace every parser that we can combine with a single CombinedRegexParser, in
+    # the place of the first of them, which is fine since any ordering dependence
+    # between parsers is a bug anyways.
+    combinable = [
+        parser for parser in parsers if CombinedRegexParser.can_combine(parser)
+    ]
+    if len(combinable) < 2:
+        return parsers
+
+    combined = CombinedRegexParser(combinable)
+    steps = []
+    for parser in parsers:
+        if parser not in combinable:
+            steps.append(parser)
+        elif parser is combinable[0]:
+            steps.append(combined)
+    return steps
@@ -10,17 +10,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
 import logging
 import re
+import sys
+import time
 
-import cattr
-import packaging.version
-
-from packaging.specifiers import SpecifierSet
-
+from linehaul.cache import LRUCache
 from linehaul.ua.datastructures import UserAgent
 from linehaul.ua.impl import ParserSet, UnableToParse, ua_parser, regex_ua_parser
+from linehaul.ua.payloads import decoder as _decode_payload
+from linehaul.ua.structuring import structure_user_agent
+from linehaul.ua.versions import VersionGate
 
 
 logger = logging.getLogger(__name__)
@@ -35,9 +37,14 @@ class UnknownUserAgentError(ValueError):
 #       ordering independent.
 _parser = ParserSet()
 
+# The versions of each installer that a given user agent format was used by.
+_pip6_versions = VersionGate(">=6")
+_pip1_4_versions = VersionGate(">=1.4,<6")
+_uv_versions = VersionGate(">=0.1.22")
+
 
 @_parser.register
-@ua_parser
+@ua_parser(prefixes=["pip/"])
 def Pip6UserAgent(user_agent):
     # We're only concerned about pip user agents.
     if not user_agent.startswith("pip/"):
@@ -46,27 +53,32 @@ def Pip6UserAgent(user_agent):
     # This format was brand new in pip 6.0, so we'll need to restrict it
     # to only versions of pip newer than that.
     version_str = user_agent.split()[0].split("/", 1)[1]
-    version = packaging.version.parse(version_str)
-    if version not in SpecifierSet(">=6", prereleases=True):
+    if version_str not in _pip6_versions:
         raise UnableToParse
 
     try:
-        return json.loads(user_agent.split(maxsplit=1)[1])
+        return _decode_payload(user_agent.split(maxsplit=1)[1])
     except (json.JSONDecodeError, UnicodeDecodeError, IndexError):
         raise UnableToParse from None
 
 
+# Note: A version that comes after a "name/" is matched as everything after the last
+#       "/" in it, or after the "/" before that, if it ends with one. That's the same
+#       split that a plain \S+ would give, except that \S+ would scan to the end of
+#       the name/version again for every "/" that the name could end at, which a long
+#       enough user agent full of them turns into quadratic backtracking.
 @_parser.register
 @regex_ua_parser(
     (
-        r"^pip/(?P<version>\S+) (?P<impl_name>\S+)/(?P<impl_version>\S+) "
-        r"(?P<system_name>\S+)/(?P<system_release>\S+)$"
-    )
+        r"^pip/(?P<version>\S+) (?P<impl_name>\S+)/(?P<impl_version>[^\s/]+|[^\s/]*/) "
+        r"(?P<system_name>\S+)/(?P<system_release>[^\s/]+|[^\s/]*/)$"
+    ),
+    prefixes=["pip/"],
 )
 def Pip1_4UserAgent(*, version, impl_name, impl_version, system_name, system_release):
     # This format was brand new in pip 1.4, and went away in pip 6.0, so
     # we'll need to restrict it to only versions of pip between 1.4 and 6.0.
-    if version not in SpecifierSet(">=1.4,<6", prereleases=True):
+    if version not in _pip1_4_versions:
         raise UnableToParse
 
     data = {"installer": {"name": "pip", "version": version}}
@@ -90,7 +102,10 @@ def Pip1_4UserAgent(*, version, impl_name, impl_version, system_name, system_rel
 
 
 @_parser.register
-@regex_ua_parser(r"^Python-urllib/(?P<python>\d\.\d) distribute/(?P<version>\S+)$")
+@regex_ua_parser(
+    r"^Python-urllib/(?P<python>\d\.\d) distribute/(?P<version>\S+)$",
+    prefixes=["Python-urllib/"],
+)
 def DistributeUserAgent(*, python, version):
     return {"installer": {"name": "distribute", "version": version}, "python": python}
 
@@ -99,6 +114,7 @@ def DistributeUserAgent(*, python, version):
 @regex_ua_parser(
     r"^Python-urllib/(?P<python>\d\.\d) setuptools/(?P<version>\S+)$",
     r"^setuptools/(?P<version>\S+) Python-urllib/(?P<python>\d\.\d)$",
+    prefixes=["Python-urllib/", "setuptools/"],
 )
 def SetuptoolsUserAgent(*, python, version):
     return {"installer": {"name": "setuptools", "version": version}, "python": python}
@@ -111,19 +127,19 @@ def PexUserAgent(*, version):
 
 
 @_parser.register
-@regex_ua_parser(r"^conda/(?P<version>\S+)(?: .+)?$")
+@regex_ua_parser(r"^conda/(?P<version>\S+)(?: .+)?$", prefixes=["conda/"])
 def CondaUserAgent(*, version):
     return {"installer": {"name": "conda", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^Bazel/(?:release\s+)?(?P<version>.+)$")
+@regex_ua_parser(r"^Bazel/(?:release\s+)?(?P<version>.+)$", prefixes=["Bazel/"])
 def BazelUserAgent(*, version):
     return {"installer": {"name": "Bazel", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^bandersnatch/(?P<version>\S+) \(.+\)$")
+@regex_ua_parser(r"^bandersnatch/(?P<version>\S+) \(.+\)$", prefixes=["bandersnatch/"])
 def BandersnatchUserAgent(*, version):
     return {"installer": {"name": "bandersnatch", "version": version}}
 
@@ -135,37 +151,43 @@ def DevPIUserAgent(*, version):
 
 
 @_parser.register
-@regex_ua_parser(r"^z3c\.pypimirror/(?P<version>\S+)$")
+@regex_ua_parser(r"^z3c\.pypimirror/(?P<version>\S+)$", prefixes=["z3c.pypimirror/"])
 def Z3CPyPIMirrorUserAgent(*, version):
     return {"installer": {"name": "z3c.pypimirror", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^Artifactory/(?P<version>\S+)$")
+@regex_ua_parser(r"^Artifactory/(?P<version>\S+)$", prefixes=["Artifactory/"])
 def ArtifactoryUserAgent(*, version):
     return {"installer": {"name": "Artifactory", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^Nexus/(?P<version>\S+)")
+@regex_ua_parser(r"^Nexus/(?P<version>\S+)", prefixes=["Nexus/"])
 def NexusUserAgent(*, version):
     return {"installer": {"name": "Nexus", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^pep381client(?:-proxy)?/(?P<version>\S+)$")
+@regex_ua_parser(
+    r"^pep381client(?:-proxy)?/(?P<version>\S+)$",
+    prefixes=["pep381client"],
+)
 def PEP381ClientUserAgent(*, version):
     return {"installer": {"name": "pep381client", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^maturin/(?P<version>\S+)$")
+@regex_ua_parser(r"^maturin/(?P<version>\S+)$", prefixes=["maturin/"])
 def MaturinUserAgent(*, version):
     return {"installer": {"name": "maturin", "version": version}}
 
 
 @_parser.register
-@regex_ua_parser(r"^pdm/(?P<version>\S+) (?P<impl_name>\S+)/(?P<impl_version>\S+)$")
+@regex_ua_parser(
+    r"^pdm/(?P<version>\S+) (?P<impl_name>\S+)/(?P<impl_version>[^\s/]+|[^\s/]*/)$",
+    prefixes=["pdm/"],
+)
 def PDMUserAgent(*, version, impl_name, impl_version):
     return {
         "installer": {"name": "pdm", "version": version},
@@ -175,8 +197,9 @@ def PDMUserAgent(*, version, impl_name, impl_version):
 
 @_parser.register
 @regex_ua_parser(
-    r"^poetry/(?P<version>\S+) (?P<impl_name>\S+)/(?P<impl_version>\S+) "
-    r"(?P<system_name>\S+)/(?P<system_release>\S+)?$"
+    r"^poetry/(?P<version>\S+) (?P<impl_name>\S+)/(?P<impl_version>[^\s/]+|[^\s/]*/) "
+    r"(?P<system_name>\S+)/(?P<system_release>[^\s/]+)?$",
+    prefixes=["poetry/"],
 )
 def PoetryUserAgent(*, version, impl_name, impl_version, system_name, system_release):
     return {
@@ -188,7 +211,9 @@ def PoetryUserAgent(*, version, impl_name, impl_version, system_name, system_rel
 
 @_parser.register
 @regex_ua_parser(
-    r"^twine/(?P<version>\S+)(?: .+)? (?P<impl_name>\S+)/(?P<impl_version>\S+)$"
+    r"^twine/(?P<version>\S+)(?: .+)? "
+    r"(?P<impl_name>\S+)/(?P<impl_version>[^\s/]+|[^\s/]*/)$",
+    prefixes=["twine/"],
 )
 def TwineUserAgent(*, version, impl_name, impl_version):
     return {
@@ -198,7 +223,7 @@ def TwineUserAgent(*, version, impl_name, impl_version):
 
 
 @_parser.register
-@ua_parser
+@ua_parser(prefixes=["uv/"])
 def UvUserAgent(user_agent):
     # We're only concerned about uv user agents.
     if not user_agent.startswith("uv/"):
@@ -207,12 +232,11 @@ def UvUserAgent(user_agent):
     # This format was brand new in uv 0.1.22, so we'll need to restrict it
     # to only versions of uv newer than that.
     version_str = user_agent.split()[0].split("/", 1)[1]
-    version = packaging.version.parse(version_str)
-    if version not in SpecifierSet(">=0.1.22", prereleases=True):
+    if version_str not in _uv_versions:
         raise UnableToParse
 
     try:
-        return json.loads(user_agent.split(maxsplit=1)[1])
+        return _decode_payload(user_agent.split(maxsplit=1)[1])
     except (json.JSONDecodeError, UnicodeDecodeError, IndexError):
         raise UnableToParse from None
 
@@ -225,7 +249,7 @@ def UvUserAgent(user_agent):
 #       right now we're counting pip 1.4 in here... but pip 1.4 usage is probably
 #       low enough not to worry about that any more.
 @_parser.register
-@regex_ua_parser(r"^Python-urllib/(?P<python>\d\.\d)$")
+@regex_ua_parser(r"^Python-urllib/(?P<python>\d\.\d)$", prefixes=["Python-urllib/"])
 def URLLib2UserAgent(*, python):
     return {"python": python}
 
@@ -234,7 +258,10 @@ def URLLib2UserAgent(*, python):
 #       just the same as we treat browsers, since we don't really know anything
 #       about it and the version of requests isn't very useful in general.
 @_parser.register
-@regex_ua_parser(r"^python-requests/(?P<version>\S+)(?: .+)?$")
+@regex_ua_parser(
+    r"^python-requests/(?P<version>\S+)(?: .+)?$",
+    prefixes=["python-requests/"],
+)
 def RequestsUserAgent(*, version):
     return {"installer": {"name": "requests", "version": version}}
 
@@ -244,7 +271,8 @@ def RequestsUserAgent(*, version):
     (
         r"^Homebrew/(?P<version>\S+) "
         r"\(Macintosh; Intel (?:Mac OS X|macOS) (?P<osx_version>[^)]+)\)(?: .+)?$"
-    )
+    ),
+    prefixes=["Homebrew/"],
 )
 def HomebrewUserAgent(*, version, osx_version):
     return {
@@ -274,7 +302,20 @@ def HomebrewUserAgent(*, version, osx_version):
     )
     """,
         re.VERBOSE,
-    )
+    ),
+    prefixes=[
+        "fetch libfetch/",
+        "libfetch/",
+        "OpenBSD ftp",
+        "MacPorts",
+        "NetBSD-ftp/",
+        "slapt-get",
+        "pypi-install/",
+        "slackrepo",
+        "PTXdist",
+        "GARstow/",
+        "xbps/",
+    ],
 )
 def OSUserAgent():
     return {"installer": {"name": "OS"}}
@@ -311,62 +352,316 @@ def BrowserUserAgent():
     return {"installer": {"name": "Browser"}}
 
 
-# TODO: It would be kind of nice to implement this as just another parser, that returns
-#       None instead of a dictionary. However given that there is no inherent ordering
-#       in a ParserSet, and we want this to always go last (just incase an ignore
-#       pattern is overlly broad) we can't do that. It would be nice to make it possible
-#       to register a parser with an explicit location in the parser set.
-_ignore_re = re.compile(
+# What IgnoredUserAgent returns for a user agent that it found, which can't be
+# confused with anything that another parser returns, such as the None that a
+# payload of JSON null decodes to.
+_IGNORED = object()
+
+
+# User agents that we know about, but don't care to record, like bots and monitoring.
+# Most of them have a literal prefix, so they're just another (prefix indexed) parser
+# that returns _IGNORED instead of a dictionary. It always goes last, after every real
+# parser that could be tried for that user agent, so that an overly broad ignore
+# pattern can never win over a real parser.
+_ignore_prefixed_re = re.compile(
     r"""
+    ^
     (?:
-        ^Datadog\ Agent/ |
-        ^\(null\)$ |
-        ^WordPress/ |
-        ^Chef\ (?:Client|Knife)/ |
-        ^Ruby$ |
-        ^Slackbot-LinkExpanding |
-        ^TextualInlineMedia/ |
-        ^WeeChat/ |
-        ^Download\ Master$ |
-        ^Java/ |
-        ^Go\ \d\.\d\ package\ http$ |
-        ^Go-http-client/ |
-        ^GNU\ Guile$ |
-        ^github-olee$ |
-        ^YisouSpider$ |
-        ^Apache\ Ant/ |
-        ^Salt/ |
-        ^ansible-httpget$ |
-        ^ltx71\ -\ \(http://ltx71.com/\) |
-        ^Scrapy/ |
-        ^spectool/ |
-        Nutch |
-        ^AWSBrewLinkChecker/ |
-        ^Y!J-ASR/ |
-        ^NSIS_Inetc\ \(Mozilla\)$ |
-        ^Debian\ uscan |
-        ^Pingdom\.com_bot_version_\d+\.\d+_\(https?://www.pingdom.com/\)$ |
-        ^MauiBot\ \(crawler\.feedback\+dc@gmail\.com\)$ |
-        ^inspector\.pypi\.io$
+        Datadog\ Agent/ |
+        \(null\)$ |
+        WordPress/ |
+        Chef\ (?:Client|Knife)/ |
+        Ruby$ |
+        Slackbot-LinkExpanding |
+        TextualInlineMedia/ |
+        WeeChat/ |
+        Download\ Master$ |
+        Java/ |
+        Go\ \d\.\d\ package\ http$ |
+        Go-http-client/ |
+        GNU\ Guile$ |
+        github-olee$ |
+        YisouSpider$ |
+        Apache\ Ant/ |
+        Salt/ |
+        ansible-httpget$ |
+        ltx71\ -\ \(http://ltx71.com/\) |
+        Scrapy/ |
+        spectool/ |
+        AWSBrewLinkChecker/ |
+        Y!J-ASR/ |
+        NSIS_Inetc\ \(Mozilla\)$ |
+        Debian\ uscan |
+        Pingdom\.com_bot_version_\d+\.\d+_\(https?://www.pingdom.com/\)$ |
+        MauiBot\ \(crawler\.feedback\+dc@gmail\.com\)$ |
+        inspector\.pypi\.io$
     )
     """,
     re.VERBOSE,
 )
 
 
-def parse(user_agent: str) -> UserAgent | None:
+@_parser.register(position="last")
+@ua_parser(
+    prefixes=[
+        "Datadog Agent/",
+        "(null)",
+        "WordPress/",
+        "Chef Client/",
+        "Chef Knife/",
+        "Ruby",
+        "Slackbot-LinkExpanding",
+        "TextualInlineMedia/",
+        "WeeChat/",
+        "Download Master",
+        "Java/",
+        "Go ",
+        "Go-http-client/",
+        "GNU Guile",
+        "github-olee",
+        "YisouSpider",
+        "Apache Ant/",
+        "Salt/",
+        "ansible-httpget",
+        "ltx71 - (http://ltx71",
+        "Scrapy/",
+        "spectool/",
+        "AWSBrewLinkChecker/",
+        "Y!J-ASR/",
+        "NSIS_Inetc (Mozilla)",
+        "Debian uscan",
+        "Pingdom.com_bot_version_",
+        "MauiBot (crawler.feedback+dc@gmail.com)",
+        "inspector.pypi.io",
+    ],
+)
+def IgnoredUserAgent(user_agent):
+    if _ignore_prefixed_re.match(user_agent) is None:
+        raise UnableToParse
+    return _IGNORED
+
+
+# The rest of the user agents that we ignore, which can't be found by their prefix,
+# and so are only looked for once every parser has failed.
+_ignore_re = re.compile(r"Nutch")
+
+
+def _structure(parsed):
+    # A parser can match a user agent and still hand us something that isn't a user
+    # agent, like a pip or uv payload of JSON null, or one with a number for its
+    # installer. That leaves us just as unable to parse it as if no parser matched.
+    try:
+        return structure_user_agent(parsed)
+    except Exception as exc:
+        raise UnknownUserAgentError from exc
+
+
+def _parse(user_agent: str) -> UserAgent | None:
+    stats = getattr(_parser, "stats", None)
+    if stats is not None:
+        return _instrumented_parse(user_agent, stats)
+
     try:
-        return cattr.structure(_parser(user_agent), UserAgent)
+        parsed = _parser(user_agent)
     except UnableToParse:
         # If we were not able to parse the user agent, then we have two options, we can
         # either raise an `UnknownUserAgentError` or we can return None to explicitly
         # say that we opted not to parse this user agent. To determine which option we
-        # pick we'll match against a regex of UAs to ignore, if we match then we'll
-        # return a None to indicate to our caller that we couldn't parse this UA, but
-        # that it was an expected inability to parse. Otherwise we'll raise an
+        # pick we'll match against a regex of the UAs to ignore that IgnoredUserAgent
+        # can't find by their prefix, if we match then we'll return a None to
+        # indicate to our caller that we couldn't parse this UA, but that it was an
+        # expected inability to parse. Otherwise we'll raise an
         # `UnknownUserAgentError` to indicate that it as an unexpected inability to
         # parse.
         if _ignore_re.search(user_agent) is not None:
             return None
 
         raise UnknownUserAgentError from None
+
+    # IgnoredUserAgent found one of the UAs to ignore.
+    if parsed is _IGNORED:
+        return None
+    return _structure(parsed)
+
+
+def _instrumented_parse(user_agent, stats):
+    # The same as _parse, only timing the parts of it that aren't the parsers, which
+    # the ParserSet times for us.
+    try:
+        parsed = _parser(user_agent)
+    except UnableToParse:
+        start = time.perf_counter_ns()
+        ignored = _ignore_re.search(user_agent) is not None
+        stats.record("ignore_re", time.perf_counter_ns() - start)
+        if ignored:
+            return None
+        raise UnknownUserAgentError from None
+
+    if parsed is _IGNORED:
+        return None
+    start = time.perf_counter_ns()
+    try:
+        return _structure(parsed)
+    finally:
+        stats.record("structure", time.perf_counter_ns() - start)
+
+
+def enable_stats():
+    """
+    Starts recording how often, and how long, each of our parsers is tried, along
+    with the time spent on the ignore list and on structuring the result, and
+    returns the ParserStats that they're recorded in. Only user agents that miss
+    the cache are parsed, and so only those are recorded.
+    """
+    return _parser.enable_stats()
+
+
+def disable_stats():
+    _parser.disable_stats()
+
+
+def stats():
+    """Returns a snapshot of the recorded stats, or None if they're not enabled."""
+    return None if _parser.stats is None else _parser.stats.snapshot()
+
+
+# Stands in for an UnknownUserAgentError in our cache.
+_UNKNOWN = object()
+_MISSING = object()
+
+
+class UserAgentCache:
+    """
+    A least recently used cache of parsed user agents, keyed on the raw user agent.
+    A handful of exact pip and uv user agents make up most of our traffic, so most
+    lines can skip parsing their user agent entirely. Ignored and unknown user
+    agents are cached as well.
+
+    The cache is bounded both by the number of user agents in it, and by roughly how
+    much memory those user agents take up, since a user agent can be arbitrarily
+    long.
+
+    The cache can be shared between threads, though two threads that miss on the
+    same user agent at once will both parse it.
+    """
+
+    # Roughly what an entry costs us on top of its user agent, the cache entry
+    # itself and our share of a parsed UserAgent.
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, maxsize=4096, *, maxbytes=8 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._entries = LRUCache(maxsize, maxcost=maxbytes, cost=self._cost)
+
+    def _cost(self, user_agent, result):
+        return sys.getsizeof(user_agent) + self.ENTRY_OVERHEAD
+
+    def __call__(self, user_agent):
+        result = self._entries.get(user_agent, _MISSING)
+        if result is _MISSING:
+            # We parse without holding the lock, so that other threads don't have
+            # to wait on us to get at user agents that are already cached.
+            try:
+                result = _parse(user_agent)
+            except UnknownUserAgentError:
+                result = _UNKNOWN
+            self._entries.put(user_agent, result)
+
+        if result is _UNKNOWN:
+            raise UnknownUserAgentError
+        return result
+
+    @property
+    def nbytes(self):
+        return self._entries.total_cost
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    @property
+    def evictions(self):
+        return self._entries.evictions
+
+    @property
+    def hit_rate(self):
+        return self._entries.hit_rate
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+    def clear(self):
+        self._entries.clear()
+
+
+class UserAgentLimit:
+    """
+    Keeps user agents longer than max_length away from our parsers and our cache.
+    No installer sends one anywhere near that long, so one that is can only be junk,
+    and a long enough one would take our parsers a long while to get through.
+
+    With the "truncate" policy, only the first max_length characters of it are
+    parsed, which is enough for the formats that allow trailing junk. With the
+    "hash" policy, it's swapped for a short stand in, named after a hash of it,
+    which no parser recognizes, and so is reported as an unknown user agent.
+    """
+
+    POLICIES = ("truncate", "hash")
+
+    def __init__(self, max_length=4096, policy="truncate"):
+        self.max_length = max_length
+        self.policy = policy
+        self.overlong = 0
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @policy.setter
+    def policy(self, name):
+        if name not in self.POLICIES:
+            raise ValueError(
+                f"Unknown user agent length policy {name!r}, "
+                f"expected one of {', '.join(self.POLICIES)}."
+            )
+        self._policy = name
+
+    def take_overlong(self):
+        """
+        Returns how many overlong user agents we've seen since this was last called,
+        and starts counting over.
+        """
+        overlong, self.overlong = self.overlong, 0
+        return overlong
+
+    def __call__(self, user_agent):
+        if len(user_agent) <= self.max_length:
+            return user_agent
+
+        self.overlong += 1
+        if self._policy == "truncate":
+            return user_agent[: self.max_length]
+        digest = hashlib.blake2b(
+            user_agent.encode("utf8", "surrogatepass"), digest_size=16
+        ).hexdigest()
+        return f"(overlong user agent {digest})"
+
+
+cache = UserAgentCache()
+limit = UserAgentLimit()
+
+
+def parse(user_agent: str) -> UserAgent | None:
+    return cache(limit(user_agent))
@@ -0,0 +1,121 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Decoding of the JSON payloads that pip and uv put in their user agents.
+
+The stdlib backend decodes a payload into a dict and leaves it to be structured
+into a UserAgent later. If it's installed, msgspec can skip the dict entirely and
+decode straight into a UserAgent, in a single pass. Anything that msgspec won't
+handle exactly like the stdlib would is decoded by the stdlib instead, so the
+UserAgent we end up with is always the same.
+"""
+
+import json
+import typing
+
+from types import ModuleType
+
+import attr
+
+from linehaul.codegen import slot_constructor
+from linehaul.ua.datastructures import UserAgent
+from linehaul.ua.structuring import _optional
+
+msgspec: ModuleType | None
+try:
+    import msgspec  # type: ignore[import-not-found, no-redef]
+except ImportError:
+    msgspec = None
+
+
+def _stdlib_decode(payload):
+    return json.loads(payload)
+
+
+def _generate(cls, globs):
+    """
+    Generates a msgspec Struct with the same fields as the given attrs class (and
+    any attrs classes nested within it), along with a function that turns an
+    instance of that Struct into an instance of the attrs class.
+    """
+    name = f"_convert_{cls.__name__.lower()}"
+    if name in globs:
+        return globs[f"_{cls.__name__}Struct"], globs[name]
+
+    fields, values = [], []
+    for field in attr.fields(cls):
+        tp = _optional(field.type)
+        value = f"struct.{field.name}"
+        if attr.has(tp):
+            tp, nested = _generate(tp, globs)
+            value = f"None if {value} is None else {nested.__name__}({value})"
+        fields.append((field.name, typing.Optional[tp], None))
+        values.append((field.name, [], value))
+
+    struct = msgspec.defstruct(f"{cls.__name__}Struct", fields)
+    globs[f"_{cls.__name__}Struct"] = struct
+    return struct, slot_constructor(cls, name, ["struct"], values, globs=globs)
+
+
+def _msgspec_backend():
+    struct, convert = _generate(UserAgent, {})
+    decoder = msgspec.json.Decoder(struct)
+
+    def _msgspec_decode(payload):
+        try:
+            return convert(decoder.decode(payload))
+        except msgspec.MsgspecError:
+            # Either it's not valid JSON, or it is and it's not something that fits
+            # in a UserAgent as is (a number where we want a string, say, that cattrs
+            # would convert for us), either way the stdlib can sort it out.
+            return json.loads(payload)
+
+    return _msgspec_decode
+
+
+BACKENDS = {"stdlib": _stdlib_decode}
+if msgspec is not None:
+    BACKENDS["msgspec"] = _msgspec_backend()
+
+
+class PayloadDecoder:
+    """
+    Decodes a JSON payload with the selected backend, which defaults to the fastest
+    one that is installed. Returns either a UserAgent, or whatever json.loads would
+    have returned, and raises json.JSONDecodeError for anything that isn't JSON.
+    """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = "msgspec" if "msgspec" in BACKENDS else "stdlib"
+        self.backend = backend
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @backend.setter
+    def backend(self, name):
+        if name not in BACKENDS:
+            raise ValueError(
+                f"Unknown or unavailable JSON backend {name!r}, "
+                f"expected one of {', '.join(BACKENDS)}."
+            )
+        self._backend = name
+        self._decode = BACKENDS[name]
+
+    def __call__(self, payload):
+        return self._decode(payload)
+
+
+decoder = PayloadDecoder()
@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Ordering profiles for the user agent ParserSet.
+
+A ParserSet learns which of its parsers to try first as it goes, but a freshly
+started process hasn't learned anything yet. A profile is how many times each
+parser parsed a user agent in some corpus of logs, which a new process can load to
+start off in a good order. A profile is only as good as the logs that it was built
+from, so build one from a good sample of real logs with:
+
+    python -m linehaul.ua.profile path/to/log.gz ... > profile.json
+
+and point UA_PARSER_PROFILE at it.
+"""
+
+import gzip
+import json
+import sys
+
+from linehaul.events.parser import _grammar_message, _split_message
+from linehaul.ua.impl import ParserSet, UnableToParse
+from linehaul.ua.parser import _parser
+
+
+def build(user_agents, parsers=_parser):
+    """
+    Returns the profile of the given ParserSet over the given user agents. It only
+    counts which parser each user agent was parsed by, so the profile is the same
+    no matter what order the parsers happen to be in. Only the parsers that a
+    profile can reorder are in it, the ones registered first or last always stay
+    where they are.
+    """
+    counting = ParserSet(optimize_every=None)
+    for position, stage in [
+        ("first", parsers._first),
+        (None, parsers._parsers),
+        ("last", parsers._last),
+    ]:
+        for parser in stage:
+            counting.register(parser, position=position, _randomize=False)
+
+    for user_agent in user_agents:
+        try:
+            counting(user_agent)
+        except UnableToParse:
+            pass
+    reorderable = {parser.name for parser in parsers._parsers}
+    return {
+        name: count
+        for name, count in counting.export_profile().items()
+        if name in reorderable
+    }
+
+
+def dump(profile, fp):
+    json.dump({"counts": dict(sorted(profile.items()))}, fp, indent=2)
+    fp.write("\n")
+
+
+def load(fp, parsers=_parser):
+    parsers.load_profile(json.load(fp)["counts"])
+
+
+def _log_user_agents(paths):
+    for path in paths:
+        with gzip.open(path, "rb") as fp:
+            for line in fp:
+                # The same as the events parser would, we skip any line that we can't
+                # decode the user agent of.
+                try:
+                    parsed = _split_message(line)
+                    if parsed is None:
+                        parsed = _grammar_message(line.decode("utf8"))
+                    if parsed is not None:
+                        user_agent = parsed.user_agent
+                        if isinstance(user_agent, bytes):
+                            user_agent = user_agent.decode("utf8")
+                        yield user_agent
+                except UnicodeDecodeError:
+                    pass
+
+
+def main(paths):
+    dump(build(_log_user_agents(paths)), sys.stdout)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import typing
+
+import attr
+import cattr
+
+from linehaul.codegen import slot_constructor
+from linehaul.ua.datastructures import UserAgent
+
+
+class _Unexpected(Exception):
+    """
+    Raised by the generated structure functions for anything they weren't generated
+    to handle, in which case we leave it to cattrs.
+    """
+
+
+def _optional(tp):
+    args = [arg for arg in typing.get_args(tp) if arg is not type(None)]
+    return args[0] if typing.get_origin(tp) is typing.Union and len(args) == 1 else tp
+
+
+def _generate(cls, globs):
+    """
+    Generates the source of a function that structures a dict into the given attrs
+    class (and any attrs classes nested within it), which is only generated once per
+    class. Every field is optional, so an absent key or a None is left as None, and
+    any key we don't know about is ignored, just like cattrs would.
+
+    The generated functions only handle the values that JSON would give us for each
+    field, without any of the conversions that cattrs would do, such as turning a
+    number into a str, and raise _Unexpected for anything else.
+    """
+    name = f"_structure_{cls.__name__.lower()}"
+    if name in globs:
+        return name
+    globs[name] = None
+
+    fields = []
+    for field in attr.fields(cls):
+        tp = _optional(field.type)
+        lines = [f"    value = data.get({field.name!r})"]
+        if tp in {str, bool}:
+            lines += [
+                f"    if value is not None and type(value) is not {tp.__name__}:",
+                "        raise _Unexpected",
+            ]
+        elif typing.get_origin(tp) is list and typing.get_args(tp) == (str,):
+            lines += [
+                "    if value is not None:",
+                "        if type(value) is not list:",
+                "            raise _Unexpected",
+                "        for item in value:",
+                "            if type(item) is not str:",
+                "                raise _Unexpected",
+                "        value = list(value)",
+            ]
+        elif attr.has(tp):
+            nested = _generate(tp, globs)
+            lines += ["    if value is not None:", f"        value = {nested}(value)"]
+        else:
+            raise TypeError(f"Can't generate structuring for {cls.__name__}.{field}")
+        fields.append((field.name, lines, "value"))
+
+    prelude = ["    if type(data) is not dict:", "        raise _Unexpected"]
+    slot_constructor(cls, name, ["data"], fields, globs=globs, prelude=prelude)
+    return name
+
+
+def _compile(cls):
+    globs = {"_Unexpected": _Unexpected}
+    return globs[_generate(cls, globs)]
+
+
+_structure_user_agent = _compile(UserAgent)
+
+
+def structure_user_agent(data):
+    """
+    Structures the dict that a user agent parser returns into a UserAgent, giving
+    the same UserAgent that ``cattr.structure(data, UserAgent)`` would, only without
+    the overhead of the generic converter in the common case. Parsers that have
+    already decoded their user agent into a UserAgent can return it as is.
+    """
+    if type(data) is UserAgent:
+        return data
+    try:
+        return _structure_user_agent(data)
+    except _Unexpected:
+        return cattr.structure(data, UserAgent)
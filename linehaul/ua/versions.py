@@ -0,0 +1,66 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+
+from packaging.specifiers import SpecifierSet
+from packaging.version import InvalidVersion, Version
+
+from linehaul.cache import hit_rate
+
+
+# Stands in for an InvalidVersion in our cache.
+_INVALID = object()
+
+
+class VersionGate:
+    """
+    Whether or not a version string falls within a specifier, like ">=6". The
+    specifier is only parsed the once, and the answer for each distinct version
+    string is memoized with functools.lru_cache, since there are only so many
+    versions of pip or uv out there, and we see the same handful over and over.
+
+    Like ``version in SpecifierSet(...)``, an invalid version raises InvalidVersion.
+    A VersionGate can be shared between threads.
+    """
+
+    def __init__(self, specifier, *, prereleases=True, maxsize=1024):
+        self.specifier = SpecifierSet(specifier, prereleases=prereleases)
+        self._check = functools.lru_cache(maxsize=maxsize)(self._uncached_check)
+
+    def _uncached_check(self, version):
+        try:
+            return Version(version) in self.specifier
+        except InvalidVersion:
+            return _INVALID
+
+    def __contains__(self, version):
+        result = self._check(version)
+        if result is _INVALID:
+            raise InvalidVersion(f"Invalid version: {version!r}")
+        return result
+
+    @property
+    def hits(self):
+        return self._check.cache_info().hits
+
+    @property
+    def misses(self):
+        return self._check.cache_info().misses
+
+    @property
+    def hit_rate(self):
+        info = self._check.cache_info()
+        return hit_rate(info.hits, info.misses)
+
+    def clear(self):
+        self._check.cache_clear()
@@ -1,16 +1,33 @@
 import cattr
 
 import datetime
+import io
 import os
-import json
 import gzip
+import itertools
+import queue
 import zlib
 import shlex
+import threading
 
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
 from contextlib import ExitStack
 
-from linehaul.events.parser import parse, Download, Simple
+from linehaul.cache import hit_rate
+from linehaul.events import timestamps
+from linehaul.events.batch import DetailsCache, EventBatch, parse_many
+from linehaul.events.parser import (
+    Download,
+    Simple,
+    SuffixCache,
+    strings,
+    urls,
+)
+from linehaul.logging import EventLimiter
+from linehaul.ua import parser as user_agents, payloads, profile
+from linehaul.ua.impl import errors as parse_errors
 from linehaul.ua.datastructures import Installer
 
 from cattr.gen import make_dict_unstructure_fn, override
@@ -20,13 +37,21 @@ from google.api_core import exceptions
 from google.api_core.retry import Retry
 from google.cloud import bigquery, storage, pubsub_v1
 
+# How many Sentry events, and how many breadcrumbs, of the same kind to send on per
+# minute, so that an error that shows up on every line of a log can't flood Sentry.
+SENTRY_EVENTS_PER_MINUTE = int(os.environ.get("SENTRY_EVENTS_PER_MINUTE", "10"))
+sentry_limiter = EventLimiter(SENTRY_EVENTS_PER_MINUTE)
+
 if dsn := os.environ.get("SENTRY_DSN"):
-    sentry_sdk.init(dsn=dsn, enable_tracing=True)
+    sentry_sdk.init(
+        dsn=dsn,
+        enable_tracing=True,
+        before_send=sentry_limiter.before_send,
+        before_breadcrumb=sentry_limiter.before_breadcrumb,
+    )
 
 _cattr = cattr.Converter()
-_cattr.register_unstructure_hook(
-    datetime.datetime, lambda o: o.strftime("%Y-%m-%d %H:%M:%S +00:00")
-)
+_cattr.register_unstructure_hook(datetime.datetime, timestamps.codec.format)
 
 
 def _unstructure_subcommand(subcommand: list[str] | None) -> str | None:
@@ -57,10 +82,239 @@ DOWNLOAD_TABLE = os.environ.get("BIGQUERY_DOWNLOAD_TABLE")
 MAX_BLOBS_PER_RUN = int(
     os.environ.get("MAX_BLOBS_PER_RUN", "1000")
 )  # Cannot exceed 10,000 per load, or 1,000 per batch call to delete blobs
+# How many distinct lines (ignoring their timestamp) to remember the parse of, 0
+# turns the cache off entirely.
+SUFFIX_CACHE_SIZE = int(os.environ.get("SUFFIX_CACHE_SIZE", "8192"))
+suffixes = SuffixCache(maxsize=SUFFIX_CACHE_SIZE) if SUFFIX_CACHE_SIZE else None
+# How many bytes of the compressed log to fetch from GCS at a time, streaming it
+# through the decompressor and the parser as it arrives, with the next chunk being
+# fetched while the last one is parsed. 0 downloads the whole log to a temporary file
+# before processing any of it instead.
+LOG_STREAM_CHUNK_SIZE = int(os.environ.get("LOG_STREAM_CHUNK_SIZE", str(8 << 20)))
+# How many lines to parse into each EventBatch.
+PARSE_BATCH_SIZE = 10000
+# When set, parse that many batches at once on a pool of threads, which only pays
+# off on a free-threaded build of Python. The batches are still written out in the
+# order that they were read.
+PARSE_THREADS = int(os.environ.get("PARSE_THREADS", "0"))
+_parse_executor = (
+    ThreadPoolExecutor(PARSE_THREADS, thread_name_prefix="parse")
+    if PARSE_THREADS
+    else None
+)
+# A SuffixCache can't be shared between threads, so each parse thread gets its own.
+_thread_state = threading.local()
+_thread_suffixes = []
+# The serialized details of the user agents that we've seen recently.
+details = DetailsCache()
+# How to decode the JSON in pip and uv user agents, msgspec if it's installed and
+# otherwise the stdlib, unless one of them is picked explicitly.
+if UA_JSON_BACKEND := os.environ.get("UA_JSON_BACKEND"):
+    payloads.decoder.backend = UA_JSON_BACKEND
+# How long a user agent can get before we stop parsing it as is, and what to do with
+# the ones that are longer, either "truncate" them or "hash" them, see
+# linehaul.ua.parser.UserAgentLimit.
+user_agents.limit.max_length = int(os.environ.get("UA_MAX_LENGTH", "4096"))
+user_agents.limit.policy = os.environ.get("UA_LENGTH_POLICY", "truncate")
+# Where to load the ordering profile for our user agent parsers from, either a path
+# or a gs://bucket/name URL, so that a fresh instance doesn't start with them in a
+# random order, see linehaul.ua.profile. Unset or empty skips loading a profile.
+UA_PARSER_PROFILE = os.environ.get("UA_PARSER_PROFILE", "")
+
+
+def _load_parser_profile(location):
+    try:
+        if location.startswith("gs://"):
+            bucket, _, name = location[len("gs://") :].partition("/")
+            blob = storage.Client().bucket(bucket).blob(name)
+            fp = io.StringIO(blob.download_as_text())
+        else:
+            fp = open(location)
+        with fp:
+            profile.load(fp)
+    except Exception as exc:
+        # Not having a profile only costs us some speed, so it's no reason to fail.
+        print(f"Could not load user agent parser profile {location}: {exc!r}")
+
+
+if UA_PARSER_PROFILE:
+    _load_parser_profile(UA_PARSER_PROFILE)
+# When set, record how much time each of our user agent parsers takes, and print
+# it after processing each log.
+UA_PARSER_STATS = bool(os.environ.get("UA_PARSER_STATS"))
+if UA_PARSER_STATS:
+    user_agents.enable_stats()
+else:
+    user_agents.disable_stats()
+
+# When set, print how well each of our caches did after processing each log.
+CACHE_STATS = bool(os.environ.get("CACHE_STATS"))
+
+
+def _cache_counts():
+    """
+    Returns how many hits and how many misses each of our caches, and each of our
+    string intern tables, has had so far. Our caches outlive any one log, so what
+    they did for a log is the difference between these from before and after it.
+    """
+    suffix_caches = _thread_suffixes if _parse_executor else [suffixes]
+    suffix_caches = [cache for cache in suffix_caches if cache is not None]
+
+    counts = {"Timestamp cache": (timestamps.codec.hits, timestamps.codec.misses)}
+    if suffix_caches:
+        counts["Suffix cache"] = (
+            sum(cache.hits for cache in suffix_caches),
+            sum(cache.misses for cache in suffix_caches),
+        )
+    counts["URL cache"] = (urls.lookups - urls.misses, urls.misses)
+    counts["User agent cache"] = (user_agents.cache.hits, user_agents.cache.misses)
+    counts["User agent details cache"] = (details.hits, details.misses)
+
+    dedup = {
+        field: (stats["lookups"] - stats["unique"], stats["unique"])
+        for field, stats in strings.stats().items()
+    }
+    return counts, dedup
+
+
+def _hit_rates_since(before, after):
+    rates = {}
+    for name, (hits, misses) in after.items():
+        # A cache that didn't exist yet (like a new thread's) started from nothing.
+        hits_before, misses_before = before.get(name, (0, 0))
+        rates[name] = hit_rate(hits - hits_before, misses - misses_before)
+    return rates
+
 
 prefix = {Simple.__name__: "simple_requests", Download.__name__: "file_downloads"}
 
 
+class _ReadAhead(io.RawIOBase):
+    """
+    Reads a file in chunks of chunk_size bytes on a background thread, keeping up to
+    depth chunks ahead of whoever is reading from us, so that waiting on the next
+    chunk overlaps with working through the last one.
+    """
+
+    def __init__(self, fp, chunk_size, depth=2):
+        self._chunks = queue.Queue(depth)
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._fill, args=(fp, chunk_size), name="read-ahead", daemon=True
+        )
+        self._thread.start()
+
+    def _fill(self, fp, chunk_size):
+        try:
+            while not self._stop.is_set():
+                chunk = fp.read(chunk_size)
+                # An empty chunk tells the reader that this is the end of the file.
+                self._put(chunk)
+                if not chunk:
+                    return
+        except BaseException as exc:
+            self._put(exc)
+
+    def _put(self, item):
+        # Don't wait forever on a reader that has stopped reading.
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._buffer:
+            if self._eof:
+                return 0
+            chunk = self._chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                self._eof = True
+                return 0
+            self._buffer = memoryview(chunk)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        super().close()
+
+
+def _open_log(stack, blob):
+    """
+    Opens the given (gzipped) log blob for reading its decompressed lines, which is
+    closed along with the given ExitStack.
+    """
+    if LOG_STREAM_CHUNK_SIZE:
+        # GzipFile decompresses as it reads, so that we can start parsing as soon as
+        # the first chunk arrives, without ever having all of the log on hand.
+        fp = stack.enter_context(blob.open("rb", chunk_size=LOG_STREAM_CHUNK_SIZE))
+        fp = stack.enter_context(_ReadAhead(fp, LOG_STREAM_CHUNK_SIZE))
+        return stack.enter_context(gzip.GzipFile(fileobj=fp, mode="rb"))
+
+    input_file_obj = stack.enter_context(NamedTemporaryFile())
+    blob.download_to_file(input_file_obj)
+    input_file_obj.flush()
+    return stack.enter_context(gzip.open(input_file_obj.name, "rb"))
+
+
+def _parse_batch(lines, suffixes):
+    try:
+        return parse_many(lines, suffixes=suffixes)
+    except Exception:
+        # Something in this batch tripped us up, go back over it a line at a time
+        # so that only the lines that we can't parse end up unprocessed.
+        batch = EventBatch()
+        for line in lines:
+            try:
+                batch.append(line, suffixes=suffixes)
+            except Exception:
+                batch.unprocessed.append(line)
+        return batch
+
+
+def _parse_batch_in_thread(lines):
+    try:
+        thread_suffixes = _thread_state.suffixes
+    except AttributeError:
+        thread_suffixes = _thread_state.suffixes = (
+            SuffixCache(maxsize=SUFFIX_CACHE_SIZE) if SUFFIX_CACHE_SIZE else None
+        )
+        if thread_suffixes is not None:
+            _thread_suffixes.append(thread_suffixes)
+    return _parse_batch(lines, thread_suffixes)
+
+
+def _parse_batches(input_file):
+    chunks = iter(lambda: list(itertools.islice(input_file, PARSE_BATCH_SIZE)), [])
+
+    if _parse_executor is None:
+        for lines in chunks:
+            yield _parse_batch(lines, suffixes)
+        return
+
+    # Keep every thread busy, with a batch waiting behind each, but read no further
+    # ahead than that so that we don't end up with the whole log in memory.
+    pending = deque()
+    for lines in chunks:
+        pending.append(_parse_executor.submit(_parse_batch_in_thread, lines))
+        if len(pending) >= 2 * PARSE_THREADS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 @serverless_function
 def process_fastly_log(data, context):
     storage_client = storage.Client()
@@ -75,43 +329,28 @@ def process_fastly_log(data, context):
     unprocessed_lines = 0
     simple_lines = 0
     download_lines = 0
+    reasons = Counter()
+    cache_counts = _cache_counts() if CACHE_STATS else None
 
     with ExitStack() as stack:
-        input_file_obj = stack.enter_context(NamedTemporaryFile())
-        bob_logs_log_blob.download_to_file(input_file_obj)
-        input_file_obj.flush()
-
-        input_file = stack.enter_context(gzip.open(input_file_obj.name, "rb"))
+        input_file = _open_log(stack, bob_logs_log_blob)
         unprocessed_file = stack.enter_context(NamedTemporaryFile())
         simple_results_file = stack.enter_context(NamedTemporaryFile())
         download_results_file = stack.enter_context(NamedTemporaryFile())
 
         min_timestamp = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
         try:
-            for line in input_file:
-                try:
-                    res = parse(line.decode())
-                    min_timestamp = min(min_timestamp, res.timestamp)
-                    if res is not None:
-                        if res.__class__.__name__ == Simple.__name__:
-                            simple_results_file.write(
-                                json.dumps(_cattr.unstructure(res)).encode() + b"\n"
-                            )
-                            simple_lines += 1
-                        elif res.__class__.__name__ == Download.__name__:
-                            download_results_file.write(
-                                json.dumps(_cattr.unstructure(res)).encode() + b"\n"
-                            )
-                            download_lines += 1
-                        else:
-                            unprocessed_file.write(line)
-                            unprocessed_lines += 1
-                    else:
-                        unprocessed_file.write(line)
-                        unprocessed_lines += 1
-                except Exception:
-                    unprocessed_file.write(line)
-                    unprocessed_lines += 1
+            for batch in _parse_batches(input_file):
+                reasons.update(batch.reasons)
+                if batch:
+                    min_timestamp = min(min_timestamp, batch.min_timestamp)
+                simple_lines += batch.write_ndjson(
+                    simple_results_file, Simple, _cattr.unstructure, details=details
+                )
+                download_lines += batch.write_ndjson(
+                    download_results_file, Download, _cattr.unstructure, details=details
+                )
+                unprocessed_lines += batch.write_unprocessed(unprocessed_file)
         except (gzip.BadGzipFile, EOFError, zlib.error) as exc:
             print(
                 f"Skipping malformed gzip gs://{data['bucket']}/{data['name']}: "
@@ -127,6 +366,41 @@ def process_fastly_log(data, context):
         print(
             f"Processed gs://{data['bucket']}/{data['name']}: {total} lines, {simple_lines} simple_requests, {download_lines} file_downloads, {unprocessed_lines} unprocessed"
         )
+        if reasons:
+            print(
+                "Parse reasons: "
+                + ", ".join(
+                    f"{reason.value}={count}"
+                    for reason, count in reasons.most_common()
+                )
+            )
+        if cache_counts is not None:
+            before, before_dedup = cache_counts
+            after, after_dedup = _cache_counts()
+            for name, rate in _hit_rates_since(before, after).items():
+                print(f"{name} hit rate: {rate:.2%}")
+            print(
+                "String dedup ratios: "
+                + ", ".join(
+                    f"{field}={rate:.2%}"
+                    for field, rate in _hit_rates_since(
+                        before_dedup, after_dedup
+                    ).items()
+                )
+            )
+        if (parser_stats := user_agents._parser.stats) is not None:
+            print("User agent parser stats:\n" + parser_stats.format())
+            parser_stats.clear()
+        # Summarize whatever parse errors we held back while processing this log. A
+        # warm instance processes many logs, so these only count this one.
+        parse_errors.flush()
+        errors, suppressed = parse_errors.take_counts()
+        if errors:
+            print(f"User agent parse errors: {errors} ({suppressed} suppressed)")
+        if overlong := user_agents.limit.take_overlong():
+            print(f"Overlong user agents: {overlong}")
+        if dropped := sentry_limiter.take_dropped():
+            print(f"Sentry events dropped: {dropped}")
 
         bucket = storage_client.bucket(RESULT_BUCKET)
         partition = min_timestamp.strftime("%Y%m%d")
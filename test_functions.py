@@ -1,5 +1,6 @@
 import contextlib
 import datetime
+import io
 from importlib import reload
 from pathlib import Path
 
@@ -17,10 +18,10 @@ RESULT_BUCKET = "my-result-bucket"
     [
         (
             "downloads-2021-01-07-20-55-2021-01-07T20-55-00.000-B8Hs_G6d6xN61En2ypwk.log.gz",
-            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/f7/12/ec3f2e203afa394a149911729357aa48affc59c20e2c1c8297a60f33f133/threadpoolctl-2.1.0-py3-none-any.whl", "project": "threadpoolctl", "file": {"filename": "threadpoolctl-2.1.0-py3-none-any.whl", "project": "threadpoolctl", "version": "2.1.0", "type": "bdist_wheel"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "pip", "version": "20.1.1", "subcommand": null}, "python": "3.7.9", "implementation": {"name": "CPython", "version": "3.7.9"}, "distro": {"name": "Debian GNU/Linux", "version": "9", "id": "stretch", "libc": {"lib": "glibc", "version": "2.24"}}, "system": {"name": "Linux", "release": "4.15.0-112-generic"}, "cpu": "x86_64", "openssl_version": "OpenSSL 1.1.0l  10 Sep 2019", "setuptools_version": "47.1.0", "rustc_version": null, "ci": null}}\n'
-            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/cd/f9/8fad70a3bd011a6be7c5c6067278f006a25341eb39d901fbda307e26804c/django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "file": {"filename": "django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "version": "0.7.9", "type": "bdist_wheel"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "pip", "version": "20.0.2", "subcommand": ""}, "python": "3.8.5", "implementation": {"name": "CPython", "version": "3.8.5"}, "distro": {"name": "Ubuntu", "version": "16.04", "id": "xenial", "libc": {"lib": "glibc", "version": "2.23"}}, "system": {"name": "Linux", "release": "4.4.0-1113-aws"}, "cpu": "x86_64", "openssl_version": "OpenSSL 1.0.2g  1 Mar 2016", "setuptools_version": "44.1.0", "rustc_version": null, "ci": null}}\n'
-            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/cd/f9/8fad70a3bd011a6be7c5c6067278f006a25341eb39d901fbda307e26804c/django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "file": {"filename": "django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "version": "0.7.9", "type": "bdist_wheel"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "pip", "version": "22.0.3", "subcommand": "install \'something with a space\'"}, "python": "3.9.10", "implementation": {"name": "CPython", "version": "3.9.10"}, "distro": {"name": "macOS", "version": "12.3", "id": null, "libc": null}, "system": {"name": "Darwin", "release": "21.4.0"}, "cpu": "arm64", "openssl_version": "OpenSSL 1.1.1m  14 Dec 2021", "setuptools_version": "60.9.0", "rustc_version": "1.59.0", "ci": true}}\n'
-            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/cd/f9/8fad70a3bd011a6be7c5c6067278f006a25341eb39d901fbda307e26804c/django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "file": {"filename": "django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "version": "0.7.9", "type": "bdist_wheel"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "uv", "version": "0.9.11", "subcommand": "pip install"}, "python": "3.9.10", "implementation": {"name": "CPython", "version": "3.9.10"}, "distro": {"name": "macOS", "version": "12.3", "id": null, "libc": null}, "system": {"name": "Darwin", "release": "21.4.0"}, "cpu": "arm64", "openssl_version": "OpenSSL 1.1.1m  14 Dec 2021", "setuptools_version": "60.9.0", "rustc_version": "1.59.0", "ci": true}}\n',
+            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/f7/12/ec3f2e203afa394a149911729357aa48affc59c20e2c1c8297a60f33f133/threadpoolctl-2.1.0-py3-none-any.whl", "project": "threadpoolctl", "file": {"filename": "threadpoolctl-2.1.0-py3-none-any.whl", "project": "threadpoolctl", "version": "2.1.0", "type": "bdist_wheel", "normalized_project": "threadpoolctl", "python_tag": "py3", "abi_tag": "none", "platform_tag": "any"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "pip", "version": "20.1.1", "subcommand": null}, "python": "3.7.9", "implementation": {"name": "CPython", "version": "3.7.9"}, "distro": {"name": "Debian GNU/Linux", "version": "9", "id": "stretch", "libc": {"lib": "glibc", "version": "2.24"}}, "system": {"name": "Linux", "release": "4.15.0-112-generic"}, "cpu": "x86_64", "openssl_version": "OpenSSL 1.1.0l  10 Sep 2019", "setuptools_version": "47.1.0", "rustc_version": null, "ci": null}}\n'
+            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/cd/f9/8fad70a3bd011a6be7c5c6067278f006a25341eb39d901fbda307e26804c/django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "file": {"filename": "django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "version": "0.7.9", "type": "bdist_wheel", "normalized_project": "django-crum", "python_tag": "py2.py3", "abi_tag": "none", "platform_tag": "any"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "pip", "version": "20.0.2", "subcommand": ""}, "python": "3.8.5", "implementation": {"name": "CPython", "version": "3.8.5"}, "distro": {"name": "Ubuntu", "version": "16.04", "id": "xenial", "libc": {"lib": "glibc", "version": "2.23"}}, "system": {"name": "Linux", "release": "4.4.0-1113-aws"}, "cpu": "x86_64", "openssl_version": "OpenSSL 1.0.2g  1 Mar 2016", "setuptools_version": "44.1.0", "rustc_version": null, "ci": null}}\n'
+            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/cd/f9/8fad70a3bd011a6be7c5c6067278f006a25341eb39d901fbda307e26804c/django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "file": {"filename": "django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "version": "0.7.9", "type": "bdist_wheel", "normalized_project": "django-crum", "python_tag": "py2.py3", "abi_tag": "none", "platform_tag": "any"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "pip", "version": "22.0.3", "subcommand": "install \'something with a space\'"}, "python": "3.9.10", "implementation": {"name": "CPython", "version": "3.9.10"}, "distro": {"name": "macOS", "version": "12.3", "id": null, "libc": null}, "system": {"name": "Darwin", "release": "21.4.0"}, "cpu": "arm64", "openssl_version": "OpenSSL 1.1.1m  14 Dec 2021", "setuptools_version": "60.9.0", "rustc_version": "1.59.0", "ci": true}}\n'
+            b'{"timestamp": "2021-01-07 20:54:54 +00:00", "url": "/packages/cd/f9/8fad70a3bd011a6be7c5c6067278f006a25341eb39d901fbda307e26804c/django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "file": {"filename": "django_crum-0.7.9-py2.py3-none-any.whl", "project": "django-crum", "version": "0.7.9", "type": "bdist_wheel", "normalized_project": "django-crum", "python_tag": "py2.py3", "abi_tag": "none", "platform_tag": "any"}, "tls_protocol": "TLSv1.2", "tls_cipher": "ECDHE-RSA-AES128-GCM-SHA256", "country_code": "US", "details": {"installer": {"name": "uv", "version": "0.9.11", "subcommand": "pip install"}, "python": "3.9.10", "implementation": {"name": "CPython", "version": "3.9.10"}, "distro": {"name": "macOS", "version": "12.3", "id": null, "libc": null}, "system": {"name": "Darwin", "release": "21.4.0"}, "cpu": "arm64", "openssl_version": "OpenSSL 1.1.1m  14 Dec 2021", "setuptools_version": "60.9.0", "rustc_version": "1.59.0", "ci": true}}\n',
             b"download|Thu, 07 Jan 2021 20:54:56 GMT|US|/packages/c5/db/e56e6b4bbac7c4a06de1c50de6fe1ef3810018ae11732a50f15f62c7d050/enum34-1.1.6-py2-none-any.whl|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|enum34|1.1.6|bdist_wheel|(null)\n",
             "unprocessed/20210107/downloads-2021-01-07-20-55-2021-01-07T20-55-00.000-B8Hs_G6d6xN61En2ypwk.txt",
             "processed/20210107/downloads-downloads-2021-01-07-20-55-2021-01-07T20-55-00.000-B8Hs_G6d6xN61En2ypwk.json",
@@ -35,8 +36,13 @@ RESULT_BUCKET = "my-result-bucket"
         ),
     ],
 )
+@pytest.mark.parametrize("threads", ["0", "2"])
+@pytest.mark.parametrize("stream_chunk_size", ["0", "1024"])
 def test_process_fastly_log(
     monkeypatch,
+    capsys,
+    threads,
+    stream_chunk_size,
     log_filename,
     expected_data,
     expected_unprocessed,
@@ -45,6 +51,8 @@ def test_process_fastly_log(
 ):
     monkeypatch.setenv("GCP_PROJECT", GCP_PROJECT)
     monkeypatch.setenv("RESULT_BUCKET", RESULT_BUCKET)
+    monkeypatch.setenv("PARSE_THREADS", threads)
+    monkeypatch.setenv("LOG_STREAM_CHUNK_SIZE", stream_chunk_size)
 
     reload(main)
 
@@ -52,8 +60,13 @@ def test_process_fastly_log(
         with open(Path(".") / "fixtures" / log_filename, "rb") as f:
             file_handler.write(f.read())
 
+    def _open(mode, chunk_size=None):
+        assert (mode, chunk_size) == ("rb", int(stream_chunk_size))
+        return open(Path(".") / "fixtures" / log_filename, "rb")
+
     get_blob_stub = pretend.stub(
         download_to_file=_download_to_file,
+        open=_open,
         delete=pretend.call_recorder(lambda: None),
     )
 
@@ -100,11 +113,66 @@ def test_process_fastly_log(
     assert get_blob_stub.delete.calls == [pretend.call()]
     assert blobs[expected_data_filename].data == expected_data
     assert blobs[expected_unprocessed_filename].data == expected_unprocessed
+    out = capsys.readouterr().out
+    assert "Parse reasons: ignored_user_agent=1\n" in out
+    assert "hit rate" not in out
+
+
+def test_process_fastly_log_cache_stats(monkeypatch, capsys):
+    monkeypatch.setenv("GCP_PROJECT", GCP_PROJECT)
+    monkeypatch.setenv("RESULT_BUCKET", RESULT_BUCKET)
+    monkeypatch.setenv("CACHE_STATS", "1")
+    # Otherwise the second log would never get past the suffix cache.
+    monkeypatch.setenv("SUFFIX_CACHE_SIZE", "0")
+
+    reload(main)
+
+    log_filename = (
+        "simple-2021-01-07-20-55-2021-01-07T20-55-00.000-3wuB00t9tqgbGLFI2fSI.log.gz"
+    )
+    get_blob_stub = pretend.stub(
+        open=lambda mode, chunk_size=None: open(
+            Path(".") / "fixtures" / log_filename, "rb"
+        ),
+        delete=lambda: None,
+    )
+    bucket_stub = pretend.stub(
+        get_blob=lambda a: get_blob_stub,
+        blob=lambda a: pretend.stub(upload_from_file=lambda fp, rewind=False: None),
+    )
+    monkeypatch.setattr(
+        main,
+        "storage",
+        pretend.stub(Client=lambda: pretend.stub(bucket=lambda a: bucket_stub)),
+    )
+
+    data = {"name": log_filename, "bucket": "my-bucket"}
+    main.process_fastly_log(data, pretend.stub())
+    capsys.readouterr()
+    main.process_fastly_log(data, pretend.stub())
 
+    # Everything in the second log was seen in the first one, and the stats only
+    # count the second one.
+    out = capsys.readouterr().out
+    assert "Timestamp cache hit rate: 100.00%\n" in out
+    assert "URL cache hit rate: 100.00%\n" in out
+    assert "User agent cache hit rate: 100.00%\n" in out
+    assert "Suffix cache" not in out
+    assert "String dedup ratios: country_code=100.00%, " in out
 
-def test_process_fastly_log_deletes_malformed_gzip(monkeypatch):
+
+def test_hit_rates_since():
+    before = {"seen": (1, 1)}
+    after = {"seen": (4, 2), "new": (1, 3)}
+
+    assert main._hit_rates_since(before, after) == {"seen": 0.75, "new": 0.25}
+
+
+@pytest.mark.parametrize("stream_chunk_size", ["0", "4"])
+def test_process_fastly_log_deletes_malformed_gzip(monkeypatch, stream_chunk_size):
     monkeypatch.setenv("GCP_PROJECT", GCP_PROJECT)
     monkeypatch.setenv("RESULT_BUCKET", RESULT_BUCKET)
+    monkeypatch.setenv("LOG_STREAM_CHUNK_SIZE", stream_chunk_size)
 
     reload(main)
 
@@ -113,6 +181,7 @@ def test_process_fastly_log_deletes_malformed_gzip(monkeypatch):
 
     get_blob_stub = pretend.stub(
         download_to_file=_download_to_file,
+        open=lambda mode, chunk_size=None: io.BytesIO(b"not gzip data"),
         delete=pretend.call_recorder(lambda: None),
     )
 
@@ -139,6 +208,70 @@ def test_process_fastly_log_deletes_malformed_gzip(monkeypatch):
     assert get_blob_stub.delete.calls == [pretend.call()]
 
 
+def test_read_ahead():
+    data = bytes(range(256)) * 64
+    with main._ReadAhead(io.BytesIO(data), chunk_size=1000) as fp:
+        assert fp.read(10) == data[:10]
+        assert fp.read() == data[10:]
+        assert fp.read() == b""
+
+
+def test_read_ahead_error():
+    class Broken(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise OSError("connection reset")
+            return super().read(size)
+
+    with main._ReadAhead(Broken(b"x" * 100), chunk_size=10) as fp:
+        assert fp.read(10) == b"x" * 10
+        with pytest.raises(OSError, match="connection reset"):
+            fp.read(10)
+
+
+def test_read_ahead_closed_early():
+    # Closing has to stop the thread, even while it's waiting to hand off a chunk.
+    fp = main._ReadAhead(io.BytesIO(b"x" * 1000), chunk_size=1, depth=1)
+    assert fp.read(1) == b"x"
+    fp.close()
+    assert not fp._thread.is_alive()
+
+
+def test_load_parser_profile_from_gcs(monkeypatch, capsys):
+    # Loading a profile reorders the parsers of the whole process, so put them back
+    # the way they were afterwards, for the tests that come after this one.
+    parsers = main.user_agents._parser
+    monkeypatch.setattr(parsers, "_parsers", parsers._parsers)
+    monkeypatch.setattr(parsers, "_counts", parsers._counts.copy())
+    monkeypatch.setattr(parsers, "_candidates", parsers._candidates)
+
+    blob_stub = pretend.stub(
+        download_as_text=lambda: '{"counts": {"BandersnatchUserAgent": 10000000}}'
+    )
+    bucket_stub = pretend.stub(blob=pretend.call_recorder(lambda a: blob_stub))
+    storage_client_stub = pretend.stub(
+        bucket=pretend.call_recorder(lambda a: bucket_stub),
+    )
+    monkeypatch.setattr(
+        main, "storage", pretend.stub(Client=lambda: storage_client_stub)
+    )
+
+    main._load_parser_profile("gs://my-bucket/profiles/ua.json")
+
+    assert storage_client_stub.bucket.calls == [pretend.call("my-bucket")]
+    assert bucket_stub.blob.calls == [pretend.call("profiles/ua.json")]
+    assert main.user_agents._parser._parsers[0].name == "BandersnatchUserAgent"
+    assert capsys.readouterr().out == ""
+
+
+def test_load_parser_profile_missing(capsys):
+    main._load_parser_profile("/does/not/exist.json")
+
+    assert capsys.readouterr().out.startswith(
+        "Could not load user agent parser profile /does/not/exist.json: "
+    )
+
+
 GCP_PROJECT = "my-gcp-project"
 BIGQUERY_DATASET = "my-bigquery-dataset"
 BIGQUERY_SIMPLE_TABLE = "my-simple-table"
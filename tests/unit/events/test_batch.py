@@ -0,0 +1,160 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+
+from datetime import datetime
+
+import cattr
+import pytest
+
+from linehaul.events import parser, timestamps
+from linehaul.events.batch import DetailsCache, parse_many
+
+
+DOWNLOAD = (
+    b"download|Fri, 20 Jul 2018 02:19:%d GMT|JP|/packages/aa/bb/cfn_flip-1.0.3"
+    b"-py3-none-any.whl|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3"
+    b'|bdist_wheel|pip/20.0.2 {"cpu":"x86_64","implementation":{"name":"CPython",'
+    b'"version":"3.8.5"},"installer":{"name":"pip","version":"20.0.2",'
+    b'"subcommand":["install"]},"python":"3.8.5"}\n'
+)
+SIMPLE = (
+    b"simple|Fri, 20 Jul 2018 02:19:%d GMT|US|/simple/%s/|TLSv1.3|AES256-GCM"
+    b"||||bandersnatch/2.2.1 (cpython 3.7.0-final0, Darwin x86_64)\n"
+)
+IGNORED = (
+    b"simple|Fri, 20 Jul 2018 02:19:19 GMT|US|/simple/foo/|TLSv1.3|AES256-GCM"
+    b"||||(null)\n"
+)
+
+LINES = [
+    DOWNLOAD % 19,
+    SIMPLE % (19, b"foo"),
+    DOWNLOAD % 20,
+    IGNORED,
+    b"not a log line",
+    SIMPLE % (18, b"bar"),
+    DOWNLOAD % 19,
+]
+
+
+_cattr = cattr.Converter()
+_cattr.register_unstructure_hook(datetime, timestamps.codec.format)
+
+
+@pytest.fixture(params=[True, False], ids=["suffixes", "no-suffixes"])
+def suffixes(request):
+    return parser.SuffixCache() if request.param else None
+
+
+def test_events(suffixes):
+    batch = parse_many(LINES, suffixes=suffixes)
+    expected = [parser.try_parse(line)[0] for line in LINES]
+
+    assert list(batch.events()) == [event for event in expected if event is not None]
+    assert len(batch) == 5
+    assert batch.unprocessed == [IGNORED, b"not a log line"]
+    assert batch.reasons == {
+        parser.Reason.ignored_user_agent: 1,
+        parser.Reason.grammar_mismatch: 1,
+    }
+
+
+def test_dictionary_encoded():
+    batch = parse_many(LINES, suffixes=parser.SuffixCache())
+
+    assert len(batch.timestamp_values) == 3
+    assert len(batch.row_values) == 3
+    assert list(batch.rows) == [0, 1, 0, 2, 0]
+
+
+def test_columns():
+    batch = parse_many(LINES)
+
+    assert batch.column("timestamp") == [event.timestamp for event in batch.events()]
+    assert batch.column("project") == ["cfn-flip", "foo", "cfn-flip", "bar", "cfn-flip"]
+    assert batch.column("file.python_tag") == ["py3", None, "py3", None, "py3"]
+    assert batch.column("details.installer.name") == [
+        "pip",
+        "bandersnatch",
+        "pip",
+        "bandersnatch",
+        "pip",
+    ]
+    assert batch.column("nope") == [None] * 5
+
+
+def test_min_timestamp():
+    assert parse_many([]).min_timestamp is None
+    assert parse_many(LINES).min_timestamp == timestamps.parse_timestamp(
+        "Fri, 20 Jul 2018 02:19:18 GMT"
+    )
+
+
+@pytest.mark.parametrize("details", [True, False], ids=["details", "no-details"])
+@pytest.mark.parametrize("cls", [parser.Download, parser.Simple])
+def test_write_ndjson(suffixes, cls, details):
+    batch = parse_many(LINES, suffixes=suffixes)
+    fp = io.BytesIO()
+
+    written = batch.write_ndjson(
+        fp, cls, _cattr.unstructure, details=DetailsCache() if details else None
+    )
+
+    expected = [
+        json.dumps(_cattr.unstructure(event)).encode() + b"\n"
+        for event in batch.events()
+        if isinstance(event, cls)
+    ]
+    assert written == batch.count(cls) == len(expected)
+    assert fp.getvalue() == b"".join(expected)
+
+
+def test_write_unprocessed():
+    batch = parse_many([IGNORED, b"not a log line"])
+    fp = io.BytesIO()
+
+    assert batch.write_unprocessed(fp) == 2
+    assert fp.getvalue() == IGNORED + b"not a log line\n"
+
+
+def test_details_cache():
+    details = DetailsCache(maxsize=2)
+    # Two downloads of different files by the same user agent, which don't share a
+    # row, but do share their details.
+    batch = parse_many(
+        [DOWNLOAD % 19, DOWNLOAD.replace(b"1.0.3", b"1.0.4") % 19, IGNORED],
+        suffixes=parser.SuffixCache(),
+    )
+    assert len(batch.row_values) == 2
+
+    batch.write_ndjson(
+        io.BytesIO(), parser.Download, _cattr.unstructure, details=details
+    )
+    assert (details.hits, details.misses) == (1, 1)
+    assert details.hit_rate == 0.5
+    assert details(None, _cattr.unstructure) == "null"
+
+    details.clear()
+    assert (details.hits, details.misses, details.hit_rate) == (0, 0, 0.0)
+
+
+def test_details_cache_bounded():
+    details = DetailsCache(maxsize=1)
+    batch = parse_many([DOWNLOAD % 19, SIMPLE % (19, b"a")])
+    first, second = [event.details for event in batch.events()]
+    for ua in [first, second, first]:
+        details(ua, _cattr.unstructure)
+    assert details.misses == 3
+    assert list(details._entries) == [id(first)]
@@ -14,12 +14,20 @@ import inspect
 import os
 import os.path
 
+import pretend
 import pytest
 import yaml
 
 from hypothesis import given, strategies as st
 
-from linehaul.events.parser import Download, UnparseableEvent, parse, _cattr
+from linehaul.events import parser
+from linehaul.events.parser import (
+    Download,
+    PackageType,
+    UnparseableEvent,
+    parse,
+    _cattr,
+)
 
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
@@ -55,3 +63,482 @@ def test_download_parsing(event_data, expected):
 def test_invalid_event(data):
     with pytest.raises(UnparseableEvent):
         parse(data)
+
+
+@pytest.mark.parametrize(("event_data", "expected"), list(_load_event_fixtures(FIXTURE_DIR)))
+@pytest.mark.parametrize("wrapper", [bytes, bytearray, memoryview])
+def test_bytes_parsing(event_data, expected, wrapper):
+    event_data = wrapper((event_data + "\n").encode())
+    if inspect.isclass(expected) and issubclass(expected, Exception):
+        with pytest.raises(expected):
+            parse(event_data)
+    else:
+        assert parse(event_data) == expected
+
+
+@pytest.mark.parametrize(
+    "event_data",
+    [
+        # Invalid UTF-8 in the user agent, which the fast path will happily split.
+        b"download|Fri, 20 Jul 2018 02:19:19 GMT|JP|/packages/cfn_flip-1.0.3.tar.gz|"
+        b"TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|pip/\xff\n",
+        # Invalid UTF-8 before the user agent, which is left to the grammar.
+        b"download|Fri, 20 Jul 2018 02:19:19 GMT|J\xff|/packages/cfn_flip-1.0.3.tar.gz|"
+        b"TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|pip/1.0\n",
+    ],
+)
+def test_invalid_utf8(event_data):
+    with pytest.raises(UnparseableEvent):
+        parse(event_data)
+
+
+def _build_or_raise(parsed, **kwargs):
+    if parsed is None:
+        return None
+    try:
+        return parser._build_event(parsed, **kwargs)
+    except Exception as exc:
+        return type(exc)
+
+
+# Log lines are decoded from bytes, so they can't hold lone surrogates, which also
+# couldn't be encoded back into the bytes that we parse as well.
+_tricky_field = st.one_of(
+    st.sampled_from(["", " ", "(null)", "(null)x", "a@b", "sdistx", " US", "US "]),
+    st.text(
+        alphabet=st.characters(
+            blacklist_categories=["Cs"], blacklist_characters=["|", "\n"]
+        ),
+        max_size=10,
+    ),
+)
+_user_agent = st.one_of(
+    st.sampled_from(["(null)", "", "bandersnatch/2.2.1 (cpython 3.7.0)", "ua\nmore"]),
+    st.text(alphabet=st.characters(blacklist_categories=["Cs"]), max_size=20),
+)
+
+
+@st.composite
+def _messages(draw):
+    # Start from a well formed line, and then maybe break one of its fields, so that
+    # we exercise both sides of the fast path's accept/reject decision.
+    header = draw(st.sampled_from(["download", "simple"]))
+    fields = [
+        "Fri, 20 Jul 2018 02:19:19 GMT",
+        draw(st.sampled_from(["US", "", "(null)"])),
+        draw(st.sampled_from(["/packages/aa/bb/cfn_flip-1.0.3.tar.gz", "/simple/a/"])),
+        draw(st.sampled_from(["TLSv1.2", "(null)"])),
+        draw(st.sampled_from(["ECDHE-RSA-AES128-GCM-SHA256", "(null)"])),
+    ]
+    if header == "simple":
+        fields += ["", "", ""]
+    else:
+        fields += [
+            draw(st.sampled_from(["cfn-flip", "(null)"])),
+            draw(st.sampled_from(["1.0.3", "(null)"])),
+            draw(st.sampled_from([t.value for t in PackageType] + ["(null)"])),
+        ]
+    if draw(st.booleans()):
+        fields[draw(st.integers(0, len(fields) - 1))] = draw(_tricky_field)
+    if draw(st.booleans()):
+        header = draw(st.sampled_from([" download", "other", "simple ", "download"]))
+    fields.append(draw(_user_agent))
+    return "|".join([header] + fields) + draw(st.sampled_from(["", "\n", "\n  "]))
+
+
+class TestSplitMessage:
+    """
+    The hand written fast path has to agree exactly with the pyparsing grammar for
+    every line that it accepts, otherwise we'd silently change our output.
+    """
+
+    def _assert_matches_grammar(self, message):
+        fast = parser._split_message(message)
+        slow = parser._grammar_message(message)
+        if slow is None:
+            assert fast is None
+            return
+
+        # Splitting the raw bytes has to give us the same thing as splitting the str.
+        fast_bytes = parser._split_message(message.encode())
+        if fast_bytes is not None:
+            assert parser._Message(
+                *(
+                    value.decode() if isinstance(value, bytes) else value
+                    for value in fast_bytes
+                )
+            ) == fast
+        assert _build_or_raise(fast_bytes) == _build_or_raise(fast)
+
+        if fast is not None:
+            assert fast == slow
+            assert _build_or_raise(fast) == _build_or_raise(slow)
+            assert _build_or_raise(fast) == _build_or_raise(fast, strict=True)
+
+    @pytest.mark.parametrize(
+        ("event_data", "expected"), list(_load_event_fixtures(FIXTURE_DIR))
+    )
+    def test_fixtures(self, event_data, expected):
+        assert parser._split_message(event_data) is not None
+        self._assert_matches_grammar(event_data)
+
+    @pytest.mark.parametrize(
+        "message",
+        [
+            "simple|Thu, 07 Jan 2021 20:54:52 GMT|US|/simple/numpy/|TLSv1.2|"
+            "ECDHE-RSA-AES128-GCM-SHA256||||(null)\n",
+            "download|Thu, 07 Jan 2021 20:54:56 GMT||/packages/c5/db/enum34-1.1.6-py2"
+            "-none-any.whl|(null)|(null)|enum34|1.1.6|bdist_wheel|pip/1.5 a|b\r\n",
+        ],
+    )
+    def test_accepted(self, message):
+        assert parser._split_message(message) is not None
+        self._assert_matches_grammar(message)
+
+    @given(_messages())
+    def test_generated(self, message):
+        self._assert_matches_grammar(message)
+
+
+class TestBuildEvent:
+    @pytest.mark.parametrize(
+        ("event_data", "expected"), list(_load_event_fixtures(FIXTURE_DIR))
+    )
+    def test_strict(self, event_data, expected):
+        if inspect.isclass(expected) and issubclass(expected, Exception):
+            with pytest.raises(expected):
+                parse(event_data, strict=True)
+        else:
+            assert parse(event_data, strict=True) == expected
+
+    @pytest.mark.parametrize("cls", [parser.File, parser.Download, parser.Simple])
+    def test_trusted_constructor(self, cls):
+        values = {
+            "timestamp": parser.timestamps.parse_timestamp(
+                "Fri, 20 Jul 2018 02:19:19 GMT"
+            ),
+            "url": "/packages/aa/bb/cfn_flip-1.0.3.tar.gz",
+            "filename": "cfn_flip-1.0.3.tar.gz",
+            "project": "cfn-flip",
+            "version": "1.0.3",
+            "type": PackageType.sdist,
+            "file": parser.File("a", "b", "c", PackageType.sdist),
+        }
+        fields = [f.name for f in parser.attr.fields(cls)]
+        kwargs = {k: v for k, v in values.items() if k in fields}
+        new = parser._trusted_constructor(cls)
+
+        assert new(**kwargs) == cls(**kwargs)
+        assert new(*kwargs.values()) == cls(**kwargs)
+
+    def test_trusted_constructor_skips_validators(self):
+        new = parser._trusted_constructor(parser.File)
+        assert new(None, None, None, None).filename is None
+
+    def test_ignored_before_building(self, monkeypatch):
+        monkeypatch.setattr(parser, "_new_download", pretend.raiser(AssertionError))
+
+        # Even a line that would fail to build is fine, if we're ignoring it anyways.
+        assert parse(
+            "download|Fri, 20 Jul 2018 02:19:19 GMT|JP|/packages/cfn_flip-1.0.3.tar.gz"
+            "|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|(null)|1.0.3|sdist|(null)"
+        ) is None
+
+
+class TestTryParse:
+    @pytest.mark.parametrize(
+        ("event_data", "reason"),
+        [
+            ("not a log line", parser.Reason.grammar_mismatch),
+            (
+                b"download|Fri, 20 Jul 2018 02:19:19 GMT|J\xff|/packages/cfn_flip-1.0.3"
+                b".tar.gz|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|pip",
+                parser.Reason.decode_error,
+            ),
+            (
+                "download|Fri, 20 Jul 2018 02:19:19|JP|/packages/cfn_flip-1.0.3.tar.gz"
+                "|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|Unknown UA",
+                parser.Reason.bad_timestamp,
+            ),
+            (
+                "download|Fri, 20 Jul 2018 02:19:19 GMT|JP|/packages/cfn_flip-1.0.3.tar"
+                ".gz|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|(null)|1.0.3|sdist|Unknown UA",
+                parser.Reason.missing_project,
+            ),
+            (
+                "download|Fri, 20 Jul 2018 02:19:19 GMT|JP|/packages/cfn_flip-1.0.3.tar"
+                ".gz|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|(null)|Unknown UA",
+                parser.Reason.bad_package_type,
+            ),
+            (
+                "simple|Fri, 20 Jul 2018 02:19:19 GMT|JP|/simple|TLSv1.2"
+                "|ECDHE-RSA-AES128-GCM-SHA256||||Unknown UA",
+                parser.Reason.bad_url,
+            ),
+            (
+                "simple|Fri, 20 Jul 2018 02:19:19 GMT|JP|/simple/foo/|TLSv1.2"
+                "|ECDHE-RSA-AES128-GCM-SHA256||||(null)",
+                parser.Reason.ignored_user_agent,
+            ),
+        ],
+    )
+    def test_reasons(self, event_data, reason):
+        assert parser.try_parse(event_data) == (None, reason)
+
+    def test_unknown_user_agent(self):
+        result, reason = parser.try_parse(
+            "simple|Fri, 20 Jul 2018 02:19:19 GMT|JP|/simple/foo/|TLSv1.2"
+            "|ECDHE-RSA-AES128-GCM-SHA256||||Unknown UA"
+        )
+        assert result.project == "foo"
+        assert reason is parser.Reason.unknown_user_agent
+
+    @pytest.mark.parametrize("payload", ["null", '{"installer": 5}'])
+    def test_unstructurable_user_agent(self, payload):
+        result, reason = parser.try_parse(
+            "simple|Fri, 20 Jul 2018 02:19:19 GMT|JP|/simple/foo/|TLSv1.2"
+            f"|ECDHE-RSA-AES128-GCM-SHA256||||pip/20.0 {payload}"
+        )
+        assert result.project == "foo"
+        assert result.details is None
+        assert reason is parser.Reason.unknown_user_agent
+
+    @pytest.mark.parametrize(
+        ("event_data", "expected"), list(_load_event_fixtures(FIXTURE_DIR))
+    )
+    def test_agrees_with_parse(self, event_data, expected):
+        result, reason = parser.try_parse(event_data)
+        if inspect.isclass(expected) and issubclass(expected, Exception):
+            assert result is None
+            assert parser._REASON_EXCEPTIONS[reason] is expected
+        else:
+            assert result == expected
+
+    @given(st.text(alphabet=st.characters(blacklist_characters=["\n"])))
+    def test_never_raises(self, data):
+        assert parser.try_parse(data)[0] is None
+
+
+class TestSuffixCache:
+    @given(
+        _messages(),
+        st.sampled_from(
+            [
+                "Fri, 20 Jul 2018 02:19:19 GMT",
+                "Sat, 21 Jul 2018 02:19:20 GMT",
+                "Fri, 20 Jul 2018 02:19:19",
+                " Fri, 20 Jul 2018 02:19:19 GMT",
+                "",
+            ]
+        ),
+        st.sampled_from([str, str.encode]),
+    )
+    def test_agrees_with_try_parse(self, message, timestamp, wrapper):
+        cache = parser.SuffixCache()
+        header, _, rest = message.partition("|")
+        _, _, rest = rest.partition("|")
+        again = "|".join([header, timestamp, rest])
+
+        for line in [message, again, message]:
+            assert cache.parse(wrapper(line)) == parser.try_parse(wrapper(line))
+
+    def test_hits(self):
+        cache = parser.SuffixCache()
+        message = (
+            "download|{}|JP|/packages/cfn_flip-1.0.3.tar.gz|TLSv1.2"
+            "|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|Unknown UA"
+        )
+        first, _ = parser.try_parse(
+            message.format("Fri, 20 Jul 2018 02:19:19 GMT"), suffixes=cache
+        )
+        second, _ = parser.try_parse(
+            message.format("Fri, 20 Jul 2018 02:19:20 GMT"), suffixes=cache
+        )
+
+        assert second.file is first.file
+        assert (second.timestamp - first.timestamp).total_seconds() == 1
+        assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+        cache.clear()
+        assert cache.stats()["size"] == 0
+
+    def test_bounded(self):
+        cache = parser.SuffixCache(maxsize=2)
+        message = (
+            "simple|Fri, 20 Jul 2018 02:19:19 GMT|JP|/simple/{}/|TLSv1.2"
+            "|ECDHE-RSA-AES128-GCM-SHA256||||Unknown UA"
+        )
+        for project in ["a", "b", "a", "c"]:
+            cache.parse(message.format(project))
+
+        assert [key[1].split("|")[1] for key in cache._entries] == [
+            "/simple/a/",
+            "/simple/c/",
+        ]
+
+    def test_ignored_in_strict_mode(self):
+        cache = parser.SuffixCache()
+        parser.try_parse(
+            "simple|Fri, 20 Jul 2018 02:19:19 GMT|JP|/simple/a/|TLSv1.2"
+            "|ECDHE-RSA-AES128-GCM-SHA256||||(null)",
+            strict=True,
+            suffixes=cache,
+        )
+        assert cache.stats()["misses"] == 0
+
+
+class TestUrlFields:
+    @pytest.mark.parametrize(
+        ("url", "project", "expected"),
+        [
+            (
+                "/packages/aa/bb/cfn_flip-1.0.3.tar.gz",
+                "cfn-flip",
+                parser.UrlFields("cfn_flip-1.0.3.tar.gz", "cfn-flip"),
+            ),
+            (
+                "/packages/aa/bb/Django_Crum-0.7.9-py2.py3-none-any.whl",
+                "Django_Crum",
+                parser.UrlFields(
+                    "Django_Crum-0.7.9-py2.py3-none-any.whl",
+                    "django-crum",
+                    "py2.py3",
+                    "none",
+                    "any",
+                ),
+            ),
+            (
+                "/packages/aa/bb/numpy-1.19.5-1-cp39-cp39-manylinux2010_x86_64.whl",
+                "numpy",
+                parser.UrlFields(
+                    "numpy-1.19.5-1-cp39-cp39-manylinux2010_x86_64.whl",
+                    "numpy",
+                    "cp39",
+                    "cp39",
+                    "manylinux2010_x86_64",
+                ),
+            ),
+            (
+                "/packages/aa/bb/not-a-wheel.whl",
+                "not-a-wheel",
+                parser.UrlFields("not-a-wheel.whl", "not-a-wheel"),
+            ),
+        ],
+    )
+    def test_url_fields(self, url, project, expected):
+        assert parser.url_fields(url, project) == expected
+
+    def test_download(self):
+        cache = parser.UrlCache()
+        url = "/packages/aa/bb/cfn_flip-1.0.3.tar.gz"
+
+        assert cache.download(url, "cfn-flip") is cache.download(url, "cfn-flip")
+        assert cache.hit_rate == 0.5
+
+    def test_download_other_project(self):
+        cache = parser.UrlCache()
+        url = "/packages/aa/bb/cfn_flip-1.0.3.tar.gz"
+
+        assert cache.download(url, "cfn-flip").normalized_project == "cfn-flip"
+        assert cache.download(url, "Other_Project").normalized_project == (
+            "other-project"
+        )
+
+    @pytest.mark.parametrize(
+        ("url", "expected"),
+        [("/simple/foo/", "foo"), ("/simple/", ""), ("/simple", None)],
+    )
+    def test_simple(self, url, expected):
+        cache = parser.UrlCache()
+        assert cache.simple(url) == expected
+        assert cache.simple(url) == expected
+        assert (cache.lookups, cache.misses) == (2, 1)
+
+    def test_bounded(self):
+        cache = parser.UrlCache(maxsize=2)
+        for project in ["a", "b", "c", "b"]:
+            cache.simple(f"/simple/{project}/")
+        assert cache.misses == 3
+
+        # "a" was the least recently used, and so is the one that went.
+        cache.simple("/simple/a/")
+        assert cache.misses == 4
+
+        cache.clear()
+        assert (cache.lookups, cache.misses) == (0, 0)
+
+
+class TestInternTable:
+    def test_interns(self):
+        table = parser.InternTable()
+        first = table("".join(["U", "S"]))
+        second = table("".join(["U", "S"]))
+
+        assert first == "US"
+        assert second is first
+        assert table(b"US") is first
+        assert table(b"US") is first
+        assert (table.lookups, table.misses) == (4, 2)
+
+    @pytest.mark.parametrize("value", [parser.NullValue, "", b""])
+    def test_nulls(self, value):
+        table = parser.InternTable(nulls=[parser.NullValue, "", b""])
+        assert table(value) is None
+        assert table.misses == 0
+
+    def test_empty_is_not_null(self):
+        table = parser.InternTable()
+        assert table("") == ""
+        assert table(b"") == ""
+
+    def test_bounded(self):
+        table = parser.InternTable(maxsize=2)
+        for value in ["a", "b", "c", "b"]:
+            table(value)
+        assert table.misses == 3
+
+        # "a" was the least recently used, and so is the one that went.
+        assert table("a") == "a"
+        assert table.misses == 4
+
+    def test_dedup_ratio(self):
+        table = parser.InternTable()
+        assert table.dedup_ratio == 0.0
+        for value in ["a", "a", "a", "b"]:
+            table(value)
+        assert table.dedup_ratio == 0.5
+
+        table.clear()
+        assert (table.lookups, table.misses) == (0, 0)
+
+
+class TestStringInterner:
+    def test_shares_strings(self):
+        interner = parser.StringInterner()
+        message = (
+            "download|Fri, 20 Jul 2018 02:19:19 GMT|JP|/packages/cfn_flip-1.0.3.tar.gz"
+            "|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|(null)"
+        )
+        parsed = parser._split_message(message)
+        assert interner.url(parsed.url) is interner.url(message.encode().split(b"|")[3])
+
+    def test_stats(self, monkeypatch):
+        interner = parser.StringInterner()
+        monkeypatch.setattr(parser, "strings", interner)
+
+        message = (
+            b"download|Fri, 20 Jul 2018 02:19:19 GMT|JP|/packages/cfn_flip-1.0.3.tar.gz"
+            b"|TLSv1.2|ECDHE-RSA-AES128-GCM-SHA256|cfn-flip|1.0.3|sdist|Unknown UA"
+        )
+        first, second = parse(message), parse(message)
+
+        assert second.file.project is first.file.project is first.project
+        assert second.url is first.url
+        assert interner.stats()["country_code"] == {
+            "lookups": 2,
+            "unique": 1,
+            "dedup_ratio": 0.5,
+        }
+
+        interner.clear()
+        assert interner.stats()["url"]["lookups"] == 0
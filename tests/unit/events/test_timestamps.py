@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timezone
+
+import pytest
+
+from hypothesis import given, strategies as st
+
+from linehaul.events import timestamps
+
+
+def _strptime(value):
+    return datetime.strptime(value[5:-4], "%d %b %Y %H:%M:%S").replace(
+        tzinfo=timezone.utc
+    )
+
+
+@given(st.datetimes(min_value=datetime(1000, 1, 1)))
+def test_parse_matches_strptime(value):
+    value = value.replace(microsecond=0)
+    formatted = value.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    assert timestamps.parse_timestamp(formatted) == _strptime(formatted)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "Fri, 20 jul 2018 02:19:19 GMT",
+        "Fri, 2 Jul 2018 02:19:19 GMT",
+        "Fri, 20 Jul 2018 2:19:19 GMT",
+    ],
+)
+def test_parse_falls_back_to_strptime(value):
+    assert timestamps.parse_timestamp(value) == _strptime(value)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "",
+        "Fri, 20 Jux 2018 02:19:19 GMT",
+        "Fri, 30 Feb 2018 02:19:19 GMT",
+        "Fri, 20 Jul 2018 25:19:19 GMT",
+        "Fri, ２０ Jul 2018 02:19:19 GMT",
+    ],
+)
+def test_parse_invalid(value):
+    with pytest.raises(ValueError):
+        timestamps.parse_timestamp(value)
+
+
+@given(st.datetimes(timezones=st.just(timezone.utc)))
+def test_format_matches_strftime(value):
+    assert timestamps.format_timestamp(value) == value.strftime(
+        "%Y-%m-%d %H:%M:%S +00:00"
+    )
+
+
+class TestTimestampCodec:
+    def test_memoizes(self):
+        codec = timestamps.TimestampCodec()
+
+        first = codec.parse("Fri, 20 Jul 2018 02:19:19 GMT")
+        assert codec.parse("Fri, 20 Jul 2018 02:19:19 GMT") is first
+        assert codec.format(first) == "2018-07-20 02:19:19 +00:00"
+        assert codec.format(first) == "2018-07-20 02:19:19 +00:00"
+
+        assert (codec.hits, codec.misses) == (2, 2)
+        assert codec.hit_rate == 0.5
+
+    def test_bounded(self):
+        codec = timestamps.TimestampCodec(maxsize=2)
+
+        for second in [0, 1, 2, 3, 4, 3]:
+            codec.parse(f"Fri, 20 Jul 2018 02:19:0{second} GMT")
+        assert (codec.hits, codec.misses) == (1, 5)
+
+        # Only the two most recently used are left.
+        for second in [4, 3, 2]:
+            codec.parse(f"Fri, 20 Jul 2018 02:19:0{second} GMT")
+        assert (codec.hits, codec.misses) == (3, 6)
+
+    def test_clear(self):
+        codec = timestamps.TimestampCodec()
+        codec.parse("Fri, 20 Jul 2018 02:19:19 GMT")
+        codec.clear()
+
+        assert codec.parse.cache_info().currsize == 0
+        assert (codec.hits, codec.misses, codec.hit_rate) == (0, 0, 0.0)
@@ -0,0 +1,62 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from linehaul.cache import LRUCache, hit_rate
+
+
+@pytest.mark.parametrize(
+    ("hits", "misses", "expected"), [(0, 0, 0.0), (1, 3, 0.25), (2, 0, 1.0)]
+)
+def test_hit_rate(hits, misses, expected):
+    assert hit_rate(hits, misses) == expected
+
+
+class TestLRUCache:
+    def test_get_put(self):
+        cache = LRUCache(4)
+        assert cache.get("a") is None
+        cache.put("a", 1)
+        assert cache.get("a") == 1
+        assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+        cache.clear()
+        assert cache.stats() == {"size": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+
+    def test_keeps_first_value(self):
+        cache = LRUCache(4)
+        cache.put("a", 1)
+        cache.put("a", 2)
+        assert cache.get("a") == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        assert list(cache) == ["a", "c"]
+        assert cache.evictions == 1
+
+    def test_bounded_by_cost(self):
+        cache = LRUCache(10, maxcost=5, cost=lambda key, value: value)
+        cache.put("a", 2)
+        cache.put("b", 2)
+        cache.put("c", 2)
+        assert list(cache) == ["b", "c"]
+        assert cache.total_cost == 4
+
+        # Anything that could never fit isn't stored at all.
+        cache.put("d", 6)
+        assert list(cache) == ["b", "c"]
@@ -0,0 +1,52 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import attr
+import attr.validators
+import pytest
+
+from linehaul.codegen import slot_constructor
+
+
+@attr.s(slots=True, frozen=True)
+class Point:
+    x = attr.ib(validator=attr.validators.instance_of(int))
+    y = attr.ib(validator=attr.validators.instance_of(int))
+
+
+def test_assigns_slots():
+    new = slot_constructor(
+        Point, "_new_point", ["x", "y"], [("x", [], "x"), ("y", [], "y")], globs={}
+    )
+    point = new(1, 2)
+
+    assert type(point) is Point
+    assert point == Point(1, 2)
+    # No validators, just like an instance that's been trusted to be correct.
+    assert new("a", "b").x == "a"
+
+
+def test_lines_and_prelude():
+    globs = {}
+    new = slot_constructor(
+        Point,
+        "_point_from_dict",
+        ["data"],
+        [("x", ["    value = data['x'] * 2"], "value"), ("y", [], "data['y']")],
+        globs=globs,
+        prelude=["    if not data:", "        raise ValueError"],
+    )
+
+    assert new({"x": 1, "y": 3}) == Point(2, 3)
+    assert globs["_point_from_dict"] is new
+    with pytest.raises(ValueError):
+        new({})
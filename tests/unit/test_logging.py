@@ -0,0 +1,130 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sys
+
+from linehaul.logging import ErrorAggregator, EventLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _fail(aggregator, kind, sample):
+    try:
+        raise ValueError(sample)
+    except ValueError:
+        return aggregator.report(kind, sample, "Failed on %r.", sample)
+
+
+class TestErrorAggregator:
+    def test_logs_each_kind_once_per_interval(self, caplog):
+        clock = FakeClock()
+        aggregator = ErrorAggregator(
+            logging.getLogger("test"), interval=60, samples=2, clock=clock
+        )
+
+        assert _fail(aggregator, ("parser", "ValueError"), "a")
+        assert _fail(aggregator, "other", "b")
+        assert not any(
+            _fail(aggregator, ("parser", "ValueError"), sample)
+            for sample in ["c", "d", "e"]
+        )
+        assert [r.getMessage() for r in caplog.records] == [
+            "Failed on 'a'.",
+            "Failed on 'b'.",
+        ]
+        assert all(r.exc_info is not None for r in caplog.records)
+        assert (aggregator.errors, aggregator.suppressed) == (5, 3)
+        caplog.clear()
+
+        # Once the interval is up, the next one is logged again, after a summary of
+        # the ones that we held back.
+        clock.now = 60
+        assert _fail(aggregator, ("parser", "ValueError"), "f")
+        assert [r.getMessage() for r in caplog.records] == [
+            "Suppressed 3 more errors like parser/ValueError, for example: 'c', 'd'",
+            "Failed on 'f'.",
+        ]
+        caplog.clear()
+
+        # Nothing has been held back since.
+        aggregator.flush()
+        assert caplog.records == []
+
+    def test_flush(self, caplog):
+        aggregator = ErrorAggregator(logging.getLogger("test"), clock=FakeClock())
+        for sample in ["a", "b"]:
+            _fail(aggregator, "kind", sample)
+        caplog.clear()
+
+        aggregator.flush()
+        aggregator.flush()
+        assert [r.getMessage() for r in caplog.records] == [
+            "Suppressed 1 more errors like kind, for example: 'b'"
+        ]
+
+        aggregator.clear()
+        assert _fail(aggregator, "kind", "c")
+        assert (aggregator.errors, aggregator.suppressed) == (1, 0)
+
+    def test_take_counts(self, caplog):
+        aggregator = ErrorAggregator(logging.getLogger("test"), clock=FakeClock())
+        for sample in ["a", "b"]:
+            _fail(aggregator, "kind", sample)
+
+        assert aggregator.take_counts() == (2, 1)
+        assert aggregator.take_counts() == (0, 0)
+
+        # Taking the counts doesn't let the next one through any sooner.
+        caplog.clear()
+        assert not _fail(aggregator, "kind", "c")
+        assert aggregator.take_counts() == (1, 1)
+
+
+class TestEventLimiter:
+    def test_limits_each_kind(self):
+        clock = FakeClock()
+        limiter = EventLimiter(2, interval=60, clock=clock)
+
+        def record(msg, args):
+            return logging.LogRecord("test", logging.ERROR, "", 0, msg, args, None)
+
+        events = [
+            limiter.before_send({"n": i}, {"log_record": record("Failed on %r", (i,))})
+            for i in range(3)
+        ]
+        assert events == [{"n": 0}, {"n": 1}, None]
+
+        # Breadcrumbs are counted separately from events, and exceptions by type.
+        crumb = {"message": "Failed on 3"}
+        hint = {"log_record": record("Failed on %r", (3,))}
+        assert limiter.before_breadcrumb(crumb, hint) is crumb
+        try:
+            raise KeyError
+        except KeyError:
+            hint = {"exc_info": sys.exc_info()}
+        assert limiter.before_send({}, hint) == {}
+        # As is anything that we can't tell the kind of.
+        assert limiter.before_send({}, None) == {}
+        assert limiter.dropped == 1
+        assert limiter.take_dropped() == 1
+        assert limiter.take_dropped() == 0
+
+        clock.now = 60
+        hint = {"log_record": record("Failed on %r", (4,))}
+        assert limiter.before_send({"n": 4}, hint) == {"n": 4}
@@ -12,10 +12,14 @@
 
 import itertools
 import logging
+import math
 import re
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
+from linehaul.logging import ErrorAggregator
 from linehaul.ua import impl
 
 
@@ -37,6 +41,11 @@ class TestDecorators:
         assert MyParser.args == [MyParserFn]
         assert MyParser.kwargs == {}
 
+        MyParser = impl.ua_parser(prefixes=["my/"])(MyParserFn)
+
+        assert MyParser.args == [MyParserFn]
+        assert MyParser.kwargs == {"prefixes": ["my/"]}
+
     @pytest.mark.parametrize("regexes", [(r"^one$",), (r"^one$", r"^two$")])
     def test_regex_us_parser(self, monkeypatch, regexes):
         class FakeRegexParser:
@@ -55,6 +64,11 @@ class TestDecorators:
         assert MyParser.args == [regexes, MyHandlerFn]
         assert MyParser.kwargs == {}
 
+        MyParser = impl.regex_ua_parser(*regexes, prefixes=["one"])(MyHandlerFn)
+
+        assert MyParser.args == [regexes, MyHandlerFn]
+        assert MyParser.kwargs == {"prefixes": ["one"]}
+
 
 class TestCallbackUserAgentParser:
     def test_undefined_name(self):
@@ -167,7 +181,9 @@ class TestParserSet:
         with pytest.raises(impl.UnableToParse):
             parser("anything")
 
-    def test_error_while_parsing(self, caplog):
+    def test_error_while_parsing(self, monkeypatch, caplog):
+        monkeypatch.setattr(impl, "errors", ErrorAggregator(impl.logger))
+
         def raiser(inp):
             raise ValueError("Oh No")
 
@@ -187,8 +203,24 @@ class TestParserSet:
             )
         ]
 
+        # Any more of the same error are only summarized.
+        for _ in range(2):
+            with pytest.raises(impl.UnableToParse):
+                parser("something else")
+        impl.errors.flush()
+
+        assert caplog.record_tuples[1:] == [
+            (
+                "linehaul.ua.impl",
+                logging.ERROR,
+                "Suppressed 2 more errors like OhNoName/ValueError, for example: "
+                "'something else', 'something else'",
+            )
+        ]
+
     def test_optimizing(self):
-        parser = impl.ParserSet()
+        # Merging after every call keeps the shared counts exact as we go.
+        parser = impl.ParserSet(merge_every=1)
 
         # Override some values to make it easier to test.
         parser._optimize_every = 100
@@ -234,9 +266,349 @@ class TestParserSet:
         # Call our parser one more time, we explictly call it with "one" here, because
         # that should ensure that the first parser has been called at least once more
         # than the third person, and the second parser should have been called almost
-        # twice as many times as either.
+        # twice as many times as either. That call is counted before we optimize.
         parser("one")
 
         assert parser._optimize_in == 100
         assert parser._parsers == [parser2, parser1, parser3]
-        assert parser._counts == {parser1: 14, parser2: 25, parser3: 12}
+        assert parser._counts == {parser1: 13, parser2: 25, parser3: 12}
+
+    def test_prefix_dispatch(self):
+        calls = []
+
+        def recorder(name, result=None):
+            def parser(inp):
+                calls.append(name)
+                if result is None:
+                    raise impl.UnableToParse
+                return result
+
+            return parser
+
+        parser = impl.ParserSet()
+        parser.register(
+            impl.CallbackUserAgentParser(recorder("pip"), prefixes=["pip/"])
+        )
+        parser.register(
+            impl.RegexUserAgentParser(
+                [r"^(?:pip|uv)/"], lambda: "either", prefixes=["pip/", "uv/"]
+            )
+        )
+        parser.register(
+            impl.CallbackUserAgentParser(recorder("ports"), prefixes=["MacPorts"])
+        )
+        parser.register(recorder("generic"))
+
+        assert parser("uv/1.0") == "either"
+        # Depending on the order that they were shuffled into, we may or may not
+        # have tried the generic parser first, but never the other prefixes.
+        assert set(calls) <= {"generic"}
+        calls.clear()
+
+        with pytest.raises(impl.UnableToParse):
+            parser("MacPortsX/1.0")
+        assert sorted(calls) == ["generic", "ports"]
+        calls.clear()
+
+        with pytest.raises(impl.UnableToParse):
+            parser("conda/1.0")
+        assert calls == ["generic"]
+
+    def test_candidates_follow_optimized_order(self):
+        def parser1(inp):
+            raise impl.UnableToParse
+
+        parser2 = impl.CallbackUserAgentParser(lambda inp: "two", prefixes=["two"])
+
+        parser = impl.ParserSet()
+        parser.register(parser1, _randomize=False)
+        parser.register(parser2, _randomize=False)
+        assert parser._candidates_for("two") == [parser1, parser2]
+
+        parser("two")
+        parser._optimize()
+        assert parser._candidates_for("two") == [parser2, parser1]
+
+    def test_concurrent_use(self):
+        def only(name):
+            def parser(inp):
+                if inp != name:
+                    raise impl.UnableToParse
+                return f"{name}!"
+
+            return impl.CallbackUserAgentParser(parser, name=name)
+
+        names = ["one", "two", "three", "four"]
+        parser = impl.ParserSet(optimize_every=37, merge_every=5)
+        for name in names:
+            parser.register(only(name))
+
+        # Reordering the parsers out from under each other, over and over, never
+        # sends a user agent to the wrong parser.
+        def work(offset):
+            inputs = [names[(offset + i) % len(names)] for i in range(500)]
+            return all(parser(inp) == f"{inp}!" for inp in inputs)
+
+        with ThreadPoolExecutor(8) as executor:
+            assert all(executor.map(work, range(8)))
+
+    def test_merges_counts_from_threads(self):
+        parser = impl.ParserSet(optimize_every=None, merge_every=10)
+        parser.register(impl.CallbackUserAgentParser(lambda inp: inp, name="echo"))
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda _: [parser("x") for _ in range(100)], range(4)))
+
+        assert parser.export_profile() == {"echo": 400}
+
+    def test_positions(self):
+        def named(name, result=None, prefixes=None):
+            def parser(inp):
+                if result is None:
+                    raise impl.UnableToParse
+                return result
+
+            return impl.CallbackUserAgentParser(parser, name=name, prefixes=prefixes)
+
+        parser = impl.ParserSet(merge_every=1)
+        first = parser.register(named("first"), position="first")
+        middle = [parser.register(named(name, name)) for name in ["one", "two"]]
+        last = parser.register(position="last")(named("last", "last", ["bot/"]))
+        also_last = parser.register(named("also_last"), position="last")
+
+        assert parser._candidates_for("bot/1") == [
+            first,
+            *parser._parsers,
+            last,
+            also_last,
+        ]
+        assert parser._candidates_for("x") == [first, *parser._parsers, also_last]
+        assert sorted(parser._parsers, key=lambda p: p.name) == middle
+
+        # Neither optimizing nor loading a profile can move them.
+        parser.load_profile({"last": 100, "first": 0})
+        for _ in range(3):
+            parser("bot/1")
+        parser._optimize()
+        assert parser._first == [first]
+        assert parser._last == [last, also_last]
+        assert parser._candidates_for("bot/1")[0] is first
+        assert parser._candidates_for("bot/1")[-2:] == [last, also_last]
+
+    def test_unknown_position(self):
+        parser = impl.ParserSet()
+        with pytest.raises(ValueError, match="Unknown position 'middle'"):
+            parser.register(lambda inp: inp, position="middle")
+
+
+class TestCombinedRegexParser:
+    def test_finds_parser_and_captures(self):
+        parser1 = impl.RegexUserAgentParser(
+            [r"^one/(\d+)$"], lambda version: ("one", version)
+        )
+        parser2 = impl.RegexUserAgentParser(
+            [re.compile(r"^ TWO / (?P<version>\d+) (?P<extra>.*)", re.I | re.X)],
+            lambda version, extra: ("two", version, extra),
+        )
+        parser3 = impl.RegexUserAgentParser(
+            [r"^three/(\d+)", r"^three-(?P<version>\d+)"],
+            lambda *args, **kwargs: ("three", args, kwargs),
+        )
+        combined = impl.CombinedRegexParser([parser1, parser2, parser3])
+
+        assert combined("one/1") == (parser1, ("one", "1"))
+        assert combined("Two/2 extra") == (parser2, ("two", "2", " extra"))
+        assert combined("three/3") == (parser3, ("three", ("3",), {}))
+        assert combined("three-4") == (parser3, ("three", (), {"version": "4"}))
+        with pytest.raises(impl.UnableToParse):
+            combined("TWO/x")
+        with pytest.raises(impl.UnableToParse):
+            combined("four/4")
+
+    def test_falls_back_when_handler_rejects(self):
+        def reject(version):
+            raise impl.UnableToParse
+
+        parser1 = impl.RegexUserAgentParser([r"^thing/(\d+)"], reject)
+        parser2 = impl.RegexUserAgentParser([r"^thing/(\d+)$"], lambda version: version)
+        combined = impl.CombinedRegexParser([parser1, parser2])
+
+        assert combined("thing/1") == (parser2, "1")
+
+    @pytest.mark.parametrize(
+        "regex",
+        [
+            re.compile(rb"^bytes/"),
+            re.compile(r"^(?P<name>\w+)/(?P=name)"),
+            re.compile(r"(?i)^global/"),
+            re.compile(r"unanchored/"),
+            re.compile(r"^anchored/(\S+)$|unanchored/(\S+)$"),
+            re.compile(r"^multiline/", re.MULTILINE),
+        ],
+    )
+    def test_cannot_combine(self, regex):
+        parser = impl.RegexUserAgentParser([regex], lambda *args, **kwargs: None)
+        assert not impl.CombinedRegexParser.can_combine(parser)
+
+    @pytest.mark.parametrize("combine_regexes", [True, False])
+    def test_unanchored_branch(self, combine_regexes):
+        parser = impl.ParserSet(combine_regexes=combine_regexes)
+        parser.register(
+            impl.RegexUserAgentParser(
+                [r"^foo/(\S+)$|bar/(\S+)$"], lambda foo, bar: foo or bar
+            )
+        )
+        parser.register(impl.RegexUserAgentParser([r"^baz/(\S+)$"], lambda v: v))
+
+        assert parser("x bar/1") == "1"
+
+    @pytest.mark.parametrize(
+        "regex",
+        [
+            re.compile(r"^anchored/"),
+            re.compile(r"^one/|^two/"),
+            re.compile(r"(?:^grouped/)"),
+            re.compile(r"  ^ verbose/", re.VERBOSE),
+        ],
+    )
+    def test_can_combine(self, regex):
+        parser = impl.RegexUserAgentParser([regex], lambda *args, **kwargs: None)
+        assert impl.CombinedRegexParser.can_combine(parser)
+
+    @pytest.mark.parametrize("combine_regexes", [True, False])
+    def test_parser_set(self, combine_regexes):
+        parser = impl.ParserSet(combine_regexes=combine_regexes, merge_every=1)
+        regex1 = impl.RegexUserAgentParser([r"^one/(\d+)"], lambda v: ("one", v))
+        regex2 = impl.RegexUserAgentParser([r"^two/(\d+)"], lambda v: ("two", v))
+        def three(inp):
+            if not inp.startswith("three/"):
+                raise impl.UnableToParse
+            return "three"
+
+        callback = impl.CallbackUserAgentParser(three)
+        for p in [regex1, regex2, callback]:
+            parser.register(p)
+
+        kinds = {type(p) for p in parser._candidates_for("one/1")}
+        assert (impl.CombinedRegexParser in kinds) == combine_regexes
+
+        assert parser("one/1") == ("one", "1")
+        assert parser("two/2") == ("two", "2")
+        assert parser("three/3") == "three"
+        # Hits are still counted against the parser that actually parsed it.
+        assert parser._counts == {regex1: 1, regex2: 1, callback: 1}
+
+
+class TestProfiles:
+    def _parser_set(self, **kwargs):
+        parsers = [
+            impl.CallbackUserAgentParser(lambda inp: inp, name=name, prefixes=[name])
+            for name in ["one", "two", "three"]
+        ]
+        parser = impl.ParserSet(**kwargs)
+        for p in parsers:
+            parser.register(p, _randomize=False)
+        return parser, parsers
+
+    def test_export(self):
+        parser, _ = self._parser_set()
+        for inp in ["two", "two", "three"]:
+            parser(inp)
+        assert parser.export_profile() == {"two": 2, "three": 1}
+
+    def test_load(self):
+        parser, (one, two, three) = self._parser_set()
+        parser._candidates_for("three")
+
+        parser.load_profile({"three": 10, "two": 5, "unknown": 100})
+
+        assert parser._parsers == [three, two, one]
+        assert parser._counts == {three: 10, two: 5}
+        assert parser._candidates == {}
+
+    def test_never_optimize(self):
+        parser, parsers = self._parser_set(optimize_every=None)
+        for _ in range(10):
+            parser("three")
+        assert parser._optimize_in == math.inf
+        assert parser._parsers == parsers
+
+
+class TestParserStats:
+    def test_record(self):
+        stats = impl.ParserStats()
+        for elapsed in range(1, 101):
+            stats.record("slow", elapsed * 1000, "misses")
+        stats.record("slow", 1000, "hits")
+        stats.record("fast", 10, "errors")
+        stats.record("phase", 500)
+
+        snapshot = stats.snapshot()
+        assert list(snapshot) == ["slow", "phase", "fast"]
+        assert snapshot["slow"] == {
+            "attempts": 101,
+            "hits": 1,
+            "misses": 100,
+            "errors": 0,
+            "total_ms": 5.051,
+            "p50_us": 50.0,
+            "p90_us": 90.0,
+            "p99_us": 99.0,
+        }
+        assert snapshot["fast"]["errors"] == 1
+        assert snapshot["phase"]["attempts"] == 1
+        assert stats.format().splitlines()[1] == (
+            "phase: attempts=1, hits=0, misses=0, errors=0, total_ms=0.00, "
+            "p50_us=0.50, p90_us=0.50, p99_us=0.50"
+        )
+
+        stats.clear()
+        assert stats.snapshot() == {}
+
+    def test_bounded_samples(self, monkeypatch):
+        monkeypatch.setattr(impl.ParserStats, "SAMPLES", 2)
+        stats = impl.ParserStats()
+        for elapsed in [1000, 2000, 3000]:
+            stats.record("parser", elapsed)
+        assert stats.snapshot()["parser"]["p50_us"] == 3.0
+
+    def test_parser_set(self, caplog):
+        def fails(inp):
+            raise ValueError
+
+        def misses(inp):
+            raise impl.UnableToParse
+
+        regex1 = impl.RegexUserAgentParser([r"^one$"], lambda: "one", name="regex1")
+        regex2 = impl.RegexUserAgentParser([r"^two$"], lambda: "two", name="regex2")
+
+        parser = impl.ParserSet(merge_every=1)
+        for p in [
+            regex1,
+            regex2,
+            impl.CallbackUserAgentParser(fails),
+            impl.CallbackUserAgentParser(misses),
+        ]:
+            parser.register(p)
+        assert parser.stats is None
+
+        stats = parser.enable_stats()
+        assert parser.enable_stats() is stats
+        assert parser("two") == "two"
+        with pytest.raises(impl.UnableToParse):
+            parser("three")
+
+        snapshot = stats.snapshot()
+        # Depending on the order that they were shuffled into, "two" may or may
+        # not have been tried with the other parsers, but "three" was tried with all.
+        assert snapshot["regex2"]["hits"] == 1
+        assert snapshot["regex2"]["misses"] == 1
+        for name, outcome in [("regex1", "misses"), ("misses", "misses")]:
+            assert snapshot[name][outcome] in {1, 2}
+        assert snapshot["fails"]["errors"] in {1, 2}
+        assert parser._counts[regex2] == 1
+
+        parser.disable_stats()
+        assert parser.stats is None
+        assert parser("one") == "one"
+        assert stats.snapshot()["regex1"] == snapshot["regex1"]
@@ -12,6 +12,10 @@
 
 import json
 import os.path
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import cattr
 import pytest
@@ -181,3 +185,212 @@ class TestParse:
     def test_unknown_user_agent(self, user_agent):
         with pytest.raises(parser.UnknownUserAgentError):
             parser.parse(user_agent)
+
+    @pytest.mark.parametrize("instrumented", [False, True])
+    @pytest.mark.parametrize("payload", ["null", '{"installer": 5}'])
+    def test_unstructurable_payload_is_unknown(self, instrumented, payload):
+        # A payload of JSON null decodes to None, which is no UserAgent, but isn't
+        # one of the user agents that we ignore either.
+        if instrumented:
+            parser.enable_stats()
+        try:
+            assert parser._parse("(null)") is None
+            with pytest.raises(parser.UnknownUserAgentError):
+                parser._parse(f"pip/20.0 {payload}")
+        finally:
+            parser.disable_stats()
+
+    def test_unstructurable_payload_is_cached(self):
+        cache = parser.UserAgentCache()
+        for _ in range(2):
+            with pytest.raises(parser.UnknownUserAgentError):
+                cache("pip/20.0 null")
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+class TestUserAgentCache:
+    def test_caches_results(self, monkeypatch):
+        cache = parser.UserAgentCache()
+        calls = []
+        monkeypatch.setattr(
+            parser, "_parser", lambda ua: calls.append(ua) or {"python": "3.8.5"}
+        )
+
+        first = cache("pip/20.0.2")
+        assert cache("pip/20.0.2") is first
+        assert first == UserAgent(python="3.8.5")
+        assert calls == ["pip/20.0.2"]
+        assert cache.stats() == {
+            "size": 1,
+            "bytes": sys.getsizeof("pip/20.0.2") + cache.ENTRY_OVERHEAD,
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "hit_rate": 0.5,
+        }
+
+    def test_caches_ignored_and_unknown(self, monkeypatch):
+        cache = parser.UserAgentCache()
+        calls = []
+
+        def _parser(ua):
+            calls.append(ua)
+            # Just like IgnoredUserAgent.
+            if ua == "(null)":
+                return parser._IGNORED
+            raise parser.UnableToParse
+
+        monkeypatch.setattr(parser, "_parser", _parser)
+
+        for _ in range(2):
+            assert cache("(null)") is None
+            with pytest.raises(parser.UnknownUserAgentError):
+                cache("Unknown UA")
+        assert calls == ["(null)", "Unknown UA"]
+        assert (cache.hits, cache.misses) == (2, 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = parser.UserAgentCache(maxsize=2)
+        for ua in ["pip/1.0", "(null)", "pip/1.0", "Unknown UA"]:
+            try:
+                cache(ua)
+            except parser.UnknownUserAgentError:
+                pass
+
+        assert list(cache._entries) == ["pip/1.0", "Unknown UA"]
+        assert cache.evictions == 1
+
+    def test_memory_cap(self):
+        ua = "(null)"
+        size = sys.getsizeof(ua) + parser.UserAgentCache.ENTRY_OVERHEAD
+        cache = parser.UserAgentCache(maxbytes=size)
+
+        cache(ua)
+        assert cache.nbytes == size
+        cache("x" * 1024 + " Nutch")
+        assert list(cache._entries) == [ua]
+
+        cache.clear()
+        assert cache.stats()["bytes"] == 0
+
+    def test_shared_between_threads(self):
+        cache = parser.UserAgentCache(maxsize=3)
+        user_agents = [f"conda/4.{minor}.0" for minor in range(7)] + ["(null)"]
+
+        def work(offset):
+            results = []
+            for i in range(200):
+                ua = user_agents[(offset + i) % len(user_agents)]
+                results.append((ua, cache(ua)))
+            return results
+
+        with ThreadPoolExecutor(8) as executor:
+            for results in executor.map(work, range(8)):
+                for ua, result in results:
+                    assert result == parser._parse(ua)
+
+        assert len(cache._entries) <= 3
+        assert cache.hits + cache.misses == 8 * 200
+
+
+class TestUserAgentLimit:
+    def test_short_enough(self):
+        limit = parser.UserAgentLimit(max_length=10, policy="hash")
+        assert limit("pip/1.0") == "pip/1.0"
+        assert limit("x" * 10) == "x" * 10
+        assert limit.overlong == 0
+
+    def test_truncate(self):
+        limit = parser.UserAgentLimit(max_length=16)
+        assert limit("conda/4.9.2 " + "x" * 100) == "conda/4.9.2 xxxx"
+        assert limit.overlong == 1
+
+    def test_take_overlong(self):
+        limit = parser.UserAgentLimit(max_length=4)
+        limit("x" * 5)
+        limit("x" * 6)
+        assert limit.take_overlong() == 2
+        assert limit.take_overlong() == 0
+
+    def test_hash(self):
+        limit = parser.UserAgentLimit(max_length=16, policy="hash")
+        first, second = limit("x" * 100), limit("x" * 99 + "y")
+        assert first != second
+        assert first == limit("x" * 100)
+        assert len(first) < 100
+        assert limit.overlong == 3
+        with pytest.raises(parser.UnknownUserAgentError):
+            parser._parse(first)
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError, match="Unknown user agent length policy"):
+            parser.UserAgentLimit(policy="drop")
+
+    def test_parse(self, monkeypatch):
+        monkeypatch.setattr(parser, "limit", parser.UserAgentLimit(max_length=16))
+        monkeypatch.setattr(parser, "cache", parser.UserAgentCache())
+
+        ua = "conda/4.9.2 " + "x" * 1024
+        assert parser.parse(ua) == parser._parse("conda/4.9.2")
+        assert list(parser.cache._entries) == [ua[:16]]
+
+
+@pytest.mark.parametrize(
+    "ua",
+    [
+        "pip/1.5 " + "a/" * 25000 + " ",
+        "pdm/1.0 " + "a/" * 25000 + " ",
+        "poetry/1.0 a/a " + "a/" * 25000 + " ",
+        "twine/1.0 " + "a/" * 25000 + " ",
+        "twine/1.0 " + "a/a " * 12500 + "/",
+        "Homebrew/2.0 (Macintosh; Intel Mac OS X 10.15) " + "a " * 25000,
+        "Bazel/release " + "a " * 25000,
+    ],
+)
+def test_long_user_agents(ua):
+    # A quadratic amount of backtracking in any of our regexes would take several
+    # seconds for these, rather than a few milliseconds.
+    start = time.perf_counter()
+    try:
+        parser._parse(ua)
+    except parser.UnknownUserAgentError:
+        pass
+    assert time.perf_counter() - start < 1
+
+
+@pytest.mark.parametrize(("ua", "expected"), list(_load_ua_fixtures(FIXTURE_DIR)))
+def test_declared_prefixes(ua, expected):
+    # A parser that declares its prefixes must never be able to parse anything that
+    # doesn't start with one of them, or the ParserSet would skip it.
+    parsers = parser._parser
+    for ua_parser in parsers._first + parsers._parsers + parsers._last:
+        if not ua_parser.prefixes or ua.startswith(tuple(ua_parser.prefixes)):
+            continue
+        with pytest.raises(parser.UnableToParse):
+            ua_parser(ua)
+
+
+class TestStats:
+    @pytest.fixture(autouse=True)
+    def stats(self):
+        stats = parser.enable_stats()
+        yield stats
+        parser.disable_stats()
+
+    def test_records_parse(self, stats):
+        assert parser._parse("pip/1.4.1 CPython/2.7.6 Darwin/12.5.0") is not None
+        assert parser._parse("(null)") is None
+        with pytest.raises(parser.UnknownUserAgentError):
+            parser._parse("Definitely not a user agent")
+
+        snapshot = parser.stats()
+        assert snapshot["Pip1_4UserAgent"]["hits"] == 1
+        assert snapshot["structure"]["attempts"] == 1
+        assert snapshot["IgnoredUserAgent"]["hits"] == 1
+        assert snapshot["ignore_re"]["attempts"] == 1
+        assert snapshot["BrowserUserAgent"]["misses"] in {2, 3}
+
+    def test_disabled(self):
+        parser.disable_stats()
+        parser._parse("pip/1.4.1 CPython/2.7.6 Darwin/12.5.0")
+        assert parser.stats() is None
@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import cattr
+import pytest
+
+from hypothesis import given, strategies as st
+
+from linehaul.ua import payloads
+from linehaul.ua.datastructures import UserAgent
+from linehaul.ua.structuring import structure_user_agent
+
+
+PAYLOADS = [
+    '{"installer":{"name":"pip","version":"24.0","subcommand":["install"]},'
+    '"python":"3.12.1","implementation":{"name":"CPython","version":"3.12.1"},'
+    '"distro":{"name":"Ubuntu","version":"22.04","id":"jammy",'
+    '"libc":{"lib":"glibc","version":"2.35"}},"system":{"name":"Linux",'
+    '"release":"6.5.0"},"cpu":"x86_64","openssl_version":"OpenSSL 3.0.2",'
+    '"setuptools_version":"69.0.3","rustc_version":"1.75.0","ci":null,'
+    '"user_data":{"anything":["at","all"]}}',
+    '{"installer":{"name":"uv","version":"0.4.18"},"ci":true}',
+    '{"python":3,"ci":1}',
+    '{"installer":{"name":"pip","version":NaN}}',
+    '{"installer":{"name":"\\ud800"}}',
+    '{"cpu":123456789012345678901234567890}',
+    '{"installer":"pip"}',
+    '{"installer":{"name":"a"},"installer":{"name":"b"}}',
+    "[1, 2, 3]",
+    "null",
+    "{}",
+    "",
+    "{",
+    '{"installer":{}} trailing',
+]
+
+
+def _decode_or_error(backend, payload):
+    try:
+        return structure_user_agent(payloads.BACKENDS[backend](payload))
+    except Exception as exc:
+        return type(exc)
+
+
+def _expected(payload):
+    try:
+        return cattr.structure(json.loads(payload), UserAgent)
+    except Exception as exc:
+        return type(exc)
+
+
+@pytest.mark.parametrize("backend", list(payloads.BACKENDS))
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_backend_parity(backend, payload):
+    assert _decode_or_error(backend, payload) == _expected(payload)
+
+
+@pytest.mark.parametrize("backend", list(payloads.BACKENDS))
+@given(
+    st.dictionaries(
+        st.sampled_from(["installer", "python", "ci", "cpu", "name", "other"]),
+        st.none()
+        | st.booleans()
+        | st.integers()
+        | st.floats()
+        | st.text()
+        | st.dictionaries(
+            st.sampled_from(["name", "version", "subcommand"]), st.text()
+        ),
+    ).map(json.dumps)
+)
+def test_backend_parity_fuzzed(backend, payload):
+    assert _decode_or_error(backend, payload) == _expected(payload)
+
+
+@pytest.mark.skipif(payloads.msgspec is None, reason="msgspec is not installed")
+def test_msgspec_decodes_straight_to_user_agent():
+    decoded = payloads.BACKENDS["msgspec"](PAYLOADS[0])
+    assert type(decoded) is UserAgent
+    assert decoded.distro.libc.lib == "glibc"
+
+
+class TestPayloadDecoder:
+    def test_default_backend(self):
+        assert payloads.PayloadDecoder().backend == list(payloads.BACKENDS)[-1]
+
+    def test_select_backend(self):
+        decoder = payloads.PayloadDecoder("stdlib")
+        assert decoder('{"cpu":"x86_64"}') == {"cpu": "x86_64"}
+        with pytest.raises(json.JSONDecodeError):
+            decoder("{")
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError, match="Unknown or unavailable JSON backend"):
+            payloads.PayloadDecoder("pickle")
@@ -0,0 +1,75 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import io
+import json
+import os
+
+from linehaul.ua import parser, profile
+
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "..", "..")
+
+USER_AGENTS = [
+    "pip/20.0.2 {}",
+    "pip/1.4.1 CPython/2.7.6 Darwin/12.5.0",
+    "bandersnatch/2.2.1 (cpython 3.7.0-final0, Darwin x86_64)",
+    "pip/20.0.2 {}",
+    "Definitely not a user agent",
+    "(null)",
+]
+
+
+def test_build():
+    assert profile.build(USER_AGENTS) == {
+        "Pip6UserAgent": 2,
+        "Pip1_4UserAgent": 1,
+        "BandersnatchUserAgent": 1,
+    }
+
+
+def test_build_skips_positioned_parsers():
+    # IgnoredUserAgent is always tried last, so a profile has nothing to say about it.
+    assert "IgnoredUserAgent" not in profile.build(["(null)", "Ruby"])
+
+
+def test_build_is_order_independent():
+    backwards = parser.ParserSet()
+    for p in reversed(parser._parser._parsers):
+        backwards.register(p, _randomize=False)
+    assert profile.build(USER_AGENTS, backwards) == profile.build(USER_AGENTS)
+
+
+def test_dump_and_load():
+    fp = io.StringIO()
+    profile.dump({"Pip6UserAgent": 2, "BandersnatchUserAgent": 1}, fp)
+    fp.seek(0)
+
+    parsers = parser.ParserSet()
+    for p in parser._parser._parsers:
+        parsers.register(p)
+    profile.load(fp, parsers)
+
+    assert [p.name for p in parsers._parsers[:2]] == [
+        "Pip6UserAgent",
+        "BandersnatchUserAgent",
+    ]
+
+
+
+def test_main(capsys):
+    profile.main(sorted(glob.glob(os.path.join(ROOT, "fixtures", "*.log.gz"))))
+
+    counts = json.loads(capsys.readouterr().out)["counts"]
+    assert counts["Pip6UserAgent"] > 0
+    assert "IgnoredUserAgent" not in counts
@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Times every registered user agent parser against long and crafted user agents, of
+doubling lengths, and fails if the time any of them takes grows faster than
+linearly with the length of the user agent, which is what a regex that backtracks
+catastrophically looks like.
+"""
+
+import math
+import time
+
+import pytest
+
+from linehaul.ua import parser as user_agents
+
+
+# What to start with after a parser's prefix, so that we get past its version.
+SEEDS = ["", "1.0 ", "1.0 (", "1.0 a/"]
+# What to repeat after that, picked to keep greedy groups and optional tails that
+# can both match spaces, slashes and everything else, guessing at where they should
+# split.
+FILLERS = ["a", " ", "a ", "a/", " a/", "a/a ", "/ ", "(", ")", " (", "a (", "a)"]
+# And what to end on, so that the whole thing almost, but doesn't quite, match.
+ENDINGS = ["", " ", "/", "!", " a/", "\n"]
+
+LENGTHS = [1000, 2000, 4000, 8000]
+# Linear is a slope of 1 and quadratic is 2, with some room for noise in between.
+MAX_SLOPE = 1.5
+
+
+def _parsers():
+    parsers = user_agents._parser
+    return parsers._first + parsers._parsers + parsers._last
+
+
+def _inputs(parser, length):
+    """
+    The user agents of (about) the given length to try the given parser with.
+    """
+    for prefix in getattr(parser, "prefixes", None) or [""]:
+        for seed in SEEDS:
+            for filler in FILLERS:
+                body = filler * (length // len(filler))
+                for ending in ENDINGS:
+                    yield prefix + seed + body + ending
+
+
+def _time(parser, length, repeat=3):
+    inputs = list(_inputs(parser, length))
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for user_agent in inputs:
+            # Anything other than UnableToParse would be logged by the ParserSet,
+            # but it's just as finished with the user agent.
+            try:
+                parser(user_agent)
+            except Exception:
+                pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _slope(lengths, timings):
+    """
+    The exponent that timings grows by with lengths, from a least squares fit on a
+    log-log scale, so 1 is linear and 2 is quadratic.
+    """
+    xs = [math.log(length) for length in lengths]
+    ys = [math.log(max(timing, 1e-9)) for timing in timings]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum(
+        (x - mean_x) ** 2 for x in xs
+    )
+
+
+@pytest.mark.parametrize(
+    ("lengths", "timings", "expected"),
+    [
+        ([1, 2, 4], [3, 3, 3], 0),
+        ([1, 2, 4], [1, 2, 4], 1),
+        ([1, 2, 4], [1, 4, 16], 2),
+    ],
+)
+def test_slope(lengths, timings, expected):
+    assert _slope(lengths, timings) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("parser", _parsers(), ids=lambda parser: parser.name)
+def test_linear(parser):
+    timings = [_time(parser, length) for length in LENGTHS]
+    assert _slope(LENGTHS, timings) <= MAX_SLOPE, timings
@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cattr
+import pytest
+
+from hypothesis import given, strategies as st
+
+from linehaul.ua import structuring
+from linehaul.ua.datastructures import Installer, UserAgent
+
+
+_KEYS = [
+    "installer",
+    "name",
+    "version",
+    "subcommand",
+    "python",
+    "implementation",
+    "distro",
+    "id",
+    "libc",
+    "lib",
+    "system",
+    "release",
+    "cpu",
+    "ci",
+    "extra",
+]
+
+_json = st.recursive(
+    st.none() | st.booleans() | st.integers() | st.text(max_size=5),
+    lambda children: st.lists(children, max_size=3)
+    | st.dictionaries(st.sampled_from(_KEYS), children, max_size=5),
+    max_leaves=20,
+)
+
+
+def _structure_or_error(fn, data):
+    try:
+        return fn(data)
+    except Exception as exc:
+        return type(exc)
+
+
+@given(st.dictionaries(st.sampled_from(_KEYS), _json, max_size=8))
+def test_same_as_cattrs(data):
+    assert _structure_or_error(
+        structuring.structure_user_agent, data
+    ) == _structure_or_error(lambda d: cattr.structure(d, UserAgent), data)
+
+
+def test_json_payload():
+    data = {
+        "installer": {"name": "pip", "version": "24.0", "subcommand": ["install"]},
+        "python": "3.12.1",
+        "implementation": {"name": "CPython", "version": "3.12.1"},
+        "distro": {"name": "Ubuntu", "libc": {"lib": "glibc", "version": "2.35"}},
+        "ci": None,
+        "user_data": {"anything": "at all"},
+    }
+
+    # Nothing in here needs cattrs to step in.
+    ua = structuring._structure_user_agent(data)
+    assert ua == cattr.structure(data, UserAgent)
+    assert ua.installer == Installer(name="pip", version="24.0", subcommand=["install"])
+    assert ua.installer.subcommand is not data["installer"]["subcommand"]
+    assert ua.system is None
+
+
+@pytest.mark.parametrize(
+    "data",
+    [{"python": 3}, {"ci": "yes"}, {"installer": {"subcommand": ("install",)}}],
+)
+def test_unexpected_falls_back(data):
+    with pytest.raises(structuring._Unexpected):
+        structuring._structure_user_agent(data)
+    assert structuring.structure_user_agent(data) == cattr.structure(data, UserAgent)
@@ -0,0 +1,55 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from packaging.version import InvalidVersion
+
+from linehaul.ua.versions import VersionGate
+
+
+class TestVersionGate:
+    @pytest.mark.parametrize(
+        ("version", "expected"),
+        [("6", True), ("20.0.2", True), ("7.0b1", True), ("1.5.6", False)],
+    )
+    def test_contains(self, version, expected):
+        gate = VersionGate(">=6")
+        assert (version in gate) is expected
+        # The second time around comes from the cache.
+        assert (version in gate) is expected
+        assert (gate.hits, gate.misses) == (1, 1)
+
+    def test_prereleases(self):
+        assert "7.0b1" not in VersionGate(">=6", prereleases=False)
+
+    def test_invalid(self):
+        gate = VersionGate(">=6")
+        for _ in range(2):
+            with pytest.raises(InvalidVersion):
+                "not a version" in gate
+        assert gate.hits == 1
+
+    def test_bounded(self):
+        gate = VersionGate(">=6", maxsize=2)
+        for version in ["1", "2", "3", "2"]:
+            version in gate
+        assert (gate.hits, gate.misses) == (1, 3)
+        assert gate.hit_rate == 0.25
+        # "1" was the least recently used, and so is the one that went.
+        for version in ["3", "2", "1"]:
+            version in gate
+        assert (gate.hits, gate.misses) == (3, 4)
+
+        gate.clear()
+        assert (gate.hits, gate.misses, gate.hit_rate) == (0, 0, 0.0)
+        assert gate._check.cache_info().currsize == 0